@@ -0,0 +1,281 @@
+import contextlib
+import logging
+import os
+import time
+
+import torch
+from torch import nn
+
+from lora_merge import lora_scaling, read_adapter
+
+logger = logging.getLogger(__name__)
+
+
+class MultiLoraLinear(nn.Module):
+    """
+    Линейный слой базовой модели с несколькими LoRA-адаптерами.
+
+    Базовый слой (в том числе 4-bit bitsandbytes) не меняется, добавки адаптеров
+    считаются поверх него. Какой адаптер применяется к какой строке батча, задаёт
+    AdapterManager.use; строки с разными адаптерами считаются сегментами
+    (по одному матричному умножению на адаптер, как в segmented gather matmul).
+
+    Args:
+        base: исходный линейный слой
+        manager: AdapterManager, хранящий текущее назначение адаптеров
+    """
+
+    def __init__(self, base: nn.Module, manager: "AdapterManager"):
+        super().__init__()
+        self.base = base
+        self.in_features = base.in_features
+        self.out_features = base.out_features
+        self.manager = manager
+        self.lora = {}  # слот адаптера -> (A [r, in], B [out, r], scaling)
+
+    @property
+    def weight(self):
+        return self.base.weight
+
+    @property
+    def bias(self):
+        return self.base.bias
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        out = self.base(x)
+        for slot, rows in self.manager.segments(x.shape[0]):
+            if slot not in self.lora:
+                continue
+            lora_a, lora_b, scaling = self.lora[slot]
+            if rows is None:
+                out = out + (x @ lora_a.T) @ lora_b.T * scaling
+            else:
+                delta = (x.index_select(0, rows) @ lora_a.T) @ lora_b.T * scaling
+                out = out.index_add(0, rows, delta.to(out.dtype))
+        return out
+
+
+class AdapterManager:
+    """
+    Одна базовая модель в памяти и несколько LoRA-адаптеров поверх неё.
+
+    Переключение адаптера - это смена номера слота, веса не перезагружаются,
+    поэтому занимает миллисекунды; каждый адаптер добавляет только свои матрицы A и B.
+
+    Args:
+        model: базовая модель без адаптеров (веса могут быть квантованы)
+        dtype: тип весов адаптеров (по умолчанию тип вычислений модели)
+    """
+
+    def __init__(self, model: nn.Module, dtype: torch.dtype | None = None):
+        self.model = model
+        self.dtype = dtype or getattr(model, "dtype", torch.float32)
+        self.slots = {}  # имя адаптера -> слот
+        self._wrappers = {}  # имя модуля -> MultiLoraLinear
+        self._rows = None  # слот каждого запроса батча (None - без адаптера)
+        self._rows_per_request = 1
+        self._segments = None
+
+    @property
+    def adapters(self) -> list[str]:
+        return list(self.slots)
+
+    @property
+    def active(self) -> str | None:
+        """Имя адаптера всех строк батча, "mixed" для смешанного батча, None - базовая модель."""
+        if self._rows is None or set(self._rows) == {-1}:
+            return None
+        if len(set(self._rows)) > 1:
+            return "mixed"
+        return next(name for name, slot in self.slots.items() if slot == self._rows[0])
+
+    def _wrap(self, name: str) -> MultiLoraLinear:
+        if name not in self._wrappers:
+            module = self.model.get_submodule(name)
+            wrapper = MultiLoraLinear(module, self)
+            parent_name, _, child = name.rpartition(".")
+            setattr(self.model.get_submodule(parent_name), child, wrapper)
+            self._wrappers[name] = wrapper
+        return self._wrappers[name]
+
+    def add_adapter(self, name: str, config: dict, pairs: dict):
+        """
+        Добавляет адаптер из уже прочитанных весов.
+
+        Args:
+            name: имя адаптера для use
+            config: конфигурация адаптера (r, lora_alpha, ...)
+            pairs: {имя модуля: (lora_A, lora_B)}
+        """
+        if config.get("fan_in_fan_out") or config.get("use_dora"):
+            raise ValueError(f"Адаптер {name}: fan_in_fan_out и DoRA не поддерживаются")
+        if name in self.slots:
+            self.remove_adapter(name)
+        slot = max(self.slots.values(), default=-1) + 1
+        for module_name, (lora_a, lora_b) in pairs.items():
+            wrapper = self._wrap(module_name)
+            device = wrapper.base.weight.device
+            wrapper.lora[slot] = (
+                lora_a.to(device, self.dtype),
+                lora_b.to(device, self.dtype),
+                lora_scaling(config, module_name),
+            )
+        self.slots[name] = slot
+
+    def load_adapter(self, name: str, adapter_path: str):
+        """Загружает адаптер PEFT из каталога (adapter_config.json + adapter_model.safetensors)."""
+        start = time.perf_counter()
+        config, pairs, extra = read_adapter(adapter_path)
+        if extra:
+            raise ValueError(f"Адаптер {adapter_path} меняет полные веса (modules_to_save), его нельзя разделять")
+        self.add_adapter(name, config, pairs)
+        logger.info(f"✅ Адаптер {name} загружен из {adapter_path}: {len(pairs)} слоёв, {time.perf_counter() - start:.2f} с")
+
+    def remove_adapter(self, name: str):
+        slot = self.slots.pop(name)
+        for wrapper in self._wrappers.values():
+            wrapper.lora.pop(slot, None)
+
+    def discover(self, root: str) -> list[str]:
+        """Загружает все адаптеры из подкаталогов root (например, models/fine_tuned), имя - имя каталога."""
+        loaded = []
+        for name in sorted(os.listdir(root)):
+            path = os.path.join(root, name)
+            if os.path.exists(os.path.join(path, "adapter_model.safetensors")):
+                self.load_adapter(name, path)
+                loaded.append(name)
+        return loaded
+
+    def adapter_bytes(self) -> int:
+        """Память, занятая весами всех адаптеров."""
+        return sum(
+            a.numel() * a.element_size() + b.numel() * b.element_size()
+            for wrapper in self._wrappers.values() for a, b, _ in wrapper.lora.values()
+        )
+
+    def segments(self, batch_size: int) -> list[tuple[int, torch.Tensor | None]]:
+        """
+        Сегменты батча для MultiLoraLinear: (слот, номера строк), rows=None - все строки.
+
+        В смешанном батче первая размерность входа должна быть ровно числом запросов,
+        умноженным на rows_per_request из use: по ней нельзя отличить строки запросов
+        от склеенных патчей изображений (визуальная часть Qwen2.5-VL), которые
+        считаются только с одним адаптером на батч.
+        """
+        if self._rows is None:
+            return []
+        if len(set(self._rows)) == 1:
+            return [(self._rows[0], None)]
+        expected = len(self._rows) * self._rows_per_request
+        if batch_size != expected:
+            raise ValueError(
+                f"Смешанный батч адаптеров: вход из {batch_size} строк вместо {len(self._rows)} запросов "
+                f"по {self._rows_per_request} строки; склеенные входы (изображения) - только с одним адаптером"
+            )
+        if self._segments is None:
+            rows = torch.tensor(self._rows).repeat_interleave(self._rows_per_request)
+            device = next(iter(self._wrappers.values())).base.weight.device
+            self._segments = [
+                (slot, (rows == slot).nonzero().squeeze(1).to(device)) for slot in sorted(set(self._rows))
+            ]
+        return self._segments
+
+    @contextlib.contextmanager
+    def use(self, adapters: str | list[str | None] | None, rows_per_request: int = 1):
+        """
+        Выбирает адаптеры на время генерации.
+
+        Args:
+            adapters: имя адаптера для всего батча, список имён по запросам батча
+                      (None в списке - запрос без адаптера) или None - базовая модель
+            rows_per_request: подряд идущих строк входа на запрос в смешанном батче
+                              (num_beams при beam search, num_return_sequences при сэмплировании)
+        """
+        if rows_per_request < 1:
+            raise ValueError(f"rows_per_request должно быть положительным, получено {rows_per_request}")
+        previous = self._rows, self._rows_per_request, self._segments
+        if adapters is None:
+            rows = None
+        else:
+            names = [adapters] if isinstance(adapters, str) else adapters
+            unknown = [name for name in names if name is not None and name not in self.slots]
+            if unknown:
+                raise KeyError(f"Адаптеры не загружены: {unknown}")
+            rows = [self.slots[name] if name is not None else -1 for name in names]
+        self._rows, self._rows_per_request, self._segments = rows, rows_per_request, None
+        try:
+            yield self
+        finally:
+            self._rows, self._rows_per_request, self._segments = previous
+
+
+def _random_adapter(model: nn.Module, rank: int, seed: int) -> tuple[dict, dict]:
+    generator = torch.Generator().manual_seed(seed)
+    pairs = {
+        name: (torch.randn(rank, module.in_features, generator=generator) * 0.02,
+               torch.randn(module.out_features, rank, generator=generator) * 0.02)
+        for name, module in model.named_modules() if isinstance(module, nn.Linear)
+    }
+    return {"r": rank, "lora_alpha": rank}, pairs
+
+
+def benchmark_adapters(num_adapters: int = 3, hidden: int = 512, layers: int = 4, rank: int = 16,
+                       batch_size: int = 8, repeats: int = 20) -> dict:
+    """
+    Маленькая модель на CPU с несколькими адаптерами: время переключения адаптера,
+    смешанный батч одним проходом против отдельного прохода на каждый адаптер,
+    память адаптеров против копии модели на адаптер.
+
+    Returns:
+        dict: switch_ms, mixed_ms, per_adapter_ms, max_diff, base_bytes, adapter_bytes
+    """
+    torch.manual_seed(0)
+    model = nn.Sequential(*[
+        nn.Sequential(nn.Linear(hidden, 4 * hidden), nn.GELU(), nn.Linear(4 * hidden, hidden))
+        for _ in range(layers)
+    ]).eval()
+    manager = AdapterManager(model, torch.float32)
+    names = [f"adapter_{i}" for i in range(num_adapters)]
+    adapters = [_random_adapter(model, rank, seed) for seed in range(num_adapters)]
+    for name, (config, pairs) in zip(names, adapters):
+        manager.add_adapter(name, config, pairs)
+
+    x = torch.randn(batch_size, 16, hidden)
+    row_names = [names[i % num_adapters] for i in range(batch_size)]
+    result = {}
+    with torch.inference_mode():
+        start = time.perf_counter()
+        for i in range(repeats):
+            with manager.use(names[i % num_adapters]):
+                pass
+        result["switch_ms"] = (time.perf_counter() - start) / repeats * 1000
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            with manager.use(row_names):
+                mixed = model(x)
+        result["mixed_ms"] = (time.perf_counter() - start) / repeats * 1000
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            separate = torch.empty_like(mixed)
+            for name in names:
+                rows = [i for i, row_name in enumerate(row_names) if row_name == name]
+                with manager.use(name):
+                    separate[rows] = model(x[rows])
+        result["per_adapter_ms"] = (time.perf_counter() - start) / repeats * 1000
+        result["max_diff"] = float((mixed - separate).abs().max())
+
+    result["base_bytes"] = sum(p.numel() * p.element_size() for p in model.parameters())
+    result["adapter_bytes"] = manager.adapter_bytes()
+    print(
+        f"Переключение адаптера {result['switch_ms']:.3f} мс, смешанный батч {result['mixed_ms']:.1f} мс "
+        f"против {result['per_adapter_ms']:.1f} мс по адаптерам (расхождение {result['max_diff']:.1e}), "
+        f"память: база {result['base_bytes'] / 2 ** 20:.1f} МБ + адаптеры {result['adapter_bytes'] / 2 ** 20:.1f} МБ "
+        f"вместо {num_adapters} копий модели"
+    )
+    return result
+
+
+if __name__ == "__main__":
+    benchmark_adapters()
@@ -0,0 +1,214 @@
+import logging
+import os
+import time
+
+from PIL import Image
+from transformers import TextStreamer
+
+from inference_model import (
+    count_image_tokens, count_text_tokens, generate_answer_from_features, generate_answer_from_text,
+    preprocess_images, select_images,
+)
+from map_reduce import CHUNK_TOKEN_BUDGET, ModelBackend, map_reduce_answer
+from page_cache import PageCache
+from page_retrieval import RETRIEVAL_TOP_K, select_pages
+from region_crop import REGION_CROP_MAX_PAGES, question_crops
+from upload_pipeline import build_prompt
+
+logger = logging.getLogger(__name__)
+
+# Режим OCR-сервиса: "auto" - текстовые вопросы по OCR, "crop" - по вырезкам страниц
+# вокруг строк OCR, похожих на вопрос, "off" - всегда по изображениям
+OCR_SERVICE_MODE = os.getenv("OCR_SERVICE_MODE", "auto")
+
+# Слова, по которым вопрос требует визуального анализа, а не только текста
+VISION_KEYWORDS = (
+    "изображ", "картин", "фото", "цвет", "график", "диаграмм", "схем", "рисун",
+    "подпис", "печат", "штамп", "логотип", "выгляд", "расположен", "таблиц",
+)
+
+
+# Проверка, требует ли вопрос визуального анализа страниц
+def needs_vision(question: str) -> bool:
+    question = question.lower()
+    return any(keyword in question for keyword in VISION_KEYWORDS)
+
+
+def answer_prepared(prepared: list[dict], question: str, cache: PageCache, max_new_tokens: int = 256,
+                    stats: dict | None = None, streamer: TextStreamer | None = None,
+                    ocr_mode: str = OCR_SERVICE_MODE) -> str:
+    """
+    Отвечает на вопрос по документам, подготовленным preprocess_upload. Общий путь
+    бота и HTTP-сервера: ответ по OCR-тексту, отбор страниц (RETRIEVAL_TOP_K),
+    вырезки по вопросу и map-reduce для документов больше CHUNK_TOKEN_BUDGET.
+    LoRA-адаптер выбирает вызывающий (use_adapter).
+
+    Args:
+        prepared: результаты preprocess_upload для файлов
+        question: текст вопроса
+        cache: кэш, в котором лежат страницы документов (для вырезок)
+        max_new_tokens: максимальное количество новых токенов ответа
+        stats: если передан, заполняется prompt_tokens и generation_time
+        streamer: получает ответ по мере генерации (ответ map-reduce приходит целиком)
+        ocr_mode: режим OCR-сервиса, с которым подготовлены документы
+    Returns:
+        str: ответ модели
+    """
+    stats = {} if stats is None else stats
+
+    if ocr_mode == "auto" and all("ocr_text" in p for p in prepared) and not needs_vision(question):
+        # Ответ по извлечённому при загрузке тексту, без визуальных токенов
+        document_text = "\n\n".join("\n\n".join(p["ocr_text"]) for p in prepared)
+        prompt = f"Вопрос: {question}\n\nПроанализируй текст документа и дай развернутый ответ."
+        answer = generate_answer_from_text(document_text, prompt, max_new_tokens, stats=stats, streamer=streamer)
+
+        image_tokens = sum(p["image_tokens"] for p in prepared)
+        ocr_time = sum(p["timings"]["ocr"] for p in prepared)
+        logger.info(
+            f"📊 OCR-режим: OCR при загрузке {ocr_time:.2f} с, генерация {stats['generation_time']:.2f} с, "
+            f"токенов промпта {stats['prompt_tokens']} вместо ~{image_tokens} визуальных"
+        )
+        return answer
+
+    # Изображения подготовлены при загрузке - остаётся только генерация,
+    # цифровые страницы PDF идут в промпт текстом
+    features = [p["features"] for p in prepared if p["features"] is not None]
+    document_text = "\n\n".join(p["text_pages"] for p in prepared if p.get("text_pages"))
+    selected = None
+    # KV префикса с изображениями переиспользуется последующими вопросами по документу
+    prefix_key = "|".join(p["content_key"] for p in prepared)
+    if RETRIEVAL_TOP_K > 0 and all("ocr_text" in p and "image_pages" in p for p in prepared):
+        # Модели передаются только страницы, близкие к вопросу
+        retrieval_start = time.perf_counter()
+        all_tokens = sum(count_image_tokens(f) for f in features)
+        features, document_text, selected = retrieve_pages(prepared, question)
+        prefix_key += f"#{selected}"
+        logger.info(
+            f"📊 Отбор страниц: {time.perf_counter() - retrieval_start:.3f} с, страницы {selected}, "
+            f"визуальных токенов {sum(count_image_tokens(f) for f in features)} вместо {all_tokens}"
+        )
+    if ocr_mode == "crop" and not needs_vision(question):
+        # Вместо страниц - миниатюра и вырезки в полном разрешении вокруг нужных строк
+        crops = crop_pages(prepared, selected, question, cache)
+        if crops:
+            page_tokens = sum(count_image_tokens(f) for f in features)
+            features, prefix_key = [preprocess_images(crops)], None
+            logger.info(
+                f"📊 Вырезки по вопросу: {len(crops) - 1} фрагм., "
+                f"визуальных токенов {count_image_tokens(features[0])} вместо {page_tokens}"
+            )
+
+    document_tokens = sum(count_image_tokens(f) for f in features) + count_text_tokens(document_text)
+    if document_tokens > CHUNK_TOKEN_BUDGET and all("page_texts" in p for p in prepared):
+        # Документ не помещается в один промпт: ответы по фрагментам и их объединение
+        answer, report = map_reduce_answer(
+            document_pages(prepared, selected), question,
+            ModelBackend(lambda f, text, n: generate_answer_from_features(f, text, max_new_tokens=n)),
+        )
+        stats["generation_time"] = report["map_time"] + report["reduce_time"]
+        stats["prompt_tokens"] = report["estimate"]["prompt_tokens"]
+        logger.info(
+            f"📊 Map-reduce: {document_tokens} токенов документа, {report['chunks']} фрагментов, "
+            f"reduce-раундов {report['reduce_rounds']}, оценка {report['estimate']['latency']:.1f} с, "
+            f"факт {stats['generation_time']:.1f} с"
+        )
+        if streamer is not None:
+            streamer.on_finalized_text(answer, stream_end=True)
+    else:
+        answer = generate_answer_from_features(
+            features, build_prompt(question, document_text), max_new_tokens,
+            stats=stats, prefix_key=prefix_key, streamer=streamer,
+        )
+
+    saved_tokens = sum(p.get("text_layer_saved_tokens", 0) for p in prepared)
+    if saved_tokens:
+        logger.info(f"📊 Текстовый слой PDF сэкономил ~{saved_tokens} визуальных токенов")
+    return answer
+
+
+# Отбор страниц документов, относящихся к вопросу
+def retrieve_pages(prepared: list[dict], question: str) -> tuple[list[dict], str, list[tuple[int, int]]]:
+    """
+    Выбирает top-k страниц всех файлов по тексту страниц (текстовый слой или OCR).
+
+    Args:
+        prepared: результаты preprocess_upload для файлов сессии
+        question: текст вопроса
+    Returns:
+        tuple: (признаки выбранных страниц-изображений, текст выбранных цифровых страниц,
+                [(номер файла, номер страницы)] выбранных страниц)
+    """
+    pages = [(file_index, page_index, text)
+             for file_index, p in enumerate(prepared) for page_index, text in enumerate(p["ocr_text"])]
+    selected = [pages[i][:2] for i in select_pages([text for _, _, text in pages], question)]
+
+    features, texts = [], []
+    for file_index, p in enumerate(prepared):
+        chosen = [page_index for index, page_index in selected if index == file_index]
+        images = [i for i, page_index in enumerate(p["image_pages"]) if page_index in chosen]
+        if images:
+            features.append(select_images(p["features"], images))
+        texts.extend(
+            f"Страница {page_number(p, page_index)}:\n{p['ocr_text'][page_index]}"
+            for page_index in chosen if page_index not in p["image_pages"]
+        )
+    return features, "\n\n".join(texts), selected
+
+
+# Номер страницы в исходном файле (пустые страницы и повторы могли быть пропущены)
+def page_number(prepared: dict, position: int) -> int:
+    numbers = prepared.get("page_numbers")
+    return (numbers[position] if numbers else position) + 1
+
+
+# Вырезки страниц вокруг строк OCR, относящихся к вопросу
+def crop_pages(prepared: list[dict], selected: list[tuple[int, int]] | None, question: str,
+               cache: PageCache) -> list[Image.Image] | None:
+    """
+    Args:
+        prepared: результаты preprocess_upload для файлов сессии
+        selected: [(номер файла, номер страницы)] после отбора страниц (None - все страницы)
+        question: текст вопроса
+        cache: кэш, в котором лежат страницы документов
+    Returns:
+        list | None: изображения для модели или None, если нужны страницы целиком
+    """
+    pages = [(file_index, position) for file_index, p in enumerate(prepared) for position in p["image_pages"]
+             if selected is None or (file_index, position) in selected]
+    if not pages or len(pages) > REGION_CROP_MAX_PAGES or not all("ocr_regions" in p for p in prepared):
+        return None
+
+    images = []
+    for file_index, position in pages:
+        p = prepared[file_index]
+        image_index = p["image_pages"].index(position)
+        page = cache.load_page(p["cache_key"], image_index)
+        crops = question_crops(page, p["ocr_regions"][image_index], question) if page is not None else None
+        if crops is None:
+            return None
+        images.extend(crops)
+    return images
+
+
+# Постраничное представление документов для map-reduce
+def document_pages(prepared: list[dict], selected: list[tuple[int, int]] | None = None) -> list[dict]:
+    """
+    Args:
+        prepared: результаты preprocess_upload для файлов сессии
+        selected: [(номер файла, номер страницы)] - только эти страницы (None - все)
+    Returns:
+        list: страницы {'label', 'tokens', 'features', 'text'} для map_reduce_answer
+    """
+    pages = []
+    for file_index, p in enumerate(prepared):
+        for page_index, text in enumerate(p["page_texts"]):
+            if selected is not None and (file_index, page_index) not in selected:
+                continue
+            number = page_number(p, page_index)
+            label = f"стр. {number}" if len(prepared) == 1 else f"файл {file_index + 1}, стр. {number}"
+            if page_index in p["image_pages"]:
+                features = select_images(p["features"], [p["image_pages"].index(page_index)])
+                pages.append({"label": label, "tokens": count_image_tokens(features), "features": features, "text": None})
+            else:
+                pages.append({"label": label, "tokens": count_text_tokens(text), "features": None, "text": text})
+    return pages
@@ -0,0 +1,490 @@
+import argparse
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import os
+import time
+import uuid
+
+from aiohttp import web
+
+from image_ingest import load_photo, sniff_format
+from image_tokens import estimate_image_tokens
+from map_reduce import CostModel
+from page_cache import PageCache, content_key
+from pdf_ingest import format_text_pages, ingest_pdf
+
+logger = logging.getLogger(__name__)
+
+API_HOST = os.getenv("API_HOST", "0.0.0.0")
+API_PORT = int(os.getenv("API_PORT", "8080"))
+# "qwen" - модель бота, "stub" - заглушка на CPU для тестов и нагрузочного генератора
+API_BACKEND = os.getenv("API_BACKEND", "qwen")
+# Сколько ждать попутных запросов, прежде чем запускать неполный батч
+BATCH_WAIT_MS = float(os.getenv("API_BATCH_WAIT_MS", "10"))
+MAX_UPLOAD_MB = int(os.getenv("API_MAX_UPLOAD_MB", "20"))
+DEFAULT_MAX_TOKENS = 256
+# Свой кэш подготовленных документов: PageCache рассчитан на один процесс, каталог бота (PAGE_CACHE_DIR) не подходит
+API_PAGE_CACHE_DIR = os.getenv("API_PAGE_CACHE_DIR", "data/api_page_cache")
+API_PAGE_CACHE_MAX_MB = int(os.getenv("API_PAGE_CACHE_MAX_MB", "2048"))
+# Режим OCR (см. answer_pipeline.OCR_SERVICE_MODE)
+OCR_SERVICE_MODE = os.getenv("OCR_SERVICE_MODE", "auto")
+
+
+class QwenBackend:
+    """
+    Qwen2.5-VL бота: документы готовятся preprocess_upload через PageCache сервера,
+    ответ - answer_prepared, тот же путь, что у бота (OCR-текст, отбор страниц,
+    вырезки, map-reduce для длинных документов, кэш KV префикса).
+    Модель обслуживает один запрос за раз (batch_size = 1), как ModelBackend.
+
+    Имя модели в запросе - LoRA-адаптер (LORA_ADAPTERS), иначе адаптер по умолчанию.
+    """
+
+    batch_size = 1
+
+    def __init__(self):
+        # Модель загружается только при выборе этого бэкенда
+        import answer_pipeline
+        import inference_model
+        import upload_pipeline
+
+        inference_model.load_model()
+        self.inference = inference_model
+        self.upload = upload_pipeline
+        self.pipeline = answer_pipeline
+        self.page_cache = PageCache(API_PAGE_CACHE_DIR, API_PAGE_CACHE_MAX_MB * 1024 * 1024)
+        adapters = inference_model.adapter_manager.adapters if inference_model.adapter_manager is not None else []
+        self.models = ["qwen2.5-vl"] + adapters
+
+    def prepare(self, data: bytes, file_type: str) -> dict:
+        return self.upload.preprocess_upload(
+            data, file_type, OCR_SERVICE_MODE != "off", self.page_cache, regions=OCR_SERVICE_MODE == "crop",
+        )
+
+    def generate_batch(self, requests: list[dict]) -> list[str]:
+        answers = []
+        for r in requests:
+            streamer = self.inference.CallbackStreamer(r["on_text"]) if r.get("on_text") else None
+            adapter = r["model"] if r["model"] in self.models[1:] else self.inference.DEFAULT_ADAPTER
+            with self.inference.use_adapter(adapter):
+                answers.append(self.pipeline.answer_prepared(
+                    r["documents"], r["question"], self.page_cache, r["max_new_tokens"],
+                    stats=r["stats"], streamer=streamer, ocr_mode=OCR_SERVICE_MODE,
+                ))
+        return answers
+
+
+class StubChatBackend:
+    """
+    Заглушка для запуска сервера на CPU: документы разбираются так же, как в боте
+    (pdf_ingest, load_photo), а генерация только выдерживает время по CostModel
+    и отдаёт детерминированный ответ по словам. Батч декодируется одновременно.
+
+    Args:
+        batch_size: размер батча
+        cost_model: скорости prefill и декодирования
+    """
+
+    models = ["stub"]
+
+    def __init__(self, batch_size: int = 8, cost_model: CostModel | None = None):
+        self.batch_size = batch_size
+        self.cost_model = cost_model or CostModel()
+        self.prepared = {}  # content_key -> подготовленный документ
+
+    def prepare(self, data: bytes, file_type: str) -> dict:
+        key = content_key(data)
+        if key not in self.prepared:
+            if file_type == "pdf":
+                pages = ingest_pdf(data)
+            else:
+                image = load_photo(data)
+                pages = [{
+                    "index": 0, "kind": "scanned", "text": None, "image": image,
+                    "image_tokens": estimate_image_tokens(*image.size),
+                }]
+            self.prepared[key] = {
+                "content_key": key,
+                "features": None,
+                "text_pages": format_text_pages(pages),
+                "image_tokens": sum(page["image_tokens"] for page in pages if page["image"] is not None),
+            }
+        return self.prepared[key]
+
+    def generate_batch(self, requests: list[dict]) -> list[str]:
+        time.sleep(sum(r["tokens"] for r in requests) / self.cost_model.prefill_tokens_per_s)
+        words = []
+        for r in requests:
+            answer = f"Ответ заглушки на вопрос «{r['question']}» по {len(r['documents'])} файл(ам), " \
+                     f"{r['tokens']} токенов промпта."
+            words.append(answer.split()[:r["max_new_tokens"]])
+            r["stats"]["prompt_tokens"] = r["tokens"]
+            r["stats"]["completion_tokens"] = len(words[-1])
+        for step in range(max(len(w) for w in words)):
+            time.sleep(1 / self.cost_model.decode_steps_per_s)
+            for r, request_words in zip(requests, words):
+                if step < len(request_words) and r.get("on_text"):
+                    r["on_text"](("" if step == 0 else " ") + request_words[step])
+        return [" ".join(w) for w in words]
+
+
+class RequestBatcher:
+    """
+    Собирает одновременные HTTP-запросы в батчи по backend.batch_size и выполняет
+    их по одному батчу за раз в отдельном потоке (модель одна).
+
+    Args:
+        backend: объект с batch_size и generate_batch(requests) -> list[str]
+        max_wait: сколько секунд ждать попутных запросов для неполного батча
+    """
+
+    def __init__(self, backend, max_wait: float = BATCH_WAIT_MS / 1000):
+        self.backend = backend
+        self.max_wait = max_wait
+        self.batches = 0
+        self.requests = 0
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    @property
+    def waiting(self) -> int:
+        return self._queue.qsize()
+
+    async def submit(self, request: dict) -> str:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((request, future))
+        return await future
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.backend.batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), max(deadline - loop.time(), 0)))
+                except asyncio.TimeoutError:
+                    break
+            batch = [(request, future) for request, future in batch if not future.cancelled()]
+            if not batch:
+                continue
+            self.batches += 1
+            self.requests += len(batch)
+            try:
+                answers = await asyncio.to_thread(self.backend.generate_batch, [request for request, _ in batch])
+            except Exception as ex:
+                logger.error(f"❌ Ошибка генерации батча из {len(batch)} запросов: {ex}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(ex)
+                continue
+            for (_, future), answer in zip(batch, answers):
+                if not future.done():
+                    future.set_result(answer)
+
+
+def _decode_data_url(url: str) -> bytes:
+    if not isinstance(url, str) or not url.startswith("data:") or ";base64," not in url:
+        raise web.HTTPBadRequest(text="Изображения и файлы принимаются только как data:...;base64, URL")
+    try:
+        return base64.b64decode(url.split(";base64,", 1)[1], validate=True)
+    except binascii.Error:
+        raise web.HTTPBadRequest(text="Некорректный base64")
+
+
+def parse_messages(messages: list[dict]) -> tuple[str, list[bytes]]:
+    """
+    Вопрос и файлы из сообщений в формате chat completions.
+
+    Вопрос - текст последнего сообщения пользователя, файлы - части image_url
+    и file (file_data) всех сообщений пользователя.
+
+    Args:
+        messages: [{'role', 'content'}], content - строка или список частей
+    Returns:
+        tuple: (вопрос, содержимое файлов)
+    """
+    if not isinstance(messages, list) or not all(isinstance(message, dict) for message in messages):
+        raise web.HTTPBadRequest(text="messages - список объектов {'role', 'content'}")
+    question, files = "", []
+    for message in messages:
+        if message.get("role") != "user":
+            continue
+        content = message.get("content") or ""
+        parts = [{"type": "text", "text": content}] if isinstance(content, str) else content
+        if not isinstance(parts, list) or not all(isinstance(part, dict) for part in parts):
+            raise web.HTTPBadRequest(text="content - строка или список частей {'type', ...}")
+        texts = []
+        for part in parts:
+            if part.get("type") == "text":
+                texts.append(str(part.get("text", "")))
+            elif part.get("type") == "image_url":
+                image_url = part.get("image_url")
+                files.append(_decode_data_url(image_url.get("url") if isinstance(image_url, dict) else image_url))
+            elif part.get("type") == "file":
+                file = part.get("file")
+                files.append(_decode_data_url(file.get("file_data") if isinstance(file, dict) else None))
+        question = "\n".join(text for text in texts if text)
+    return question, files
+
+
+def _file_type(data: bytes) -> str:
+    file_format = sniff_format(data)
+    if file_format is None:
+        raise web.HTTPBadRequest(text="Неподдерживаемый формат файла (ожидается PDF или изображение)")
+    return "pdf" if file_format == "pdf" else "image"
+
+
+class ChatServer:
+    """
+    HTTP-сервер в стиле OpenAI chat completions поверх бэкенда бота.
+
+    POST /v1/chat/completions принимает JSON (изображения и PDF - data URL в частях
+    image_url/file) или multipart/form-data (поля messages или question, файлы - любые
+    части с именем файла), "stream": true отдаёт ответ событиями SSE.
+    GET /v1/models - имена моделей (адаптеров), GET /health - состояние очереди.
+
+    Args:
+        backend: QwenBackend или StubChatBackend
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.batcher = RequestBatcher(backend)
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=MAX_UPLOAD_MB * 1024 * 1024)
+        app.router.add_get("/health", self.health)
+        app.router.add_get("/v1/models", self.list_models)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    async def _on_startup(self, app: web.Application):
+        self.batcher.start()
+
+    async def _on_cleanup(self, app: web.Application):
+        await self.batcher.stop()
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "ok",
+            "backend": type(self.backend).__name__,
+            "batch_size": self.backend.batch_size,
+            "waiting": self.batcher.waiting,
+            "batches": self.batcher.batches,
+            "requests": self.batcher.requests,
+        })
+
+    async def list_models(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "object": "list",
+            "data": [{"id": name, "object": "model", "owned_by": "clever-document-assistant"}
+                     for name in self.backend.models],
+        })
+
+    async def _read_request(self, request: web.Request) -> tuple[dict, str, list[bytes]]:
+        if request.content_type == "multipart/form-data":
+            body, files = {}, []
+            async for part in await request.multipart():
+                if part.filename:
+                    files.append(await part.read(decode=True))
+                else:
+                    body[part.name] = await part.text()
+            if "messages" in body:
+                try:
+                    messages = json.loads(body["messages"])
+                except json.JSONDecodeError:
+                    raise web.HTTPBadRequest(text="Поле messages - не JSON")
+                question, message_files = parse_messages(messages)
+            else:
+                question, message_files = body.get("question", ""), []
+            body["stream"] = body.get("stream", "false").lower() == "true"
+            return body, question, message_files + files
+        try:
+            body = await request.json()
+        except json.JSONDecodeError:
+            raise web.HTTPBadRequest(text="Тело запроса - не JSON")
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text="Тело запроса - не объект JSON")
+        question, files = parse_messages(body.get("messages", []))
+        return body, question, files
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        start = time.perf_counter()
+        body, question, files = await self._read_request(request)
+        if not question:
+            raise web.HTTPBadRequest(text="В сообщениях нет текста вопроса")
+        max_tokens = body.get("max_tokens", body.get("max_completion_tokens"))
+        try:
+            max_new_tokens = DEFAULT_MAX_TOKENS if max_tokens is None else int(max_tokens)
+        except (TypeError, ValueError):
+            max_new_tokens = 0
+        if max_new_tokens <= 0:
+            raise web.HTTPBadRequest(text="max_tokens - положительное целое число")
+        file_types = [_file_type(data) for data in files]
+        documents = await asyncio.gather(*(
+            asyncio.to_thread(self.backend.prepare, data, file_type) for data, file_type in zip(files, file_types)
+        ))
+        model = body.get("model") or self.backend.models[0]
+        chat_request = {
+            "model": model,
+            "question": question,
+            "documents": documents,
+            "tokens": sum(p.get("image_tokens", 0) for p in documents) + len(question) // 4,
+            "max_new_tokens": max_new_tokens,
+            "stats": {},
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        if body.get("stream"):
+            response = await self._stream(request, chat_request, completion_id)
+        else:
+            answer = await self.batcher.submit(chat_request)
+            response = web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                "usage": self._usage(chat_request),
+            })
+        logger.info(
+            f"📊 HTTP-запрос {completion_id}: файлов {len(files)}, {time.perf_counter() - start:.2f} с, "
+            f"потоковый: {bool(body.get('stream'))}"
+        )
+        return response
+
+    @staticmethod
+    def _usage(chat_request: dict) -> dict:
+        prompt_tokens = chat_request["stats"].get("prompt_tokens", chat_request["tokens"])
+        completion_tokens = chat_request["stats"].get("completion_tokens", 0)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    async def _stream(self, request: web.Request, chat_request: dict, completion_id: str) -> web.StreamResponse:
+        loop = asyncio.get_running_loop()
+        texts = asyncio.Queue()
+        # Фрагменты приходят из потока генерации
+        chat_request["on_text"] = lambda text: loop.call_soon_threadsafe(texts.put_nowait, text)
+        task = asyncio.ensure_future(self.batcher.submit(chat_request))
+        task.add_done_callback(lambda _: loop.call_soon_threadsafe(texts.put_nowait, None))
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        async def send(delta: dict, finish_reason: str | None = None, **extra):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": chat_request["model"],
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                **extra,
+            }
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+
+        await send({"role": "assistant"})
+        streamed = False
+        while (text := await texts.get()) is not None:
+            streamed = True
+            await send({"content": text})
+        try:
+            answer = task.result()
+        except Exception as ex:
+            await response.write(f"data: {json.dumps({'error': {'message': str(ex)}}, ensure_ascii=False)}\n\n".encode())
+        else:
+            if not streamed:
+                # Бэкенд не отдаёт ответ по частям
+                await send({"content": answer})
+            await send({}, "stop", usage=self._usage(chat_request))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+async def benchmark_server(url: str = f"http://127.0.0.1:{API_PORT}", concurrency: int = 8,
+                           num_requests: int = 64, stream: bool = False, max_tokens: int = 64) -> dict:
+    """
+    Нагрузка на запущенный сервер: num_requests текстовых вопросов, не больше concurrency одновременно.
+
+    Returns:
+        dict: throughput (запросов/с), p50 и p95 задержки, для stream - p50 времени до первого фрагмента
+    """
+    import aiohttp
+
+    latencies, first_chunks = [], []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(session, i):
+        async with semaphore:
+            start = time.perf_counter()
+            payload = {
+                "messages": [{"role": "user", "content": f"Вопрос {i}: о чём документ?"}],
+                "stream": stream,
+                "max_tokens": max_tokens,
+            }
+            async with session.post(f"{url}/v1/chat/completions", json=payload) as response:
+                response.raise_for_status()
+                if stream:
+                    first_chunk = None
+                    async for line in response.content:
+                        if first_chunk is None and line.startswith(b"data: ") and b'"content"' in line:
+                            first_chunk = time.perf_counter() - start
+                    first_chunks.append(first_chunk)
+                else:
+                    await response.json()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(one(session, i) for i in range(num_requests)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    result = {
+        "throughput": num_requests / elapsed,
+        "p50": latencies[len(latencies) // 2],
+        "p95": latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)],
+    }
+    first_chunks = sorted(t for t in first_chunks if t is not None)
+    if first_chunks:
+        result["first_chunk_p50"] = first_chunks[len(first_chunks) // 2]
+    print(", ".join(f"{name} {value:.3f}" for name, value in result.items()))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-совместимый HTTP-сервер ассистента")
+    parser.add_argument("--backend", choices=("qwen", "stub"), default=API_BACKEND)
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    parser.add_argument("--batch-size", type=int, default=8, help="размер батча заглушки")
+    parser.add_argument("--load", metavar="URL", help="не запускать сервер, а нагрузить уже запущенный")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--stream", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if args.load:
+        asyncio.run(benchmark_server(args.load, args.concurrency, stream=args.stream))
+        return
+    backend = QwenBackend() if args.backend == "qwen" else StubChatBackend(args.batch_size)
+    logger.info(f"🚀 HTTP-сервер ({args.backend}) на {args.host}:{args.port}")
+    web.run_app(ChatServer(backend).app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
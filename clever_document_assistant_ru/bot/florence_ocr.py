@@ -0,0 +1,871 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import wait
+from typing import Callable
+
+import numpy as np
+import torch
+from transformers import AutoModelForCausalLM, AutoProcessor
+from transformers.generation.logits_process import NoRepeatNGramLogitsProcessor
+from transformers.generation.streamers import BaseStreamer
+
+from lora_merge import preferred_model_path
+from page_transport import PageDescriptor, as_image, page_transport
+from shard_loader import PREFETCH_WEIGHTS, prefetch_checkpoint
+from worker_pool import InferencePool
+
+logger = logging.getLogger(__name__)
+
+florence_model_path = preferred_model_path(os.getenv("FLORENCE_MODEL_PATH", "models/fine_tuned/florence_2_large"))
+florence_ocr_task = os.getenv("FLORENCE_OCR_TASK", "<OCR>")
+# Крупные страницы распознаются по перекрывающимся плиткам вместо сжатия до 768x768
+florence_ocr_tiled = os.getenv("FLORENCE_OCR_TILED", "1") == "1"
+florence_tile_batch = int(os.getenv("FLORENCE_TILE_BATCH", "8"))
+# Доля визуальных токенов, остающихся после отбрасывания фона (1.0 - без отбрасывания)
+florence_token_keep_ratio = float(os.getenv("FLORENCE_TOKEN_KEEP_RATIO", "1.0"))
+# K/V кросс-внимания декодера хранятся один раз на изображение, а не на каждый из лучей beam search
+florence_beam_shared_kv = os.getenv("FLORENCE_BEAM_SHARED_KV", "1") == "1"
+# no_repeat_ngram_size (3 в конфиге) проверяется инкрементально, без пересборки n-грамм на каждом шаге
+florence_incremental_ngram = os.getenv("FLORENCE_INCREMENTAL_NGRAM", "1") == "1"
+# Ответ задачи ограничен её словарём и грамматикой (при num_beams=1 логиты только по разрешённым строкам lm_head)
+florence_task_constraint = os.getenv("FLORENCE_TASK_CONSTRAINT", "1") == "1"
+# Реплик Florence-2 в отдельных процессах для OCR страниц при загрузке (0 - OCR в процессе бота)
+florence_workers = int(os.getenv("FLORENCE_WORKERS", "0"))
+
+_florence_model = None
+_florence_processor = None
+# Генерация Florence-2 по одной за раз: ограничение словаря, состояние лучей и кросс-внимания
+# хранятся в модуле модели на время вызова generate, а OCR загрузок идёт из разных потоков (asyncio.to_thread).
+# Бенчмарки держат блокировку, пока переключают настройки модели
+_florence_lock = threading.RLock()
+_task_constraints = {}
+_ocr_pool = None
+
+# Теги, которые не несут текста и координат
+_SKIP_TAGS = ("<s>", "</s>", "<pad>")
+_LOC_RE = re.compile(r"<loc_(\d+)>")
+# Количество координат в quad_box (4 точки по 2 координаты)
+_QUAD_COORDS = 8
+# Размер входа Florence-2 и перекрытие соседних плиток
+TILE_SIZE = 768
+TILE_OVERLAP = 128
+# Страницы меньше этого размера распознаются целиком
+TILE_MIN_SIDE = int(TILE_SIZE * 1.25)
+
+
+class OcrRegionStreamParser:
+    """
+    Инкрементальный парсер вывода Florence-2 для задачи <OCR_WITH_REGION>.
+
+    Повторяет семантику Florence2PostProcesser.parse_ocr_from_text_and_spans,
+    но принимает текст кусками по мере декодирования и отдаёт строку
+    (text, quad_box) сразу, как только пришла её восьмая координата.
+
+    Args:
+        post_processor: Florence2PostProcesser (processor.post_processor)
+        image_size: (width, height) исходного изображения
+    """
+
+    def __init__(self, post_processor, image_size: tuple[int, int]):
+        self.coordinates_quantizer = post_processor.coordinates_quantizer
+        self.area_threshold = post_processor.parse_tasks_configs.get("ocr", {}).get(
+            "AREA_THRESHOLD", 0.0
+        )
+        self.image_size = image_size
+        self.instances = []
+        self._buffer = ""
+        self._text = ""
+        self._coords = []
+        self._raw_locs = []
+
+    def feed(self, chunk: str) -> list[dict]:
+        """
+        Добавляет очередной кусок декодированного текста.
+
+        Args:
+            chunk: новый текст (с сохранёнными специальными токенами)
+        Returns:
+            list: строки {'quad_box', 'text'}, завершённые этим куском
+        """
+        self._buffer += chunk
+        emitted = []
+
+        while self._buffer:
+            idx = self._buffer.find("<")
+            if idx != 0:
+                plain = self._buffer if idx == -1 else self._buffer[:idx]
+                self._append_text(plain)
+                self._buffer = "" if idx == -1 else self._buffer[idx:]
+                continue
+
+            match = _LOC_RE.match(self._buffer)
+            if match:
+                self._coords.append(int(match.group(1)))
+                self._raw_locs.append(match.group(0))
+                self._buffer = self._buffer[match.end():]
+                if len(self._coords) == _QUAD_COORDS:
+                    instance = self._complete_line()
+                    if instance is not None:
+                        emitted.append(instance)
+                continue
+
+            end = self._buffer.find(">")
+            if end == -1:
+                # Тег ещё не докодирован - ждём следующий кусок
+                break
+            tag = self._buffer[: end + 1]
+            if tag in _SKIP_TAGS:
+                self._buffer = self._buffer[end + 1:]
+            else:
+                self._append_text("<")
+                self._buffer = self._buffer[1:]
+
+        self.instances.extend(emitted)
+        return emitted
+
+    def finish(self) -> list[dict]:
+        """
+        Завершает разбор. Незавершённый хвост без координат отбрасывается,
+        как и в пакетном парсере.
+
+        Returns:
+            list: все разобранные строки
+        """
+        self._buffer = ""
+        self._text = ""
+        self._coords = []
+        self._raw_locs = []
+        return self.instances
+
+    def _append_text(self, text: str):
+        # Прерванная текстом серия координат становится частью текста строки
+        if self._raw_locs:
+            self._text += "".join(self._raw_locs)
+            self._coords = []
+            self._raw_locs = []
+        self._text += text
+
+    def _complete_line(self) -> dict | None:
+        if not self._text:
+            # Как и (.+?) в регулярном выражении: первая координата уходит в текст
+            self._text = self._raw_locs.pop(0)
+            self._coords.pop(0)
+            return None
+
+        text = self._text
+        quad_box = self.coordinates_quantizer.dequantize(
+            torch.tensor(np.array(self._coords).reshape(-1, 2)),
+            size=self.image_size,
+        ).reshape(-1).tolist()
+        self._text = ""
+        self._coords = []
+        self._raw_locs = []
+
+        if self.area_threshold > 0:
+            image_width, image_height = self.image_size
+            x_coords = quad_box[0::2]
+            y_coords = quad_box[1::2]
+            area = 0.5 * abs(
+                sum(x_coords[i] * y_coords[i + 1] - x_coords[i + 1] * y_coords[i] for i in range(3))
+            )
+            if area < (image_width * image_height) * self.area_threshold:
+                return None
+
+        return {"quad_box": quad_box, "text": text}
+
+
+class OcrRegionStreamer(BaseStreamer):
+    """
+    Стример токенов для model.generate, который передаёт декодированный текст
+    в OcrRegionStreamParser и вызывает on_line для каждой готовой строки.
+
+    Работает только с жадным декодированием (num_beams=1), как и все стримеры
+    transformers.
+
+    Args:
+        tokenizer: токенизатор процессора Florence-2
+        parser: OcrRegionStreamParser
+        on_line: функция, вызываемая для каждой строки {'quad_box', 'text'}
+    """
+
+    def __init__(self, tokenizer, parser: OcrRegionStreamParser, on_line: Callable | None = None):
+        self.tokenizer = tokenizer
+        self.parser = parser
+        self.on_line = on_line
+        self.token_cache = []
+        self.print_len = 0
+        self.next_tokens_are_prompt = True
+
+    def put(self, value):
+        if len(value.shape) > 1 and value.shape[0] > 1:
+            raise ValueError("OcrRegionStreamer поддерживает только batch_size=1")
+        # Первый вызов - decoder_input_ids, их пропускаем
+        if self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+
+        self.token_cache.extend(value.reshape(-1).tolist())
+        text = self.tokenizer.decode(self.token_cache, skip_special_tokens=False)
+        # Неполный многобайтовый символ (кириллица) - ждём следующий токен
+        if text.endswith("�"):
+            return
+        self._emit(text[self.print_len:])
+        self.print_len = len(text)
+
+    def end(self):
+        if self.token_cache:
+            text = self.tokenizer.decode(self.token_cache, skip_special_tokens=False)
+            self._emit(text[self.print_len:])
+        self.parser.finish()
+        self.token_cache = []
+        self.print_len = 0
+        self.next_tokens_are_prompt = True
+
+    def _emit(self, chunk: str):
+        if not chunk:
+            return
+        for instance in self.parser.feed(chunk):
+            if self.on_line is not None:
+                self.on_line(instance)
+
+
+def stream_ocr_with_regions(model, processor, image, on_line: Callable | None = None,
+                            max_new_tokens: int = 1024) -> list[dict]:
+    """
+    Запускает <OCR_WITH_REGION> и отдаёт строки по мере декодирования.
+
+    Args:
+        model: Florence2ForConditionalGeneration
+        processor: Florence2Processor
+        image: PIL.Image страницы
+        on_line: функция, вызываемая для каждой готовой строки
+        max_new_tokens: максимальное количество новых токенов
+    Returns:
+        list: все строки {'quad_box', 'text'} в порядке появления
+    """
+    task = "<OCR_WITH_REGION>"
+    inputs = processor(text=task, images=image, return_tensors="pt")
+    inputs = {
+        k: v.to(model.device, dtype=model.dtype if k == "pixel_values" else None)
+        for k, v in inputs.items()
+    }
+    parser = OcrRegionStreamParser(processor.post_processor, (image.width, image.height))
+    streamer = OcrRegionStreamer(processor.tokenizer, parser, on_line=on_line)
+
+    with _florence_lock, torch.inference_mode():
+        model.generate(
+            input_ids=inputs["input_ids"],
+            pixel_values=inputs["pixel_values"],
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            num_beams=1,
+            streamer=streamer,
+        )
+
+    logger.debug(f"✅ Потоковый OCR: {len(parser.instances)} строк")
+    return parser.instances
+
+
+def load_florence():
+    """
+    Лениво загружает Florence-2 (один раз на процесс).
+
+    Returns:
+        tuple: (model, processor)
+    """
+    global _florence_model, _florence_processor
+    with _florence_lock:
+        if _florence_model is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            dtype = torch.float16 if device == "cuda" else torch.float32
+            if PREFETCH_WEIGHTS:
+                prefetch_checkpoint(florence_model_path)
+            model = AutoModelForCausalLM.from_pretrained(
+                florence_model_path,
+                torch_dtype=dtype,
+                trust_remote_code=True,
+            ).eval().to(device)
+            model.image_token_keep_ratio = florence_token_keep_ratio
+            model.beam_shared_cross_attention = florence_beam_shared_kv
+            model.incremental_no_repeat_ngram = florence_incremental_ngram
+            _florence_processor = AutoProcessor.from_pretrained(florence_model_path, trust_remote_code=True)
+            _florence_model = model
+            logger.info(f"✅ Florence-2 загружена из {florence_model_path} ({device})")
+    return _florence_model, _florence_processor
+
+
+def task_constraint(task: str):
+    """
+    Ограничение словаря для задачи Florence-2 (Florence2Processor.task_constraint), создаётся один раз на задачу.
+
+    Returns:
+        Florence2VocabularyConstraint | None: None, если ограничение выключено (FLORENCE_TASK_CONSTRAINT=0)
+    """
+    if not florence_task_constraint:
+        return None
+    if task not in _task_constraints:
+        _, processor = load_florence()
+        _task_constraints[task] = processor.task_constraint(task)
+    return _task_constraints[task]
+
+
+def _run_task(image, task: str, max_new_tokens: int):
+    # Генерация Florence-2 и разбор ответа штатным Florence2PostProcesser
+    model, processor = load_florence()
+    image = image.convert("RGB")
+    inputs = processor(text=task, images=image, return_tensors="pt")
+    inputs = {
+        k: v.to(model.device, dtype=model.dtype if k == "pixel_values" else None)
+        for k, v in inputs.items()
+    }
+
+    with _florence_lock, torch.inference_mode():
+        generated_ids = model.generate(
+            input_ids=inputs["input_ids"],
+            pixel_values=inputs["pixel_values"],
+            attention_mask=inputs.get("attention_mask"),
+            vocabulary_constraint=task_constraint(task),
+            max_new_tokens=max_new_tokens,
+            early_stopping=False,
+            do_sample=False,
+            num_beams=3,
+        )
+
+    generated_text = processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
+    return processor.post_process_generation(
+        generated_text,
+        task=task,
+        image_size=(image.width, image.height),
+    )[task]
+
+
+def run_ocr(image, task: str | None = None, max_new_tokens: int = 1024) -> str:
+    """
+    Извлекает текст страницы через Florence-2.
+
+    Args:
+        image: PIL.Image страницы
+        task: '<OCR>' или '<OCR_WITH_REGION>' (по умолчанию FLORENCE_OCR_TASK)
+        max_new_tokens: максимальное количество новых токенов
+    Returns:
+        str: распознанный текст, для '<OCR_WITH_REGION>' - строки через перевод строки
+    """
+    task = task or florence_ocr_task
+    if task == "<OCR_WITH_REGION>" or (florence_ocr_tiled and max(image.size) > TILE_MIN_SIDE):
+        # Плиточный OCR склеивает строки по координатам, поэтому всегда идёт через регионы
+        return "\n".join(region["text"] for region in run_ocr_regions(image, max_new_tokens))
+    return _run_task(image, task, max_new_tokens).strip()
+
+
+def _parse_regions(parsed: dict, offset: tuple[int, int] = (0, 0)) -> list[dict]:
+    # quad_boxes -> прямоугольники строк, со сдвигом плитки относительно страницы
+    regions = []
+    for quad, label in zip(parsed["quad_boxes"], parsed["labels"]):
+        text = label.replace("</s>", "").strip()
+        if text:
+            xs, ys = quad[0::2], quad[1::2]
+            regions.append({
+                "text": text,
+                "box": [int(min(xs)) + offset[0], int(min(ys)) + offset[1],
+                        int(max(xs)) + offset[0], int(max(ys)) + offset[1]],
+            })
+    return regions
+
+
+def run_ocr_regions(image, max_new_tokens: int = 1024) -> list[dict]:
+    """
+    Распознаёт строки страницы вместе с их положением (<OCR_WITH_REGION>).
+    Крупные страницы при FLORENCE_OCR_TILED распознаются по плиткам (см. run_ocr_tiled).
+
+    Args:
+        image: PIL.Image страницы
+        max_new_tokens: максимальное количество новых токенов
+    Returns:
+        list: строки {'text', 'box': [x0, y0, x1, y1]} в пикселях исходного изображения
+    """
+    if florence_ocr_tiled and max(image.size) > TILE_MIN_SIDE:
+        return run_ocr_tiled(image, max_new_tokens=max_new_tokens)
+    return _parse_regions(_run_task(image, "<OCR_WITH_REGION>", max_new_tokens))
+
+
+def _tile_starts(length: int) -> list[int]:
+    if length <= TILE_SIZE:
+        return [0]
+    step = TILE_SIZE - TILE_OVERLAP
+    starts = list(range(0, length - TILE_SIZE, step))
+    # Последняя плитка прижимается к краю страницы
+    return starts + [length - TILE_SIZE]
+
+
+def tile_boxes(width: int, height: int) -> list[tuple[int, int, int, int]]:
+    """
+    Разбивает страницу на плитки TILE_SIZE с перекрытием TILE_OVERLAP.
+
+    Args:
+        width: ширина страницы
+        height: высота страницы
+    Returns:
+        list: прямоугольники (x0, y0, x1, y1) по строкам сверху вниз
+    """
+    return [
+        (x, y, min(x + TILE_SIZE, width), min(y + TILE_SIZE, height))
+        for y in _tile_starts(height) for x in _tile_starts(width)
+    ]
+
+
+def _merge_text(left: str, right: str) -> str:
+    # Строка, разрезанная границей плиток: убираем повтор на стыке (суффикс left == префикс right)
+    for size in range(min(len(left), len(right)), 1, -1):
+        if left.endswith(right[:size]):
+            return left + right[size:]
+    return f"{left} {right}"
+
+
+def stitch_regions(regions: list[dict]) -> list[dict]:
+    """
+    Склеивает строки соседних плиток: дубликаты из зоны перекрытия убираются,
+    части строки, разрезанной границей плитки, объединяются.
+
+    Args:
+        regions: строки {'text', 'box', 'tile'} всех плиток в координатах страницы
+    Returns:
+        list: строки {'text', 'box'} в порядке чтения
+    """
+    lines = []
+    for region in sorted(regions, key=lambda r: (r["box"][1], r["box"][0])):
+        x0, y0, x1, y1 = region["box"]
+        for line in lines:
+            lx0, ly0, lx1, ly1 = line["box"]
+            if line["tile"] == region["tile"]:
+                continue
+            # Одна и та же строка: перекрытие по высоте больше половины и по ширине
+            vertical = min(y1, ly1) - max(y0, ly0)
+            if vertical < 0.5 * min(y1 - y0, ly1 - ly0) or min(x1, lx1) <= max(x0, lx0):
+                continue
+            if lx0 <= x0 and x1 <= lx1:
+                pass  # строка целиком внутри уже найденной
+            elif x0 <= lx0 and lx1 <= x1:
+                line["text"] = region["text"]
+            elif x0 > lx0:
+                line["text"] = _merge_text(line["text"], region["text"])
+            else:
+                line["text"] = _merge_text(region["text"], line["text"])
+            line["box"] = [min(x0, lx0), min(y0, ly0), max(x1, lx1), max(y1, ly1)]
+            line["tile"] = region["tile"]
+            break
+        else:
+            lines.append(dict(region))
+
+    # Порядок чтения: строки группируются по вертикали, внутри строки - слева направо
+    lines.sort(key=lambda line: (line["box"][1], line["box"][0]))
+    ordered, row = [], []
+    for line in lines:
+        if row and line["box"][1] >= min(r["box"][3] for r in row) - 0.5 * (line["box"][3] - line["box"][1]):
+            ordered.extend(sorted(row, key=lambda r: r["box"][0]))
+            row = []
+        row.append(line)
+    ordered.extend(sorted(row, key=lambda r: r["box"][0]))
+    return [{"text": line["text"], "box": line["box"]} for line in ordered]
+
+
+def run_ocr_tiled(image, batch_size: int | None = None, max_new_tokens: int = 1024) -> list[dict]:
+    """
+    OCR страницы высокого разрешения по перекрывающимся плиткам 768x768.
+
+    Все плитки кодируются одним батчевым вызовом _encode_image, генерация идёт
+    батчами по batch_size плиток, строки склеиваются по координатам (stitch_regions).
+
+    Args:
+        image: PIL.Image страницы
+        batch_size: плиток в одном вызове generate (по умолчанию FLORENCE_TILE_BATCH)
+        max_new_tokens: максимальное количество новых токенов на плитку
+    Returns:
+        list: строки {'text', 'box'} в пикселях исходного изображения
+    """
+    batch_size = batch_size or florence_tile_batch
+    model, processor = load_florence()
+    image = image.convert("RGB")
+    boxes = tile_boxes(*image.size)
+    tiles = [image.crop(box) for box in boxes]
+    task = "<OCR_WITH_REGION>"
+    inputs = processor(text=[task] * len(tiles), images=tiles, return_tensors="pt")
+
+    regions = []
+    with _florence_lock, torch.inference_mode():
+        pixel_values = inputs["pixel_values"].to(model.device, dtype=model.dtype)
+        image_features = model._encode_image(pixel_values)
+        text_embeds = model.get_input_embeddings()(inputs["input_ids"].to(model.device))
+        text_mask = inputs["attention_mask"].to(model.device)
+        for start in range(0, len(tiles), batch_size):
+            inputs_embeds, attention_mask = model._merge_input_ids_with_image_features(
+                image_features[start:start + batch_size], text_embeds[start:start + batch_size],
+                text_mask[start:start + batch_size],
+            )
+            generated_ids = model.generate(
+                input_ids=None,
+                inputs_embeds=inputs_embeds,
+                attention_mask=attention_mask,
+                vocabulary_constraint=task_constraint(task),
+                max_new_tokens=max_new_tokens,
+                early_stopping=False,
+                do_sample=False,
+                num_beams=3,
+            )
+            texts = processor.batch_decode(generated_ids, skip_special_tokens=False)
+            for index, text in enumerate(texts, start):
+                tile = tiles[index]
+                parsed = processor.post_process_generation(text, task=task, image_size=tile.size)[task]
+                for region in _parse_regions(parsed, offset=boxes[index][:2]):
+                    region["tile"] = index
+                    regions.append(region)
+    return stitch_regions(regions)
+
+
+def benchmark_tiled_ocr(image, batch_sizes: tuple[int, ...] = (1, 2, 4, 8)) -> dict:
+    """
+    Пропускная способность плиточного OCR в зависимости от размера батча.
+
+    Args:
+        image: PIL.Image крупной страницы (например, A4 при 200 DPI)
+        batch_sizes: проверяемые размеры батча
+    Returns:
+        dict: batch_size -> плиток в секунду
+    """
+    num_tiles = len(tile_boxes(*image.size))
+    result = {}
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        run_ocr_tiled(image, batch_size=batch_size)
+        result[batch_size] = num_tiles / (time.perf_counter() - start)
+        print(f"batch {batch_size}: {num_tiles} плиток, {result[batch_size]:.2f} плиток/с")
+    return result
+
+
+def ocr_pool() -> InferencePool | None:
+    """
+    Пул процессов с репликами Florence-2 (FLORENCE_WORKERS > 0), создаётся при первом обращении.
+
+    Returns:
+        InferencePool | None: None, если OCR выполняется в процессе бота
+    """
+    global _ocr_pool
+    if florence_workers > 0 and _ocr_pool is None:
+        _ocr_pool = InferencePool("florence_ocr", florence_workers)
+    return _ocr_pool
+
+
+def run_on_page(method: str, descriptor: PageDescriptor):
+    """Выполняется в воркере пула: run_ocr или run_ocr_regions для страницы из общей памяти."""
+    return {"run_ocr": run_ocr, "run_ocr_regions": run_ocr_regions}[method](as_image(descriptor))
+
+
+def _map_pages(function: Callable, images: list) -> list:
+    # Страницы расходятся по репликам параллельно; стоимость страницы - число пикселей.
+    # Воркерам уходят не изображения, а дескрипторы страниц в общей памяти
+    pool = ocr_pool()
+    if pool is None:
+        return [function(image) for image in images]
+    transport = page_transport()
+    descriptors = [transport.put_image(image) for image in images]
+    futures = []
+    try:
+        for image, descriptor in zip(images, descriptors):
+            futures.append(pool.submit("run_on_page", function.__name__, descriptor, cost=image.width * image.height))
+        return [future.result() for future in futures]
+    finally:
+        # Ошибка одной страницы не отпускает память раньше времени: остальные воркеры
+        # ещё читают свои страницы, а отпущенный сегмент заполняется следующим документом
+        wait(futures)
+        for descriptor in descriptors:
+            transport.release(descriptor)
+
+
+def extract_pages_text(images: list) -> tuple[list[str], float]:
+    """
+    Прогоняет OCR по всем страницам документа.
+
+    Args:
+        images: список PIL.Image страниц
+    Returns:
+        tuple: (текст каждой страницы, затраченное время в секундах)
+    """
+    start = time.perf_counter()
+    texts = _map_pages(run_ocr, images)
+    elapsed = time.perf_counter() - start
+    logger.debug(f"✅ OCR {len(images)} стр. за {elapsed:.2f} с")
+    return texts, elapsed
+
+
+def extract_pages_regions(images: list) -> tuple[list[list[dict]], float]:
+    """
+    Прогоняет OCR с координатами строк по всем страницам документа.
+
+    Args:
+        images: список PIL.Image страниц
+    Returns:
+        tuple: (строки {'text', 'box'} каждой страницы, затраченное время в секундах)
+    """
+    start = time.perf_counter()
+    regions = _map_pages(run_ocr_regions, images)
+    elapsed = time.perf_counter() - start
+    logger.debug(f"✅ OCR с координатами {len(images)} стр. за {elapsed:.2f} с")
+    return regions, elapsed
+
+
+def check_batched_generation(images: list, tasks: list[str], max_new_tokens: int = 256) -> list[bool]:
+    """
+    Проверяет, что батч промптов разной длины (с паддингом) даёт те же ответы,
+    что и поштучная генерация.
+
+    Args:
+        images: PIL.Image для каждого элемента батча
+        tasks: задачи Florence-2 разной длины, например '<OCR>', '<CAPTION>', '<OCR_WITH_REGION>'
+        max_new_tokens: максимальное количество новых токенов
+    Returns:
+        list: совпадение батчевого и поштучного ответа для каждого элемента
+    """
+    model, processor = load_florence()
+    images = [image.convert("RGB") for image in images]
+    generate_kwargs = dict(max_new_tokens=max_new_tokens, early_stopping=False, do_sample=False, num_beams=3)
+
+    def _generate(batch_images, batch_tasks):
+        inputs = processor(text=batch_tasks, images=batch_images, return_tensors="pt", padding="longest")
+        with _florence_lock, torch.inference_mode():
+            generated_ids = model.generate(
+                input_ids=inputs["input_ids"].to(model.device),
+                pixel_values=inputs["pixel_values"].to(model.device, dtype=model.dtype),
+                attention_mask=inputs["attention_mask"].to(model.device),
+                **generate_kwargs,
+            )
+        return processor.batch_decode(generated_ids, skip_special_tokens=True)
+
+    batched = _generate(images, tasks)
+    single = [_generate([image], [task])[0] for image, task in zip(images, tasks)]
+    matches = [a.strip() == b.strip() for a, b in zip(batched, single)]
+    logger.debug(f"Батчевая генерация совпала с поштучной: {sum(matches)} из {len(matches)}")
+    return matches
+
+
+def character_error_rate(references: list[str], predictions: list[str]) -> float:
+    """CER: суммарное расстояние Левенштейна по символам, делённое на длину эталонов."""
+    errors, total = 0, 0
+    for reference, prediction in zip(references, predictions):
+        previous = list(range(len(prediction) + 1))
+        for i, ref_char in enumerate(reference, 1):
+            current = [i]
+            for j, pred_char in enumerate(prediction, 1):
+                current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref_char != pred_char)))
+            previous = current
+        errors += previous[-1]
+        total += len(reference)
+    return errors / max(total, 1)
+
+
+def sweep_token_pruning(samples: list[tuple], keep_ratios: tuple[float, ...] = (1.0, 0.75, 0.5, 0.35, 0.25),
+                        criterion: str = "pixel_std") -> list[dict]:
+    """
+    Точность и скорость OCR в зависимости от доли оставленных визуальных токенов.
+
+    Args:
+        samples: пары (PIL.Image, эталонный текст) из оценочного набора
+        keep_ratios: проверяемые значения image_token_keep_ratio
+        criterion: "pixel_std" или "feature_norm"
+    Returns:
+        list: {'keep_ratio', 'cer', 'seconds_per_page'} для каждого значения
+    """
+    model, _ = load_florence()
+    _florence_lock.acquire()
+    previous = model.image_token_keep_ratio, model.image_token_prune_criterion
+    model.image_token_prune_criterion = criterion
+    references = [" ".join(reference.split()) for _, reference in samples]
+    results = []
+    try:
+        for keep_ratio in keep_ratios:
+            model.image_token_keep_ratio = keep_ratio
+            start = time.perf_counter()
+            predictions = [" ".join(run_ocr(image, task="<OCR>").split()) for image, _ in samples]
+            elapsed = (time.perf_counter() - start) / max(len(samples), 1)
+            results.append({
+                "keep_ratio": keep_ratio,
+                "cer": character_error_rate(references, predictions),
+                "seconds_per_page": elapsed,
+            })
+            print(f"keep_ratio {keep_ratio:.2f}: CER {results[-1]['cer']:.4f}, {elapsed:.2f} с/стр.")
+    finally:
+        model.image_token_keep_ratio, model.image_token_prune_criterion = previous
+        _florence_lock.release()
+    return results
+
+
+def check_beam_shared_kv(images: list, num_beams: int = 3, max_new_tokens: int = 1024) -> dict:
+    """
+    Сравнивает beam search с общими для лучей K/V кросс-внимания и с копией на каждый луч:
+    совпадение ответов, время и пиковую память GPU.
+
+    Args:
+        images: PIL.Image страниц
+        num_beams: число лучей
+        max_new_tokens: максимальное количество новых токенов
+    Returns:
+        dict: {True/False: {'texts', 'seconds', 'peak_memory'}, 'matches': совпадение по страницам}
+    """
+    model, processor = load_florence()
+    _florence_lock.acquire()
+    previous = model.beam_shared_cross_attention
+    result = {}
+    try:
+        for shared in (False, True):
+            model.beam_shared_cross_attention = shared
+            if torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+            texts = []
+            start = time.perf_counter()
+            for image in images:
+                inputs = processor(text=florence_ocr_task, images=image.convert("RGB"), return_tensors="pt")
+                with torch.inference_mode():
+                    generated_ids = model.generate(
+                        input_ids=inputs["input_ids"].to(model.device),
+                        pixel_values=inputs["pixel_values"].to(model.device, dtype=model.dtype),
+                        attention_mask=inputs["attention_mask"].to(model.device),
+                        max_new_tokens=max_new_tokens,
+                        early_stopping=False,
+                        do_sample=False,
+                        num_beams=num_beams,
+                    )
+                texts.append(processor.batch_decode(generated_ids, skip_special_tokens=True)[0])
+            result[shared] = {
+                "texts": texts,
+                "seconds": time.perf_counter() - start,
+                "peak_memory": torch.cuda.max_memory_allocated() if torch.cuda.is_available() else None,
+            }
+            memory = result[shared]["peak_memory"]
+            print(
+                f"{'общие' if shared else 'по лучам'} K/V: {result[shared]['seconds']:.2f} с"
+                + (f", пик памяти {memory / 2 ** 20:.0f} МБ" if memory is not None else "")
+            )
+    finally:
+        model.beam_shared_cross_attention = previous
+        _florence_lock.release()
+    result["matches"] = [a == b for a, b in zip(result[False]["texts"], result[True]["texts"])]
+    logger.debug(f"Общие K/V совпали с поштучными: {sum(result['matches'])} из {len(images)}")
+    return result
+
+
+def benchmark_no_repeat_ngram(images: list, num_beams: int = 3, max_new_tokens: int = 1024,
+                              simulated_steps: int = 1024) -> dict:
+    """
+    Сравнивает инкрементальный запрет повторов n-грамм со штатным NoRepeatNGramLogitsProcessor:
+    шаги декодирования в секунду на OCR страниц и сами процессоры на модельном beam search
+    (случайные логиты и перестановки лучей, проверяется совпадение запретов).
+
+    Args:
+        images: PIL.Image страниц
+        num_beams: число лучей
+        max_new_tokens: максимальное количество новых токенов
+        simulated_steps: длина модельного beam search
+    Returns:
+        dict: {'generate': {True/False: шагов в секунду}, 'processor': {...}, 'matches': совпадение запретов}
+    """
+    model, processor = load_florence()
+    ngram_size = model.language_model.generation_config.no_repeat_ngram_size or 3
+    result = {"generate": {}, "processor": {}}
+
+    _florence_lock.acquire()
+    previous = model.incremental_no_repeat_ngram
+    try:
+        for incremental in (False, True):
+            model.incremental_no_repeat_ngram = incremental
+            steps, start = 0, time.perf_counter()
+            for image in images:
+                inputs = processor(text=florence_ocr_task, images=image.convert("RGB"), return_tensors="pt")
+                with torch.inference_mode():
+                    generated_ids = model.generate(
+                        input_ids=inputs["input_ids"].to(model.device),
+                        pixel_values=inputs["pixel_values"].to(model.device, dtype=model.dtype),
+                        attention_mask=inputs["attention_mask"].to(model.device),
+                        max_new_tokens=max_new_tokens,
+                        early_stopping=False,
+                        do_sample=False,
+                        num_beams=num_beams,
+                        no_repeat_ngram_size=ngram_size,
+                    )
+                steps += generated_ids.shape[1]
+            result["generate"][incremental] = steps / (time.perf_counter() - start)
+    finally:
+        model.incremental_no_repeat_ngram = previous
+        _florence_lock.release()
+
+    # Процессоры отдельно от модели: одинаковые входы, лучи переставляются как в beam search
+    incremental_class = sys.modules[type(model).__module__].Florence2NoRepeatNGramLogitsProcessor
+    vocab_size = model.language_model.config.vocab_size
+    generator = torch.Generator().manual_seed(0)
+    scores = torch.randn(num_beams, vocab_size, generator=generator).to(model.device)
+    # Небольшой алфавит, чтобы n-граммы повторялись и запреты срабатывали
+    tokens = torch.randint(0, 64, (simulated_steps, num_beams), generator=generator).to(model.device)
+    parents = torch.randint(0, num_beams, (simulated_steps, num_beams), generator=generator).to(model.device)
+    outputs = {}
+    for incremental in (False, True):
+        logits_processor = incremental_class(ngram_size) if incremental else NoRepeatNGramLogitsProcessor(ngram_size)
+        input_ids = torch.zeros(num_beams, 1, dtype=torch.long, device=model.device)
+        banned = []
+        start = time.perf_counter()
+        for step in range(simulated_steps):
+            banned.append(torch.isinf(logits_processor(input_ids, scores.clone())).sum().item())
+            beam_idx = parents[step]
+            input_ids = torch.cat([input_ids[beam_idx], tokens[step][:, None]], dim=1)
+            if incremental:
+                logits_processor.reorder(beam_idx)
+        result["processor"][incremental] = simulated_steps / (time.perf_counter() - start)
+        outputs[incremental] = banned
+    result["matches"] = outputs[False] == outputs[True]
+
+    for incremental, name in ((False, "штатный"), (True, "инкрементальный")):
+        print(
+            f"{name}: {result['generate'][incremental]:.1f} шагов/с генерации, "
+            f"{result['processor'][incremental]:.0f} шагов/с процессора"
+        )
+    logger.debug(f"Запреты n-грамм совпадают со штатным процессором: {result['matches']}")
+    return result
+
+
+def benchmark_task_constraint(images: list, tasks: tuple[str, ...] = ("<OCR_WITH_REGION>", "<OD>", "<REGION_PROPOSAL>"),
+                              max_new_tokens: int = 1024) -> list[dict]:
+    """
+    Сравнивает генерацию с ограничением словаря задачи и без него: время и число
+    распознанных постпроцессором объектов (строк, рамок).
+
+    Args:
+        images: PIL.Image страниц
+        tasks: задачи Florence-2
+        max_new_tokens: максимальное количество новых токенов
+    Returns:
+        list: {'task', 'constrained', 'seconds', 'instances'} для каждой задачи и режима
+    """
+    global florence_task_constraint
+    _florence_lock.acquire()
+    previous = florence_task_constraint
+    results = []
+    try:
+        for task in tasks:
+            for constrained in (False, True):
+                florence_task_constraint = constrained
+                start = time.perf_counter()
+                parsed = [_run_task(image, task, max_new_tokens) for image in images]
+                results.append({
+                    "task": task,
+                    "constrained": constrained,
+                    "seconds": time.perf_counter() - start,
+                    "instances": sum(len(answer.get("labels", [])) for answer in parsed),
+                })
+                print(
+                    f"{task} {'с ограничением' if constrained else 'без ограничения'}: "
+                    f"{results[-1]['seconds']:.2f} с, объектов {results[-1]['instances']}"
+                )
+    finally:
+        florence_task_constraint = previous
+        _florence_lock.release()
+    return results
@@ -0,0 +1,138 @@
+import io
+import logging
+import multiprocessing
+import os
+import resource
+import time
+
+from PIL import Image, ImageOps
+
+from image_tokens import IMAGE_FACTOR, MAX_PIXELS, smart_resize
+
+logger = logging.getLogger(__name__)
+
+# Ограничение площади фотографий Telegram (message.photo): снимок с камеры 12+ Мп не нужен модели целиком.
+# Изображения, присланные документом (сканы), остаются в пределе модели
+PHOTO_MAX_PIXELS = int(os.getenv("PHOTO_MAX_PIXELS", str(2560 * IMAGE_FACTOR * IMAGE_FACTOR)))
+
+# Сигнатуры форматов (magic bytes)
+MAGIC_BYTES = (
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+    (b"%PDF", "pdf"),
+)
+
+
+def sniff_format(data: bytes) -> str | None:
+    """
+    Определяет формат файла по первым байтам, не доверяя расширению.
+
+    Args:
+        data: содержимое файла
+    Returns:
+        str | None: "jpeg", "png", "gif", "bmp", "tiff", "webp", "pdf" или None
+    """
+    for magic, name in MAGIC_BYTES:
+        if data.startswith(magic):
+            return name
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def decode_to_target(data: bytes, target_size: tuple[int, int] | None = None) -> Image.Image:
+    """
+    Декодирует изображение сразу в разрешение, близкое к целевому.
+
+    Для JPEG используется Image.draft: libjpeg масштабирует при декодировании
+    (1/2, 1/4, 1/8), и полноразмерный буфер не создаётся. draft не опускается
+    ниже target_size, поэтому остаток масштаба добирается ресайзом.
+
+    Args:
+        data: закодированное изображение
+        target_size: (ширина, высота) результата (None - исходный размер)
+    Returns:
+        PIL.Image: изображение в RGB размера target_size
+    """
+    image = Image.open(io.BytesIO(data))
+    if target_size is not None and image.format == "JPEG":
+        image.draft("RGB", target_size)
+    image.load()
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if target_size is not None and image.size != tuple(target_size):
+        image = image.resize(target_size, Image.BICUBIC, reducing_gap=2.0)
+    return image
+
+
+def load_photo(data: bytes, max_pixels: int = MAX_PIXELS) -> Image.Image:
+    """
+    Загружает присланную фотографию: уменьшенное декодирование JPEG до целевого
+    размера, поворот по EXIF и однократное приведение к RGB.
+
+    Args:
+        data: содержимое файла (bytes передаются в BytesIO без копирования)
+        max_pixels: верхняя граница площади итогового изображения
+    Returns:
+        PIL.Image: изображение в RGB, стороны кратны IMAGE_FACTOR
+    """
+    image = Image.open(io.BytesIO(data))
+    if image.format == "JPEG":
+        # draft не зависит от ориентации: масштаб одинаков по обеим осям
+        image.draft("RGB", smart_resize(*image.size, max_pixels=max_pixels))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    target = smart_resize(*image.size, max_pixels=max_pixels)
+    if target != image.size:
+        image = image.resize(target, Image.BICUBIC, reducing_gap=2.0)
+    return image
+
+
+def _legacy_decode(data: bytes) -> Image.Image:
+    # Прежний путь: копия bytes, полноразмерное декодирование, ресайз в препроцессоре
+    image = Image.open(io.BytesIO(bytes(data))).convert("RGB")
+    return image.resize(smart_resize(*image.size, max_pixels=PHOTO_MAX_PIXELS), Image.BICUBIC)
+
+
+def _measure(variant: str, path: str) -> tuple[float, int]:
+    with open(path, "rb") as f:
+        data = f.read()
+    start = time.perf_counter()
+    if variant == "legacy":
+        _legacy_decode(data)
+    else:
+        load_photo(data, PHOTO_MAX_PIXELS)
+    elapsed = time.perf_counter() - start
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def benchmark_photo_decode(path: str) -> dict:
+    """
+    Сравнивает время декодирования и пиковый RSS для прежнего пути и load_photo.
+    Каждый вариант запускается в отдельном процессе, чтобы пиковая память не смешивалась.
+
+    Args:
+        path: путь к фотографии
+    Returns:
+        dict: {'legacy': (секунды, пиковый RSS в КБ), 'load_photo': (...)}
+    """
+    context = multiprocessing.get_context("spawn")
+    result = {}
+    for variant in ("legacy", "load_photo"):
+        with context.Pool(1) as pool:
+            result[variant] = pool.apply(_measure, (variant, path))
+        print(f"{variant}: {result[variant][0] * 1000:.1f} мс, пиковый RSS {result[variant][1] / 1024:.1f} МБ")
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+
+    benchmark_photo_decode(sys.argv[1])
@@ -0,0 +1,48 @@
+import math
+
+
+# Параметры препроцессора Qwen2.5-VL (preprocessor_config.json)
+IMAGE_FACTOR = 28  # patch_size * merge_size
+MIN_PIXELS = 3136
+MAX_PIXELS = 12845056
+
+
+def smart_resize(width: int, height: int, max_pixels: int = MAX_PIXELS) -> tuple[int, int]:
+    """
+    Размер, к которому препроцессор Qwen2.5-VL приводит изображение:
+    стороны кратны IMAGE_FACTOR, площадь в пределах [MIN_PIXELS, max_pixels].
+
+    Args:
+        width (int): Ширина изображения.
+        height (int): Высота изображения.
+        max_pixels (int): Верхняя граница площади.
+
+    Returns:
+        tuple: (ширина, высота) после приведения.
+    """
+    h_bar = max(IMAGE_FACTOR, round(height / IMAGE_FACTOR) * IMAGE_FACTOR)
+    w_bar = max(IMAGE_FACTOR, round(width / IMAGE_FACTOR) * IMAGE_FACTOR)
+    if h_bar * w_bar > max_pixels:
+        beta = math.sqrt((height * width) / max_pixels)
+        h_bar = math.floor(height / beta / IMAGE_FACTOR) * IMAGE_FACTOR
+        w_bar = math.floor(width / beta / IMAGE_FACTOR) * IMAGE_FACTOR
+    elif h_bar * w_bar < MIN_PIXELS:
+        beta = math.sqrt(MIN_PIXELS / (height * width))
+        h_bar = math.ceil(height * beta / IMAGE_FACTOR) * IMAGE_FACTOR
+        w_bar = math.ceil(width * beta / IMAGE_FACTOR) * IMAGE_FACTOR
+    return w_bar, h_bar
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """
+    Оценивает количество визуальных токенов Qwen2.5-VL для изображения.
+
+    Args:
+        width (int): Ширина изображения.
+        height (int): Высота изображения.
+
+    Returns:
+        int: Количество визуальных токенов.
+    """
+    w_bar, h_bar = smart_resize(width, height)
+    return (h_bar // IMAGE_FACTOR) * (w_bar // IMAGE_FACTOR)
@@ -1,19 +1,225 @@
 from unsloth import FastVisionModel
 from transformers import TextStreamer
 import torch
+import contextlib
 import os
+import time
+from collections import OrderedDict
+from PIL import Image
+from adapter_manager import AdapterManager
+from image_tokens import smart_resize
+from lora_merge import preferred_model_path
+from shard_loader import PREFETCH_WEIGHTS, prefetch_checkpoint
 
 
-model_path = os.getenv("MODEL_PATH", "/home/jupyter/datasphere/project/qwen2.5-vl-32b-qlora-a100-copy")
-
-model, tokenizer = FastVisionModel.from_pretrained(
-    model_name=model_path,
-    load_in_4bit=True,
+# Если для адаптера собран объединённый чекпоинт (lora_merge.py), грузится он - без LoRA-добавок на каждом токене
+model_path = preferred_model_path(
+    os.getenv("MODEL_PATH", "/home/jupyter/datasphere/project/qwen2.5-vl-32b-qlora-a100-copy")
 )
-FastVisionModel.for_inference(model)
-print("Модель успешно загружена и готова к инференсу!")
+# Несколько LoRA-адаптеров поверх одной базы: "имя=каталог,..." (MODEL_PATH тогда указывает на базовую модель)
+LORA_ADAPTERS = os.getenv("LORA_ADAPTERS", "")
+
+# Заполняются load_model()
+model = None
+tokenizer = None
+adapter_manager = None
+# Адаптер по умолчанию - первый в списке
+DEFAULT_ADAPTER = None
+text_streamer = None
+
+
+def load_model():
+    """
+    Загружает Qwen2.5-VL и LoRA-адаптеры (один раз на процесс).
+
+    Вызывается из main() бота и HTTP-сервера, а не при импорте: воркеры пула
+    процессов (spawn) заново импортируют главный модуль и иначе загрузили бы
+    по реплике модели каждый.
+    """
+    global model, tokenizer, adapter_manager, DEFAULT_ADAPTER, text_streamer
+    if model is not None:
+        return
+    if PREFETCH_WEIGHTS:
+        # Шарды читаются параллельно, from_pretrained затем берёт их из страничного кэша
+        prefetch_checkpoint(model_path)
+
+    loaded, tokenizer = FastVisionModel.from_pretrained(
+        model_name=model_path,
+        load_in_4bit=True,
+    )
+    FastVisionModel.for_inference(loaded)
+    print("Модель успешно загружена и готова к инференсу!")
+
+    if LORA_ADAPTERS:
+        adapter_manager = AdapterManager(loaded)
+        for spec in LORA_ADAPTERS.split(","):
+            name, _, path = spec.strip().partition("=")
+            adapter_manager.load_adapter(name, path)
+        DEFAULT_ADAPTER = adapter_manager.adapters[0]
+
+    text_streamer = TextStreamer(tokenizer, skip_prompt=True)
+    model = loaded
+
+
+class CallbackStreamer(TextStreamer):
+    """Передаёт готовые фрагменты ответа в on_text по мере генерации (например, в SSE HTTP-сервера)."""
+
+    def __init__(self, on_text):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.on_text = on_text
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if text:
+            self.on_text(text)
+
+
+def preprocess_images(images: list) -> dict:
+    """
+    Выполняет всю подготовку изображений для Qwen2.5-VL заранее (при загрузке файла):
+    приведение к RGB, ресайз к целевому разрешению и нормализацию в тензоры.
+
+    Args:
+        images (list): Список PIL.Image страниц.
+
+    Returns:
+        dict: pixel_values и image_grid_thw, готовые для generate_answer_from_features.
+    """
+    resized = []
+    for image in images:
+        image = image.convert("RGB")
+        size = smart_resize(*image.size)
+        if size != image.size:
+            image = image.resize(size, Image.BICUBIC)
+        resized.append(image)
+
+    features = tokenizer.image_processor(images=resized, return_tensors="pt")
+    return {
+        "pixel_values": features["pixel_values"],
+        "image_grid_thw": features["image_grid_thw"],
+    }
+
+
+def select_images(features: dict, indices: list[int]) -> dict:
+    """
+    Оставляет в подготовленных признаках только изображения с указанными номерами.
+
+    Args:
+        features (dict): Результат preprocess_images.
+        indices (list): Номера изображений в исходном порядке.
+
+    Returns:
+        dict: pixel_values и image_grid_thw выбранных изображений.
+    """
+    # pixel_values - патчи всех изображений подряд, по t*h*w строк на изображение
+    offsets = [0] + features["image_grid_thw"].prod(dim=-1).cumsum(0).tolist()
+    return {
+        "pixel_values": torch.cat([features["pixel_values"][offsets[i]:offsets[i + 1]] for i in indices]),
+        "image_grid_thw": features["image_grid_thw"][indices],
+    }
+
+
+def count_image_tokens(features: dict) -> int:
+    """Число визуальных токенов в промпте для подготовленных признаков (после слияния патчей)."""
+    merge = tokenizer.image_processor.merge_size ** 2
+    return int(features["image_grid_thw"].prod(dim=-1).sum()) // merge
+
+
+def count_text_tokens(text: str) -> int:
+    """Число токенов текста в промпте."""
+    return len(tokenizer.tokenizer(text)["input_ids"]) if text else 0
+
+
+class PrefixKVCache:
+    """
+    LRU-кэш KV префикса промпта (системное сообщение + изображения документа).
+
+    Повторные вопросы по тому же документу прогоняют через модель только
+    токены нового вопроса. Суммарный размер тензоров ограничен max_bytes.
+
+    Args:
+        max_bytes (int): Максимальный суммарный размер KV-кэшей в байтах.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(entry["bytes"] for entry in self._entries.values())
+
+    def get(self, key: str) -> dict | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, entry: dict):
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            self._entries.popitem(last=False)
+
+    def drop(self, key: str):
+        self._entries.pop(key, None)
+
+
+prefix_cache = PrefixKVCache(int(os.getenv("PREFIX_CACHE_MAX_MB", "4096")) * 1024 * 1024)
+
+
+def use_adapter(name: str | None):
+    """
+    Контекст генерации с выбранным LoRA-адаптером (None - базовая модель).
+    Без LORA_ADAPTERS модель загружена целиком и контекст ничего не меняет.
+    """
+    if adapter_manager is None:
+        return contextlib.nullcontext()
+    return adapter_manager.use(name)
+
+
+def _cache_bytes(past_key_values) -> int:
+    if hasattr(past_key_values, "layers"):
+        tensors = [t for layer in past_key_values.layers for t in (layer.keys, layer.values)]
+    else:
+        tensors = list(past_key_values.key_cache) + list(past_key_values.value_cache)
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+
+def _rope_holder():
+    # Модуль Qwen2.5-VL, хранящий смещения mrope между шагами генерации
+    for module in model.modules():
+        if hasattr(module, "rope_deltas"):
+            return module
+    raise AttributeError("В модели не найден атрибут rope_deltas")
+
+
+def _generate(inputs, max_new_tokens: int, stats: dict | None, **kwargs) -> str:
+    start = time.perf_counter()
+    with torch.inference_mode():
+        output = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            use_cache=True,
+            temperature=0.7,
+            min_p=0.1,
+            pad_token_id=tokenizer.eos_token_id,
+            **kwargs
+        )
+
+    prompt_len = inputs['input_ids'].shape[1]
+    decoded_answer = tokenizer.decode(output[0][prompt_len:], skip_special_tokens=True)
+
+    if stats is not None:
+        stats["prompt_tokens"] = prompt_len
+        stats["completion_tokens"] = output.shape[1] - prompt_len
+        stats["generation_time"] = time.perf_counter() - start
 
-text_streamer = TextStreamer(tokenizer, skip_prompt=True)
+    return decoded_answer.strip()
 
 
 def generate_answer_one_img(image, question, max_new_tokens=256):
@@ -51,15 +257,19 @@ def generate_answer_one_img(image, question, max_new_tokens=256):
     return decoded
 
 
-def generate_answer(images: list, question: str, max_new_tokens: int = 256):
+def generate_answer(images: list, question: str, max_new_tokens: int = 256, stats: dict | None = None,
+                    streamer: TextStreamer | None = None):
     """
     Генерирует ответ на основе списка изображений и текстового вопроса.
 
     Args:
         images (list): Список изображений. Элементы могут быть PIL.Image,
-                       bytes или путями к файлам.
+                       bytes или путями к файлам. Может быть пустым, если весь
+                       документ передан текстом в вопросе.
         question (str): Вопрос пользователя.
         max_new_tokens (int): Максимальное количество новых токенов для генерации.
+        stats (dict | None): Если передан, заполняется prompt_tokens и generation_time.
+        streamer (TextStreamer | None): Получает ответ по мере генерации.
     
     Returns:
         str: Сгенерированный и декодированный ответ модели.
@@ -75,24 +285,179 @@ def generate_answer(images: list, question: str, max_new_tokens: int = 256):
     input_text = tokenizer.apply_chat_template(messages, add_generation_prompt=True)
 
     inputs = tokenizer(
-        images, 
+        images or None,
         input_text,
         add_special_tokens=False,
         return_tensors="pt",
     ).to("cuda")
 
-    with torch.inference_mode():
-        output = model.generate(
-            **inputs,
-            max_new_tokens=max_new_tokens,
-            use_cache=True,
-            temperature=0.7,
-            min_p=0.1,
-            pad_token_id=tokenizer.eos_token_id
+    print(inputs['input_ids'].shape[1])
+    return _generate(inputs, max_new_tokens, stats, streamer=streamer)
+
+
+def generate_answer_from_features(features: list[dict], question: str, max_new_tokens: int = 256,
+                                  stats: dict | None = None, prefix_key: str | None = None,
+                                  streamer: TextStreamer | None = None):
+    """
+    Генерирует ответ по изображениям, заранее подготовленным preprocess_images.
+    Во время вопроса остаётся только токенизация текста и генерация.
+
+    Args:
+        features (list[dict]): Результаты preprocess_images для каждого файла.
+        question (str): Вопрос пользователя.
+        max_new_tokens (int): Максимальное количество новых токенов для генерации.
+        stats (dict | None): Если передан, заполняется prompt_tokens и generation_time.
+        prefix_key (str | None): Ключ документа; если задан, KV префикса с изображениями
+                                 сохраняется и переиспользуется следующими вопросами.
+        streamer (TextStreamer | None): Получает ответ по мере генерации.
+
+    Returns:
+        str: Сгенерированный и декодированный ответ модели.
+    """
+    if not features:
+        return generate_answer([], question, max_new_tokens, stats, streamer)
+
+    pixel_values = torch.cat([f["pixel_values"] for f in features], dim=0)
+    image_grid_thw = torch.cat([f["image_grid_thw"] for f in features], dim=0)
+
+    image_contents = [{"type": "image"} for _ in range(len(image_grid_thw))]
+    messages = [
+        {"role": "user", "content": image_contents + [
+            {"type": "text", "text": question}
+        ]}
+    ]
+    input_text = tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+
+    # Разворачиваем <|image_pad|> по сетке каждого изображения, как это делает процессор
+    merge_length = tokenizer.image_processor.merge_size ** 2
+    image_token = tokenizer.image_token
+    for grid in image_grid_thw:
+        input_text = input_text.replace(image_token, "<|placeholder|>" * int(grid.prod() // merge_length), 1)
+    input_text = input_text.replace("<|placeholder|>", image_token)
+
+    inputs = tokenizer.tokenizer(
+        input_text,
+        add_special_tokens=False,
+        return_tensors="pt",
+    )
+    inputs["pixel_values"] = pixel_values
+    inputs["image_grid_thw"] = image_grid_thw
+    inputs = inputs.to("cuda")
+
+    if prefix_key is None:
+        return _generate(inputs, max_new_tokens, stats, streamer=streamer)
+    return _generate_with_prefix(inputs, prefix_key, max_new_tokens, stats, streamer)
+
+
+def _generate_with_prefix(inputs, prefix_key: str, max_new_tokens: int, stats: dict | None,
+                          streamer: TextStreamer | None = None) -> str:
+    # Префикс - всё до последнего <|vision_end|> включительно, дальше идёт вопрос
+    input_ids = inputs["input_ids"]
+    vision_end_id = tokenizer.tokenizer.convert_tokens_to_ids("<|vision_end|>")
+    prefix_len = int((input_ids[0] == vision_end_id).nonzero()[-1]) + 1
+    prefix_ids = input_ids[0, :prefix_len].cpu()
+    rope_holder = _rope_holder()
+    if adapter_manager is not None:
+        # KV префикса зависит от весов, с которыми он посчитан
+        prefix_key = f"{prefix_key}@{adapter_manager.active}"
+
+    entry = prefix_cache.get(prefix_key)
+    if entry is not None and not torch.equal(entry["input_ids"], prefix_ids):
+        entry = None
+    if entry is None:
+        start = time.perf_counter()
+        with torch.inference_mode():
+            output = model(
+                input_ids=input_ids[:, :prefix_len],
+                attention_mask=inputs["attention_mask"][:, :prefix_len],
+                pixel_values=inputs["pixel_values"],
+                image_grid_thw=inputs["image_grid_thw"],
+                use_cache=True,
+                logits_to_keep=1,
+            )
+        entry = {
+            "past_key_values": output.past_key_values,
+            "rope_deltas": rope_holder.rope_deltas.clone(),
+            "input_ids": prefix_ids,
+            "prefix_len": prefix_len,
+            "bytes": _cache_bytes(output.past_key_values),
+        }
+        prefix_cache.put(prefix_key, entry)
+        if stats is not None:
+            stats["prefix_time"] = time.perf_counter() - start
+    if stats is not None:
+        stats["prefix_hit"] = "prefix_time" not in stats
+        stats["prefix_tokens"] = prefix_len
+
+    # Смещения mrope зависят только от изображений, которые целиком в префиксе
+    rope_holder.rope_deltas = entry["rope_deltas"]
+    try:
+        return _generate(
+            {"input_ids": input_ids, "attention_mask": inputs["attention_mask"]},
+            max_new_tokens,
+            stats,
+            past_key_values=entry["past_key_values"],
+            streamer=streamer,
         )
+    finally:
+        # Возвращаем кэш к состоянию префикса для следующего вопроса
+        entry["past_key_values"].crop(prefix_len)
 
-    prompt_len = inputs['input_ids'].shape[1]
-    print(prompt_len)
-    decoded_answer = tokenizer.decode(output[0][prompt_len:], skip_special_tokens=True)
 
-    return decoded_answer.strip()
+def benchmark_followups(features: list[dict], questions: list[str], prefix_key: str,
+                        max_new_tokens: int = 64) -> list[dict]:
+    """
+    Замеряет задержку серии вопросов по одному документу: первый вопрос
+    считает префикс, последующие используют сохранённый KV-кэш.
+
+    Args:
+        features (list[dict]): Результаты preprocess_images для документа.
+        questions (list[str]): Вопросы по порядку.
+        prefix_key (str): Ключ документа в кэше префиксов.
+        max_new_tokens (int): Максимальное количество новых токенов для генерации.
+
+    Returns:
+        list[dict]: Статистика по каждому вопросу (latency, prefix_hit, prompt_tokens).
+    """
+    prefix_cache.drop(prefix_key)
+    results = []
+    for question in questions:
+        stats = {}
+        start = time.perf_counter()
+        generate_answer_from_features(features, question, max_new_tokens, stats, prefix_key=prefix_key)
+        stats["latency"] = time.perf_counter() - start
+        results.append(stats)
+        print(f"{question[:40]!r}: {stats['latency']:.2f} с, prefix_hit={stats['prefix_hit']}")
+    return results
+
+
+def generate_answer_from_text(document_text: str, question: str, max_new_tokens: int = 256,
+                              stats: dict | None = None, streamer: TextStreamer | None = None):
+    """
+    Генерирует ответ по уже извлечённому тексту документа, без визуальных токенов.
+
+    Args:
+        document_text (str): Текст документа (OCR или текстовый слой PDF).
+        question (str): Вопрос пользователя.
+        max_new_tokens (int): Максимальное количество новых токенов для генерации.
+        stats (dict | None): Если передан, заполняется prompt_tokens и generation_time.
+        streamer (TextStreamer | None): Получает ответ по мере генерации.
+
+    Returns:
+        str: Сгенерированный и декодированный ответ модели.
+    """
+    messages = [
+        {"role": "user", "content": [
+            {"type": "text", "text": f"Текст документа:\n{document_text}\n\n{question}"}
+        ]}
+    ]
+
+    input_text = tokenizer.apply_chat_template(messages, add_generation_prompt=True)
+
+    inputs = tokenizer(
+        text=input_text,
+        add_special_tokens=False,
+        return_tensors="pt",
+    ).to("cuda")
+
+    return _generate(inputs, max_new_tokens, stats, streamer=streamer)
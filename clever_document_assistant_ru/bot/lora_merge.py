@@ -0,0 +1,311 @@
+import argparse
+import hashlib
+import importlib
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+import torch
+from safetensors.torch import load_file
+from torch import nn
+
+logger = logging.getLogger(__name__)
+
+# Объединённый чекпоинт кладётся рядом с адаптером: <адаптер>-merged
+MERGED_SUFFIX = "-merged"
+MERGE_INFO = "merge_info.json"
+ADAPTER_FILES = ("adapter_config.json", "adapter_model.safetensors")
+# Файлы адаптера, которые не нужны объединённому чекпоинту
+SKIP_FILES = ADAPTER_FILES + ("adapter_model.bin", "README.md")
+LORA_KEY_RE = re.compile(r"^base_model\.model\.(.+)\.lora_([AB])(?:\.\w+)?\.weight$")
+
+
+def merged_path(adapter_path: str) -> str:
+    """Каталог объединённого чекпоинта для адаптера."""
+    return adapter_path.rstrip("/") + MERGED_SUFFIX
+
+
+def adapter_fingerprint(adapter_path: str) -> str:
+    """SHA-256 конфигурации и весов адаптера: объединённый чекпоинт устаревает при их изменении."""
+    digest = hashlib.sha256()
+    for name in ADAPTER_FILES:
+        path = os.path.join(adapter_path, name)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+    return digest.hexdigest()
+
+
+def preferred_model_path(model_path: str) -> str:
+    """
+    Путь, с которого стоит загружать модель: объединённый чекпоинт, если он собран
+    из текущей версии адаптера, иначе исходный каталог (адаптер подключается поверх базы).
+
+    Args:
+        model_path: каталог адаптера или полной модели
+    Returns:
+        str: каталог для from_pretrained
+    """
+    if not os.path.exists(os.path.join(model_path, "adapter_config.json")):
+        return model_path
+    info_path = os.path.join(merged_path(model_path), MERGE_INFO)
+    if not os.path.exists(info_path):
+        logger.info(f"ℹ️ Объединённого чекпоинта для {model_path} нет, LoRA считается отдельно на каждом токене")
+        return model_path
+    with open(info_path, encoding="utf-8") as f:
+        info = json.load(f)
+    if info.get("adapter_fingerprint") != adapter_fingerprint(model_path):
+        logger.warning(f"⚠️ Объединённый чекпоинт {merged_path(model_path)} устарел, используется адаптер")
+        return model_path
+    return merged_path(model_path)
+
+
+def _pattern_value(patterns: dict, name: str, default):
+    # Как в PEFT: ключ rank_pattern / alpha_pattern совпадает с концом имени модуля
+    for pattern, value in patterns.items():
+        if re.match(rf"(.*\.)?{pattern}$", name):
+            return value
+    return default
+
+
+def lora_scaling(config: dict, name: str) -> float:
+    """Множитель LoRA-добавки модуля: lora_alpha / r (или / sqrt(r) для rsLoRA)."""
+    rank = _pattern_value(config.get("rank_pattern") or {}, name, config["r"])
+    alpha = _pattern_value(config.get("alpha_pattern") or {}, name, config["lora_alpha"])
+    return alpha / (rank ** 0.5 if config.get("use_rslora") else rank)
+
+
+def read_adapter(adapter_path: str) -> tuple[dict, dict, dict]:
+    """
+    Читает адаптер PEFT.
+
+    Args:
+        adapter_path: каталог с adapter_config.json и adapter_model.safetensors
+    Returns:
+        tuple: (конфигурация, {имя модуля: (lora_A, lora_B)}, прочие тензоры - modules_to_save)
+    """
+    with open(os.path.join(adapter_path, "adapter_config.json"), encoding="utf-8") as f:
+        config = json.load(f)
+    if config.get("peft_type") != "LORA":
+        raise ValueError(f"Поддерживаются только LoRA-адаптеры, а не {config.get('peft_type')}")
+    if config.get("use_dora"):
+        raise ValueError("DoRA нельзя свести к одной добавке к весу, объединение не поддерживается")
+
+    pairs, extra = {}, {}
+    for key, tensor in load_file(os.path.join(adapter_path, "adapter_model.safetensors")).items():
+        match = LORA_KEY_RE.match(key)
+        if match is None:
+            extra[key.removeprefix("base_model.model.")] = tensor
+            continue
+        pairs.setdefault(match.group(1), {})[match.group(2)] = tensor
+    return config, {name: (pair["A"], pair["B"]) for name, pair in pairs.items()}, extra
+
+
+def _dense_weight(module: nn.Module) -> torch.Tensor:
+    # Веса bitsandbytes 4-bit хранятся упакованными, для сложения их нужно распаковать
+    weight = module.weight
+    if hasattr(weight, "quant_state"):
+        import bitsandbytes.functional as bnb_functional
+
+        return bnb_functional.dequantize_4bit(weight.data, weight.quant_state)
+    return weight.data
+
+
+def dequantize_linears(model: nn.Module, dtype: torch.dtype) -> int:
+    """
+    Заменяет квантованные 4-bit слои bitsandbytes обычными nn.Linear в dtype.
+
+    LoRA нельзя прибавлять к 4-bit кодам: добавка меньше шага квантования и теряется
+    при повторном квантовании. Поэтому база распаковывается, веса объединяются
+    в 16 бит, а квантование (load_in_4bit) выполняется один раз при загрузке.
+
+    Returns:
+        int: число заменённых слоёв
+    """
+    replaced = 0
+    for name, module in list(model.named_modules()):
+        if not hasattr(getattr(module, "weight", None), "quant_state"):
+            continue
+        linear = nn.Linear(module.in_features, module.out_features, bias=module.bias is not None,
+                           device=module.weight.device, dtype=dtype)
+        linear.weight.data.copy_(_dense_weight(module).to(dtype))
+        if module.bias is not None:
+            linear.bias.data.copy_(module.bias.data.to(dtype))
+        parent_name, _, child = name.rpartition(".")
+        setattr(model.get_submodule(parent_name), child, linear)
+        replaced += 1
+    if replaced:
+        for attribute in ("is_quantized", "is_loaded_in_4bit"):
+            if hasattr(model, attribute):
+                setattr(model, attribute, False)
+        if hasattr(model, "hf_quantizer"):
+            model.hf_quantizer = None
+        if hasattr(model, "config"):
+            model.config.__dict__.pop("quantization_config", None)
+    return replaced
+
+
+@torch.no_grad()
+def merge_lora(model: nn.Module, config: dict, pairs: dict, extra: dict | None = None) -> int:
+    """
+    Вливает LoRA в веса модели: W += scaling * B @ A (в float32, результат в dtype слоя).
+
+    Args:
+        model: базовая модель без квантования (см. dequantize_linears)
+        config: конфигурация адаптера
+        pairs: {имя модуля: (lora_A, lora_B)} из read_adapter
+        extra: тензоры modules_to_save
+    Returns:
+        int: число объединённых слоёв
+    """
+    modules = dict(model.named_modules())
+    for name, (lora_a, lora_b) in pairs.items():
+        module = modules.get(name)
+        if module is None:
+            raise KeyError(f"В базовой модели нет слоя {name} из адаптера")
+        weight = module.weight
+        delta = lora_b.to(weight.device, torch.float32) @ lora_a.to(weight.device, torch.float32)
+        if config.get("fan_in_fan_out"):
+            delta = delta.T
+        weight.data = (weight.data.float() + lora_scaling(config, name) * delta).to(weight.dtype)
+    if extra:
+        # missing_keys - все веса базы вне modules_to_save, это ожидаемо; лишний ключ значит,
+        # что тензор адаптера не попал бы в модель (lora_embedding_A/B, modules_to_save под другим именем)
+        unexpected = model.load_state_dict(extra, strict=False).unexpected_keys
+        if unexpected:
+            raise KeyError(f"Тензоры адаптера не соответствуют весам базовой модели: {', '.join(unexpected)}")
+    return len(pairs)
+
+
+def load_base_model(config: dict, base_model: str | None, dtype: torch.dtype):
+    # Класс базовой модели берётся из auto_mapping конфигурации адаптера
+    mapping = config.get("auto_mapping") or {}
+    if mapping.get("base_model_class"):
+        module = importlib.import_module(mapping["parent_library"])
+        model_class = getattr(module, mapping["base_model_class"])
+    else:
+        from transformers import AutoModelForCausalLM as model_class
+    return model_class.from_pretrained(base_model or config["base_model_name_or_path"], torch_dtype=dtype)
+
+
+def merge_checkpoint(adapter_path: str, output_path: str | None = None, base_model: str | None = None,
+                     dtype: torch.dtype = torch.bfloat16) -> str:
+    """
+    Собирает готовый к инференсу чекпоинт: база без квантования + влитый адаптер,
+    токенизатор и препроцессор из каталога адаптера.
+
+    Args:
+        adapter_path: каталог адаптера (например, models/fine_tuned/qwen2_5_vl_32B_Instruct)
+        output_path: куда сохранить (по умолчанию <адаптер>-merged, его выбирает preferred_model_path)
+        base_model: база вместо base_model_name_or_path (например, неквантованная версия модели)
+        dtype: тип весов объединённого чекпоинта
+    Returns:
+        str: каталог объединённого чекпоинта
+    """
+    output_path = output_path or merged_path(adapter_path)
+    config, pairs, extra = read_adapter(adapter_path)
+    start = time.perf_counter()
+    model = load_base_model(config, base_model, dtype)
+    dequantized = dequantize_linears(model, dtype)
+    merged = merge_lora(model, config, pairs, extra)
+
+    os.makedirs(output_path, exist_ok=True)
+    model.save_pretrained(output_path, safe_serialization=True)
+    for name in os.listdir(adapter_path):
+        source = os.path.join(adapter_path, name)
+        if name not in SKIP_FILES and os.path.isfile(source):
+            shutil.copy2(source, os.path.join(output_path, name))
+    with open(os.path.join(output_path, MERGE_INFO), "w", encoding="utf-8") as f:
+        json.dump({
+            "adapter_path": adapter_path,
+            "adapter_fingerprint": adapter_fingerprint(adapter_path),
+            "base_model": base_model or config["base_model_name_or_path"],
+            "dtype": str(dtype),
+            "merged_layers": merged,
+            "dequantized_layers": dequantized,
+        }, f, ensure_ascii=False, indent=2)
+    logger.info(
+        f"✅ Адаптер {adapter_path} влит в {output_path}: {merged} слоёв LoRA, "
+        f"распаковано 4-bit слоёв {dequantized}, {time.perf_counter() - start:.1f} с"
+    )
+    return output_path
+
+
+class LoraLinear(nn.Module):
+    """Слой с LoRA без объединения, как его считает PEFT: x W^T + scaling * (x A^T) B^T."""
+
+    def __init__(self, base: nn.Linear, rank: int, alpha: float):
+        super().__init__()
+        self.base = base
+        self.lora_A = nn.Linear(base.in_features, rank, bias=False)
+        self.lora_B = nn.Linear(rank, base.out_features, bias=False)
+        nn.init.normal_(self.lora_B.weight, std=0.02)
+        self.scaling = alpha / rank
+
+    def forward(self, x):
+        return self.base(x) + self.lora_B(self.lora_A(x)) * self.scaling
+
+
+def _tiny_model(hidden: int, layers: int, rank: int | None) -> nn.Module:
+    # Блоки "внимание + MLP" из одних проекций - те же слои, на которые смотрит target_modules
+    blocks = []
+    for _ in range(layers):
+        for in_features, out_features in ((hidden, hidden),) * 4 + ((hidden, 4 * hidden), (4 * hidden, hidden)):
+            linear = nn.Linear(in_features, out_features, bias=False)
+            blocks.append(LoraLinear(linear, rank, rank) if rank else linear)
+    return nn.Sequential(*blocks).eval()
+
+
+def benchmark_merged_latency(hidden: int = 512, layers: int = 4, rank: int = 16, tokens: int = 256) -> dict:
+    """
+    Задержка на токен для маленькой модели на CPU: LoRA отдельно и влитая в веса.
+
+    Args:
+        hidden: размер скрытого слоя
+        layers: число блоков
+        rank: ранг LoRA (как r в adapter_config.json)
+        tokens: число шагов декодирования (по одному токену)
+    Returns:
+        dict: {'unmerged', 'merged'} - миллисекунды на токен, 'max_diff' - расхождение выходов
+    """
+    torch.manual_seed(0)
+    unmerged = _tiny_model(hidden, layers, rank)
+    merged = _tiny_model(hidden, layers, None)
+    with torch.no_grad():
+        for lora, plain in zip(unmerged, merged):
+            delta = lora.lora_B.weight @ lora.lora_A.weight
+            plain.weight.copy_(lora.base.weight + lora.scaling * delta)
+
+    x = torch.randn(1, hidden)
+    result = {}
+    with torch.inference_mode():
+        for name, model in (("unmerged", unmerged), ("merged", merged)):
+            model(x)
+            start = time.perf_counter()
+            for _ in range(tokens):
+                model(x)
+            result[name] = (time.perf_counter() - start) / tokens * 1000
+        result["max_diff"] = float((unmerged(x) - merged(x)).abs().max())
+    print(
+        f"LoRA отдельно: {result['unmerged']:.3f} мс/токен, влитая: {result['merged']:.3f} мс/токен, "
+        f"расхождение {result['max_diff']:.2e}"
+    )
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Объединение LoRA-адаптера с базовой моделью")
+    parser.add_argument("adapter_path", nargs="?", help="каталог адаптера")
+    parser.add_argument("--output", help="каталог объединённого чекпоинта")
+    parser.add_argument("--base-model", help="база вместо base_model_name_or_path")
+    parser.add_argument("--benchmark", action="store_true", help="сравнить задержку на маленькой модели")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.benchmark or not args.adapter_path:
+        benchmark_merged_latency()
+    else:
+        merge_checkpoint(args.adapter_path, args.output, args.base_model)
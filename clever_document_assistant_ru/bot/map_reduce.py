@@ -0,0 +1,245 @@
+import logging
+import os
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Бюджет токенов одного промпта Qwen2.5-VL: контекст минус системное сообщение и ответ
+CHUNK_TOKEN_BUDGET = int(os.getenv("MAP_REDUCE_CHUNK_TOKENS", "16000"))
+MAP_NEW_TOKENS = 192
+REDUCE_NEW_TOKENS = 512
+# Частичный ответ map-шага, если во фрагменте нет сведений по вопросу
+NO_INFO = "нет сведений"
+
+MAP_PROMPT = (
+    "Это фрагмент большого документа ({pages}).\n{text}\n\nВопрос: {question}\n\n"
+    "Выпиши из фрагмента всё, что относится к вопросу, с указанием страниц. "
+    f"Если во фрагменте ничего нет, ответь «{NO_INFO}»."
+)
+REDUCE_PROMPT = (
+    "Ниже выдержки из разных частей документа, относящиеся к вопросу.\n\n{partials}\n\n"
+    "Вопрос: {question}\n\nОбъедини выдержки и дай развернутый ответ на вопрос."
+)
+
+
+def is_no_info(answer: str) -> bool:
+    """Частичный ответ - ровно «нет сведений» (цитата этих слов в полезном ответе не считается)."""
+    return answer.strip().strip(".!«»\"'").strip().lower() == NO_INFO
+
+
+def plan_chunks(pages: list[dict], budget: int = CHUNK_TOKEN_BUDGET) -> list[list[dict]]:
+    """
+    Делит страницы на фрагменты, помещающиеся в один промпт, сохраняя порядок страниц.
+
+    Args:
+        pages: страницы {'label', 'tokens', 'features', 'text'}
+        budget: максимум токенов документа в одном фрагменте
+    Returns:
+        list: фрагменты - списки подряд идущих страниц
+    """
+    chunks, current, current_tokens = [], [], 0
+    for page in pages:
+        if current and current_tokens + page["tokens"] > budget:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(page)
+        current_tokens += page["tokens"]
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class CostModel:
+    """
+    Оценка стоимости map-reduce ответа до запуска: токены и задержка.
+
+    Args:
+        prefill_tokens_per_s: скорость обработки промпта бэкендом (на один батч)
+        decode_steps_per_s: шагов декодирования в секунду (батч декодируется одновременно)
+    """
+
+    def __init__(self, prefill_tokens_per_s: float = 4000.0, decode_steps_per_s: float = 20.0):
+        self.prefill_tokens_per_s = prefill_tokens_per_s
+        self.decode_steps_per_s = decode_steps_per_s
+
+    def estimate(self, chunks: list[list[dict]], batch_size: int) -> dict:
+        """
+        Args:
+            chunks: фрагменты из plan_chunks
+            batch_size: размер батча бэкенда
+        Returns:
+            dict: map_calls, map_batches, prompt_tokens, generated_tokens, latency (секунды)
+        """
+        prompt_tokens = sum(page["tokens"] for chunk in chunks for page in chunk)
+        batches = -(-len(chunks) // batch_size)
+        reduce_tokens = len(chunks) * MAP_NEW_TOKENS
+        latency = (
+            prompt_tokens / self.prefill_tokens_per_s + batches * MAP_NEW_TOKENS / self.decode_steps_per_s
+            + reduce_tokens / self.prefill_tokens_per_s + REDUCE_NEW_TOKENS / self.decode_steps_per_s
+        )
+        return {
+            "map_calls": len(chunks),
+            "map_batches": batches,
+            "prompt_tokens": prompt_tokens + reduce_tokens,
+            "generated_tokens": len(chunks) * MAP_NEW_TOKENS + REDUCE_NEW_TOKENS,
+            "latency": latency,
+        }
+
+
+class ModelBackend:
+    """
+    Бэкенд на функции генерации модели. Qwen в боте обслуживает один запрос за раз,
+    поэтому батч обрабатывается последовательно (batch_size = 1).
+
+    Args:
+        generate_fn: функция (признаки изображений, промпт, max_new_tokens) -> ответ
+    """
+
+    batch_size = 1
+
+    def __init__(self, generate_fn: Callable[[list[dict], str, int], str]):
+        self.generate_fn = generate_fn
+
+    def generate_batch(self, requests: list[dict]) -> list[str]:
+        return [self.generate_fn(r["features"], r["prompt"], r["max_new_tokens"]) for r in requests]
+
+
+class StubBackend:
+    """
+    Бэкенд-заглушка для проверки планирования без модели: отвечает детерминированно
+    и считает модельное время по тем же скоростям, что и CostModel.
+
+    Args:
+        batch_size: размер батча
+        cost_model: скорости prefill и декодирования
+    """
+
+    def __init__(self, batch_size: int = 8, cost_model: CostModel | None = None):
+        self.batch_size = batch_size
+        self.cost_model = cost_model or CostModel()
+        self.batches = []
+        self.simulated_time = 0.0
+
+    def generate_batch(self, requests: list[dict]) -> list[str]:
+        self.batches.append(len(requests))
+        self.simulated_time += (
+            sum(r["tokens"] for r in requests) / self.cost_model.prefill_tokens_per_s
+            + max(r["max_new_tokens"] for r in requests) / self.cost_model.decode_steps_per_s
+        )
+        answers = []
+        for r in requests:
+            if "partials" in r:
+                answers.append("; ".join(r["partials"]) or NO_INFO)
+                continue
+            marked = [label for label, text in r.get("texts", []) if "ОТВЕТ" in text]
+            answers.append("; ".join(f"ответ на {label}" for label in marked) or NO_INFO)
+        return answers
+
+
+def _run_batches(backend, requests: list[dict]) -> list[str]:
+    # Самые длинные запросы первыми: батчи заполнены целиком, кроме последнего,
+    # а запросы близкой длины попадают в один батч
+    order = sorted(range(len(requests)), key=lambda i: requests[i]["tokens"], reverse=True)
+    answers = [None] * len(requests)
+    for start in range(0, len(order), backend.batch_size):
+        batch = order[start:start + backend.batch_size]
+        for i, answer in zip(batch, backend.generate_batch([requests[i] for i in batch])):
+            answers[i] = answer
+    return answers
+
+
+def map_reduce_answer(pages: list[dict], question: str, backend,
+                      budget: int = CHUNK_TOKEN_BUDGET, cost_model: CostModel | None = None) -> tuple[str, dict]:
+    """
+    Отвечает на вопрос по документу, который не помещается в один промпт:
+    map - частичный ответ по каждому фрагменту, reduce - объединение частичных ответов.
+
+    Args:
+        pages: страницы {'label', 'tokens', 'features' (dict | None), 'text' (str | None)}
+        question: текст вопроса
+        backend: объект с batch_size и generate_batch(requests) -> list[str]
+        budget: максимум токенов документа в одном промпте
+        cost_model: модель стоимости для оценки до запуска
+    Returns:
+        tuple: (ответ, отчёт {'estimate', 'chunks', 'map_time', 'reduce_time', 'reduce_rounds'})
+    """
+    chunks = plan_chunks(pages, budget)
+    report = {"chunks": len(chunks), "estimate": (cost_model or CostModel()).estimate(chunks, backend.batch_size)}
+    logger.debug(f"🧩 Map-reduce: {len(pages)} стр. в {len(chunks)} фрагментах, оценка {report['estimate']}")
+
+    requests = []
+    for chunk in chunks:
+        texts = [(page["label"], page["text"]) for page in chunk if page["text"]]
+        labels = f"{chunk[0]['label']} - {chunk[-1]['label']}" if len(chunk) > 1 else chunk[0]["label"]
+        requests.append({
+            "features": [page["features"] for page in chunk if page["features"] is not None],
+            "prompt": MAP_PROMPT.format(
+                pages=labels, question=question, text="\n\n".join(f"{label}:\n{text}" for label, text in texts),
+            ),
+            "texts": texts,
+            "tokens": sum(page["tokens"] for page in chunk),
+            "max_new_tokens": MAP_NEW_TOKENS,
+        })
+
+    start = time.perf_counter()
+    partials = [answer for answer in _run_batches(backend, requests) if not is_no_info(answer)]
+    report["map_time"] = time.perf_counter() - start
+
+    # Reduce по уровням, пока частичные ответы не поместятся в один промпт
+    start = time.perf_counter()
+    rounds = 0
+    # Ответы map-шага ограничены MAP_NEW_TOKENS, ответы reduce - REDUCE_NEW_TOKENS
+    partial_tokens = MAP_NEW_TOKENS
+    while True:
+        rounds += 1
+        items = [{"text": p, "tokens": partial_tokens} for p in partials]
+        groups = plan_chunks(items, budget) or [[]]
+        if len(groups) >= len(partials) > 1:
+            # В бюджет не помещаются даже два ответа: объединяем попарно, иначе reduce не сойдётся
+            groups = [items[i:i + 2] for i in range(0, len(items), 2)]
+        answers = _run_batches(backend, [{
+            "features": [],
+            "prompt": REDUCE_PROMPT.format(
+                partials="\n\n".join(p["text"] for p in group) or NO_INFO, question=question
+            ),
+            "partials": [p["text"] for p in group],
+            "tokens": len(group) * partial_tokens,
+            "max_new_tokens": REDUCE_NEW_TOKENS,
+        } for group in groups])
+        if len(answers) == 1:
+            break
+        partials, partial_tokens = answers, REDUCE_NEW_TOKENS
+    report["reduce_time"] = time.perf_counter() - start
+    report["reduce_rounds"] = rounds
+    return answers[0], report
+
+
+def benchmark_map_reduce(num_pages: int = 120, tokens_per_page: int = 1300, batch_size: int = 8) -> dict:
+    """
+    Прогоняет map-reduce на заглушке для документа из num_pages страниц и сравнивает
+    оценку CostModel с моделируемым временем бэкенда.
+
+    Returns:
+        dict: отчёт map_reduce_answer с полями simulated_time и batches
+    """
+    pages = [{
+        "label": f"стр. {i + 1}",
+        "tokens": tokens_per_page,
+        "features": None,
+        "text": "ОТВЕТ" if i in (7, 63, 111) else "Типовой текст договора.",
+    } for i in range(num_pages)]
+    backend = StubBackend(batch_size)
+    answer, report = map_reduce_answer(pages, "Где в документе ответ?", backend)
+    report["simulated_time"] = backend.simulated_time
+    report["batches"] = backend.batches
+    print(
+        f"{num_pages} стр.: {report['chunks']} фрагментов, батчи {backend.batches}, "
+        f"оценка {report['estimate']['latency']:.1f} с, моделируемое время {backend.simulated_time:.1f} с, "
+        f"reduce-раундов {report['reduce_rounds']}"
+    )
+    return report
+
+
+if __name__ == "__main__":
+    benchmark_map_reduce()
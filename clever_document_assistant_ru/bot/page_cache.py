@@ -0,0 +1,231 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import torch
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+def content_key(data: bytes) -> str:
+    """SHA-256 содержимого файла - ключ кэша."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class PageCache:
+    """
+    Контентно-адресуемый кэш подготовленных документов на диске.
+
+    Для каждого файла (ключ - SHA-256 содержимого и настройки подготовки,
+    см. upload_pipeline.upload_variant) хранит отрендеренные страницы
+    в PNG, тензоры препроцессора Qwen (features.pt) и метаданные (OCR, число
+    визуальных токенов). Дополнительно запоминает Telegram file_unique_id, чтобы
+    повторно присланный файл не приходилось даже скачивать.
+
+    Размер ограничен max_bytes, вытесняются давно не использованные записи (LRU).
+    Индекс записей живёт в памяти процесса, поэтому каталог принадлежит одному процессу:
+    у бота и HTTP-сервера (api_server) разные каталоги.
+
+    Args:
+        cache_dir: каталог кэша
+        max_bytes: максимальный суммарный размер записей в байтах
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> размер записи в байтах
+        self._aliases = {}  # file_unique_id -> key
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self._entries.values())
+
+    def lookup(self, file_unique_id: str) -> str | None:
+        """Ключ записи по Telegram file_unique_id, если файл уже встречался."""
+        with self._lock:
+            key = self._aliases.get(file_unique_id)
+            return key if key in self._entries else None
+
+    def get_prepared(self, key: str) -> dict | None:
+        """
+        Загружает подготовленные данные записи (метаданные и признаки) без страниц.
+
+        Страницы при попадании нужны редко (вырезки по вопросу), их читает load_page.
+
+        Args:
+            key: ключ записи
+        Returns:
+            dict | None: подготовленные данные или None при промахе
+        """
+        entry = self._read_entry(key)
+        return entry[1] if entry is not None else None
+
+    def get(self, key: str) -> tuple[list[Image.Image], dict] | None:
+        """
+        Загружает запись из кэша вместе со всеми страницами.
+
+        Args:
+            key: ключ записи
+        Returns:
+            tuple | None: (страницы, подготовленные данные) или None при промахе
+        """
+        entry = self._read_entry(key)
+        if entry is None:
+            return None
+        num_pages, prepared = entry
+        pages = [self.load_page(key, i) for i in range(num_pages)]
+        if any(page is None for page in pages):
+            self._drop_corrupted(key, "нет файла страницы")
+            return None
+        return pages, prepared
+
+    def _read_entry(self, key: str) -> tuple[int, dict] | None:
+        # (число страниц, подготовленные данные) записи; промах и повреждённая запись - None
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(entry_dir, "meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+            prepared = meta["prepared"]
+            prepared["features"] = torch.load(os.path.join(entry_dir, "features.pt"))
+            os.utime(entry_dir)
+        except (OSError, KeyError, ValueError) as ex:
+            self._drop_corrupted(key, ex)
+            return None
+
+        logger.debug(f"✅ Попадание в кэш {key[:12]}: {meta['num_pages']} стр.")
+        return meta["num_pages"], prepared
+
+    def _drop_corrupted(self, key: str, reason):
+        logger.warning(f"⚠️ Повреждённая запись кэша {key}: {reason}")
+        with self._lock:
+            self._remove(key)
+            self.hits -= 1
+            self.misses += 1
+
+    def load_page(self, key: str, index: int) -> Image.Image | None:
+        """Загружает одну сохранённую страницу записи (None, если записи уже нет)."""
+        path = os.path.join(self.cache_dir, key, f"page_{index:04d}.png")
+        try:
+            with Image.open(path) as page:
+                page.load()
+                return page
+        except OSError:
+            return None
+
+    def put(self, key: str, pages: list[Image.Image], prepared: dict, file_unique_id: str | None = None):
+        """
+        Сохраняет подготовленный документ и вытесняет старые записи при переполнении.
+
+        Args:
+            key: SHA-256 содержимого файла
+            pages: отрендеренные страницы
+            prepared: результат preprocess_upload (features + метаданные)
+            file_unique_id: Telegram file_unique_id файла
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = entry_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        for i, page in enumerate(pages):
+            page.save(os.path.join(tmp_dir, f"page_{i:04d}.png"))
+        torch.save(prepared["features"], os.path.join(tmp_dir, "features.pt"))
+        meta = {
+            "num_pages": len(pages),
+            "file_unique_ids": [file_unique_id] if file_unique_id else [],
+            "prepared": {k: v for k, v in prepared.items() if k != "features"},
+        }
+        with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+        with self._lock:
+            self._remove(key)
+            os.replace(tmp_dir, entry_dir)
+            self._entries[key] = _dir_size(entry_dir)
+            if file_unique_id:
+                self._aliases[file_unique_id] = key
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                oldest, _ = next(iter(self._entries.items()))
+                self._remove(oldest)
+                self.evictions += 1
+                logger.debug(f"🗑️ Запись кэша {oldest[:12]} вытеснена")
+
+    def add_alias(self, key: str, file_unique_id: str):
+        """Привязывает ещё один file_unique_id к уже сохранённой записи."""
+        with self._lock:
+            if key not in self._entries or self._aliases.get(file_unique_id) == key:
+                return
+            self._aliases[file_unique_id] = key
+            meta_path = os.path.join(self.cache_dir, key, "meta.json")
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            meta["file_unique_ids"].append(file_unique_id)
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+
+    def stats(self) -> dict:
+        """Метрики кэша: попадания, промахи, вытеснения, размер."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+            }
+
+    def _remove(self, key: str):
+        if key in self._entries:
+            del self._entries[key]
+        self._aliases = {uid: k for uid, k in self._aliases.items() if k != key}
+        shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+
+    def _load_index(self):
+        # Восстанавливаем порядок LRU по времени последнего обращения
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp"):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            meta_path = os.path.join(entry_dir, "meta.json")
+            if not os.path.isfile(meta_path):
+                continue
+            try:
+                with open(meta_path, encoding="utf-8") as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            entries.append((os.path.getmtime(entry_dir), name, meta))
+
+        for _, name, meta in sorted(entries):
+            self._entries[name] = _dir_size(os.path.join(self.cache_dir, name))
+            for file_unique_id in meta.get("file_unique_ids", []):
+                self._aliases[file_unique_id] = name
+        logger.debug(f"✅ Кэш страниц: {len(self._entries)} записей, {self.total_bytes} байт")
+
+
+def _dir_size(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
@@ -0,0 +1,202 @@
+import logging
+import os
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from image_tokens import estimate_image_tokens
+
+logger = logging.getLogger(__name__)
+
+# Отбрасывать пустые страницы и повторы перед OCR и инференсом
+PAGE_FILTER = os.getenv("PAGE_FILTER", "1") == "1"
+# Сторона уменьшенной копии страницы для статистик
+THUMB_SIZE = 256
+# Доля "чернил" (пикселей заметно темнее бумаги), ниже которой страница пустая
+BLANK_INK_RATIO = float(os.getenv("PAGE_BLANK_INK_RATIO", "0.003"))
+INK_DELTA = 48
+# Поля страницы, где у сканов бывают тени и следы сканера
+MARGIN = 0.05
+# Перцептивный хэш (dHash) HASH_SIZE x HASH_SIZE бит и пороги почти-дубликата
+HASH_SIZE = 16
+HASH_DELTA = 2.0
+DUPLICATE_HASH_DISTANCE = 12
+DUPLICATE_MEAN_DIFF = 4.0
+COMPARE_SIZE = (96, 128)
+
+
+def _thumbnail(image: Image.Image) -> Image.Image:
+    # reduce усредняет блоки пикселей и работает быстрее resize на полноразмерной странице
+    factor = max(1, max(image.size) // THUMB_SIZE)
+    small = image.reduce(factor) if factor > 1 else image
+    return small.convert("L")
+
+
+def ink_coverage(thumb: Image.Image) -> float:
+    """
+    Доля пикселей, заметно более тёмных, чем фон страницы (поля не учитываются).
+
+    Args:
+        thumb: уменьшенная страница в оттенках серого
+    Returns:
+        float: доля "чернил" от 0 до 1
+    """
+    pixels = np.asarray(thumb, dtype=np.float32)
+    height, width = pixels.shape
+    dy, dx = int(height * MARGIN), int(width * MARGIN)
+    pixels = pixels[dy:height - dy, dx:width - dx]
+    if not pixels.size:
+        return 0.0
+    background = np.percentile(pixels, 90)
+    return float((pixels < background - INK_DELTA).mean())
+
+
+def page_signature(thumb: Image.Image) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Перцептивный хэш страницы и её уменьшенная копия для подтверждения дубликата.
+
+    Args:
+        thumb: уменьшенная страница в оттенках серого
+    Returns:
+        tuple: (dHash - массив HASH_SIZE * HASH_SIZE бит, копия размера COMPARE_SIZE)
+    """
+    grid = np.asarray(thumb.resize((HASH_SIZE + 1, HASH_SIZE), Image.BOX), dtype=np.float32)
+    # Порог на разницу соседних ячеек: на однотонных полях бит не зависит от шума сканера
+    bits = ((grid[:, 1:] - grid[:, :-1]) > HASH_DELTA).ravel()
+    fine = np.asarray(thumb.resize(COMPARE_SIZE, Image.BOX), dtype=np.float32)
+    # Общая яркость повторного скана отличается, сравниваем отклонения от среднего
+    return bits, fine - fine.mean()
+
+
+def is_duplicate(a: tuple[np.ndarray, np.ndarray], b: tuple[np.ndarray, np.ndarray]) -> bool:
+    """Почти-дубликат: близкие хэши и малая средняя разница уменьшенных копий."""
+    if np.count_nonzero(a[0] != b[0]) > DUPLICATE_HASH_DISTANCE:
+        return False
+    return float(np.abs(a[1] - b[1]).mean()) <= DUPLICATE_MEAN_DIFF
+
+
+def filter_pages(pages: list[dict]) -> tuple[list[dict], list[dict]]:
+    """
+    Убирает пустые страницы (разделители, обороты) и повторы страниц документа.
+
+    Args:
+        pages: страницы из load_file_pages
+    Returns:
+        tuple: (оставшиеся страницы, пропущенные [{'index', 'reason', 'duplicate_of', 'image_tokens'}],
+               где reason - "blank" или "duplicate")
+    """
+    if not PAGE_FILTER or len(pages) < 2:
+        return pages, []
+
+    kept, skipped = [], []
+    seen_texts, seen_images = {}, []
+    for page in pages:
+        reason, duplicate_of = None, None
+        if page["image"] is None:
+            text = " ".join(page["text"].split())
+            if text in seen_texts:
+                reason, duplicate_of = "duplicate", seen_texts[text]
+            else:
+                seen_texts[text] = page["index"]
+        else:
+            thumb = _thumbnail(page["image"])
+            if ink_coverage(thumb) < BLANK_INK_RATIO:
+                reason = "blank"
+            else:
+                signature = page_signature(thumb)
+                duplicate_of = next((index for index, seen in seen_images if is_duplicate(signature, seen)), None)
+                if duplicate_of is not None:
+                    reason = "duplicate"
+                else:
+                    seen_images.append((page["index"], signature))
+
+        if reason is None:
+            kept.append(page)
+        else:
+            skipped.append({
+                "index": page["index"],
+                "reason": reason,
+                "duplicate_of": duplicate_of,
+                "image_tokens": page["image_tokens"] if page["image"] is not None else 0,
+            })
+
+    if not kept:
+        # Документ целиком из пустых страниц - отдаём модели первую, чтобы было на что ответить
+        kept, skipped = [pages[0]], skipped[1:]
+    if skipped:
+        logger.debug(
+            f"🧹 Пропущено страниц: {len(skipped)} из {len(pages)}, "
+            f"~{sum(s['image_tokens'] for s in skipped)} визуальных токенов"
+        )
+    return kept, skipped
+
+
+def describe_skipped(skipped: list[dict]) -> str:
+    """Текст для пользователя о пропущенных страницах."""
+    parts = []
+    for page in skipped:
+        if page["reason"] == "blank":
+            parts.append(f"{page['index'] + 1} (пустая)")
+        else:
+            parts.append(f"{page['index'] + 1} (повтор стр. {page['duplicate_of'] + 1})")
+    return ", ".join(parts)
+
+
+def make_synthetic_document(num_pages: int = 20, seed: int = 0) -> list[dict]:
+    """
+    Синтетический скан: страницы с текстом, пустые разделители с шумом сканера
+    и повторно отсканированные страницы (сдвиг яркости и шум).
+    """
+    rng = np.random.default_rng(seed)
+    size = (1654, 2339)  # A4 при 200 DPI
+    originals = []
+    pages = []
+    for index in range(num_pages):
+        kind = "blank" if index % 5 == 4 else "duplicate" if index % 7 == 6 and originals else "text"
+        if kind == "text":
+            image = Image.new("L", size, 245)
+            draw = ImageDraw.Draw(image)
+            for line in range(40):
+                words = rng.integers(3, 12)
+                x = 150
+                for _ in range(words):
+                    width = int(rng.integers(40, 160))
+                    draw.rectangle((x, 200 + line * 48, x + width, 222 + line * 48), fill=30)
+                    x += width + 25
+                    if x > size[0] - 300:
+                        break
+            originals.append(image)
+        elif kind == "duplicate":
+            image = originals[int(rng.integers(len(originals)))]
+        else:
+            image = Image.new("L", size, 240)
+        noisy = np.asarray(image, dtype=np.int16) + rng.integers(-6, 7, size=(size[1], size[0])) + int(rng.integers(-4, 5))
+        image = Image.fromarray(np.clip(noisy, 0, 255).astype(np.uint8)).convert("RGB")
+        pages.append({"index": index, "kind": "scanned", "text": None, "image": image,
+                      "image_tokens": estimate_image_tokens(*size)})
+    return pages
+
+
+def benchmark_filter(num_pages: int = 20) -> dict:
+    """
+    Измеряет сокращение визуальных токенов на синтетическом скане.
+
+    Returns:
+        dict: токены до и после фильтрации, пропущенные страницы
+    """
+    pages = make_synthetic_document(num_pages)
+    kept, skipped = filter_pages(pages)
+    result = {
+        "tokens_before": sum(page["image_tokens"] for page in pages),
+        "tokens_after": sum(page["image_tokens"] for page in kept),
+        "skipped": skipped,
+    }
+    print(
+        f"Визуальных токенов {result['tokens_after']} вместо {result['tokens_before']}, "
+        f"пропущены страницы: {describe_skipped(skipped)}"
+    )
+    return result
+
+
+if __name__ == "__main__":
+    benchmark_filter()
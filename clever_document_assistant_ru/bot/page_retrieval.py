@@ -0,0 +1,175 @@
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter
+
+from image_tokens import estimate_image_tokens
+
+logger = logging.getLogger(__name__)
+
+# Сколько страниц документа передавать VLM (0 - все страницы без отбора)
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+# Символьные n-граммы устойчивы к падежным окончаниям и ошибкам OCR
+NGRAM_RANGE = (3, 5)
+# Размер страницы A4, отрендеренной при 200 DPI (см. pdf_ingest.RENDER_DPI)
+A4_RENDER_SIZE = (1654, 2339)
+
+WORD_RE = re.compile(r"\w+")
+# Координаты блоков текстового слоя "[x0,y0,x1,y1]" в индекс не попадают
+BOX_RE = re.compile(r"\[\d+,\d+,\d+,\d+\]")
+
+
+def char_ngrams(text: str) -> Counter:
+    """
+    Символьные n-граммы слов текста (слово обрамляется пробелами, как в char_wb).
+
+    Args:
+        text: текст страницы или вопроса
+    Returns:
+        Counter: n-грамма -> число вхождений
+    """
+    grams = Counter()
+    for word in WORD_RE.findall(BOX_RE.sub(" ", text).lower()):
+        word = f" {word} "
+        for n in range(NGRAM_RANGE[0], NGRAM_RANGE[1] + 1):
+            for i in range(len(word) - n + 1):
+                grams[word[i:i + n]] += 1
+    return grams
+
+
+class PageIndex:
+    """
+    TF-IDF индекс страниц по символьным n-граммам для отбора страниц под вопрос.
+
+    Строится за миллисекунды по тексту страниц (текстовый слой или OCR Florence-2),
+    поэтому его можно создавать на каждый вопрос.
+
+    Args:
+        page_texts: текст каждой страницы
+    """
+
+    def __init__(self, page_texts: list[str]):
+        counts = [char_ngrams(text or "") for text in page_texts]
+        document_frequency = Counter()
+        for page_counts in counts:
+            document_frequency.update(page_counts.keys())
+        num_pages = len(page_texts)
+        self.idf = {gram: math.log((1 + num_pages) / (1 + df)) + 1 for gram, df in document_frequency.items()}
+        self.vectors = [self._weigh(page_counts) for page_counts in counts]
+
+    def _weigh(self, counts: Counter) -> dict:
+        # Сублинейный tf и L2-нормировка
+        vector = {gram: (1 + math.log(count)) * self.idf[gram] for gram, count in counts.items() if gram in self.idf}
+        norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+        return {gram: value / norm for gram, value in vector.items()}
+
+    def search(self, question: str, top_k: int) -> list[tuple[int, float]]:
+        """
+        Находит страницы, наиболее похожие на вопрос.
+
+        Args:
+            question: текст вопроса
+            top_k: число страниц
+        Returns:
+            list: (индекс страницы, косинусная близость) по убыванию близости
+        """
+        query = self._weigh(char_ngrams(question))
+        scores = [
+            (index, sum(weight * vector.get(gram, 0.0) for gram, weight in query.items()))
+            for index, vector in enumerate(self.vectors)
+        ]
+        scores.sort(key=lambda item: item[1], reverse=True)
+        return scores[:top_k]
+
+
+def select_pages(page_texts: list[str], question: str, top_k: int = RETRIEVAL_TOP_K) -> list[int]:
+    """
+    Отбирает страницы, которые нужно передать модели для ответа на вопрос.
+
+    Args:
+        page_texts: текст каждой страницы
+        question: текст вопроса
+        top_k: число страниц (0 - без отбора)
+    Returns:
+        list: индексы выбранных страниц в исходном порядке
+    """
+    if top_k <= 0 or len(page_texts) <= top_k:
+        return list(range(len(page_texts)))
+    hits = PageIndex(page_texts).search(question, top_k)
+    if not any(score > 0 for _, score in hits):
+        # Вопрос не пересекается с текстом (например, пустой OCR) - отдаём все страницы
+        return list(range(len(page_texts)))
+    return sorted(index for index, _ in hits)
+
+
+def make_fixture(num_pages: int = 40) -> tuple[list[str], list[tuple[str, int]]]:
+    """
+    Синтетический многостраничный договор: типовые страницы и несколько страниц
+    с уникальными разделами, к которым относятся вопросы.
+
+    Returns:
+        tuple: (текст страниц, [(вопрос, номер страницы с ответом)])
+    """
+    filler = (
+        "Исполнитель обязуется оказать услуги, а Заказчик обязуется принять и оплатить их "
+        "в порядке и сроки, установленные настоящим договором. Стороны руководствуются "
+        "действующим законодательством Российской Федерации."
+    )
+    sections = {
+        3: ("Стоимость услуг составляет 1 250 000 рублей, включая НДС 20%. Оплата производится "
+            "в течение десяти банковских дней после подписания акта.", "Какова стоимость услуг по договору?"),
+        11: ("За просрочку исполнения обязательств Исполнитель уплачивает неустойку в размере "
+             "0,1% от стоимости услуг за каждый день просрочки.", "Какая неустойка за просрочку?"),
+        24: ("Договор может быть расторгнут Заказчиком в одностороннем порядке с уведомлением "
+             "Исполнителя не менее чем за тридцать календарных дней.", "Как расторгнуть договор досрочно?"),
+        37: ("Споры разрешаются в Арбитражном суде города Москвы с соблюдением претензионного "
+             "порядка, срок ответа на претензию пятнадцать дней.", "В каком суде рассматриваются споры?"),
+    }
+    pages = []
+    for index in range(num_pages):
+        text = f"Раздел {index + 1}. {filler}"
+        if index in sections:
+            text += " " + sections[index][0]
+        pages.append(text)
+    questions = [(question, index) for index, (_, question) in sections.items() if index < num_pages]
+    return pages, questions
+
+
+def benchmark_retrieval(num_pages: int = 40, top_k: int = RETRIEVAL_TOP_K, tokens_per_page: int | None = None) -> dict:
+    """
+    Измеряет время отбора страниц, точность и экономию визуальных токенов на синтетическом договоре.
+
+    Args:
+        num_pages: число страниц
+        top_k: число отбираемых страниц
+        tokens_per_page: визуальных токенов на страницу (None - как у страницы A4 при 200 DPI)
+    Returns:
+        dict: время, доля вопросов с нужной страницей в выборке, токены до и после
+    """
+    if tokens_per_page is None:
+        tokens_per_page = estimate_image_tokens(*A4_RENDER_SIZE)
+    pages, questions = make_fixture(num_pages)
+    found = 0
+    start = time.perf_counter()
+    for question, expected in questions:
+        found += expected in select_pages(pages, question, top_k)
+    elapsed = (time.perf_counter() - start) / len(questions)
+
+    selected = min(top_k, num_pages) if top_k > 0 else num_pages
+    result = {
+        "retrieval_time": elapsed,
+        "recall": found / len(questions),
+        "tokens_all_pages": num_pages * tokens_per_page,
+        "tokens_selected": selected * tokens_per_page,
+    }
+    print(
+        f"Отбор страниц: {result['retrieval_time'] * 1000:.1f} мс на вопрос, recall@{top_k} {result['recall']:.2f}, "
+        f"визуальных токенов {result['tokens_selected']} вместо {result['tokens_all_pages']}"
+    )
+    return result
+
+
+if __name__ == "__main__":
+    benchmark_retrieval()
@@ -0,0 +1,227 @@
+import logging
+import os
+import pickle
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import NamedTuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from worker_pool import InferencePool
+
+logger = logging.getLogger(__name__)
+
+# Размер сегмента общей памяти под страницы (страница A4 при 200 dpi в RGB ~ 11 МБ)
+PAGE_SLAB_MB = int(os.getenv("PAGE_SLAB_MB", "64"))
+# Выравнивание начала страницы в сегменте
+ALIGNMENT = 64
+
+
+class PageDescriptor(NamedTuple):
+    """Положение страницы в общей памяти - всё, что пересылается воркеру."""
+    slab: str  # имя сегмента shared_memory
+    offset: int
+    shape: tuple[int, ...]
+    dtype: str
+    mode: str | None  # режим PIL для изображений страниц
+
+
+class _Slab:
+    def __init__(self, size: int):
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+        self.used = 0
+        self.refs = 0
+
+
+class PageTransport:
+    """
+    Передача страниц воркерам через общую память вместо pickle.
+
+    Страница копируется в сегмент один раз, воркер получает PageDescriptor
+    (сегмент, смещение, форма, dtype) и открывает его как массив без копирования.
+    Сегменты заполняются подряд; у каждого счётчик страниц, которые ещё не
+    отпущены release, и сегмент без ссылок переиспользуется с начала.
+
+    Args:
+        slab_bytes: размер сегмента (страница больше сегмента получает свой сегмент)
+    """
+
+    def __init__(self, slab_bytes: int = PAGE_SLAB_MB * 2 ** 20):
+        self.slab_bytes = slab_bytes
+        self._slabs = {}  # имя сегмента -> _Slab
+        self._lock = threading.Lock()
+
+    def _allocate(self, size: int) -> tuple[_Slab, int]:
+        # Вызывается под self._lock
+        # Отпущенный сегмент уже сброшен в release (used == 0)
+        for slab in self._slabs.values():
+            offset = -(-slab.used // ALIGNMENT) * ALIGNMENT
+            if offset + size <= slab.memory.size:
+                return slab, offset
+        slab = _Slab(max(self.slab_bytes, size))
+        self._slabs[slab.memory.name] = slab
+        logger.debug(f"📦 Новый сегмент страниц {slab.memory.name}: {slab.memory.size / 2 ** 20:.0f} МБ")
+        return slab, 0
+
+    def put(self, data, shape: tuple[int, ...], dtype: str = "uint8", mode: str | None = None) -> PageDescriptor:
+        """
+        Копирует буфер (bytes, pix.samples, массив) в общую память.
+
+        Args:
+            data: объект с буферным протоколом
+            shape: форма массива
+            dtype: тип элементов
+            mode: режим PIL, если это изображение
+        Returns:
+            PageDescriptor: описание страницы для воркера; после обработки - release
+        """
+        source = memoryview(data).cast("B")
+        with self._lock:
+            slab, offset = self._allocate(source.nbytes)
+            slab.used = offset + source.nbytes
+            slab.refs += 1
+        slab.memory.buf[offset:offset + source.nbytes] = source
+        return PageDescriptor(slab.memory.name, offset, tuple(shape), dtype, mode)
+
+    def put_image(self, image: Image.Image) -> PageDescriptor:
+        """Копирует PIL.Image страницы в общую память."""
+        bands = len(image.getbands())
+        shape = (image.height, image.width) if bands == 1 else (image.height, image.width, bands)
+        return self.put(image.tobytes(), shape, "uint8", image.mode)
+
+    def put_array(self, array: np.ndarray) -> PageDescriptor:
+        """Копирует массив NumPy в общую память."""
+        array = np.ascontiguousarray(array)
+        return self.put(array, array.shape, array.dtype.str)
+
+    def release(self, descriptor: PageDescriptor):
+        """Отпускает страницу; сегмент без страниц становится свободным."""
+        with self._lock:
+            slab = self._slabs[descriptor.slab]
+            slab.refs -= 1
+            if slab.refs == 0:
+                slab.used = 0
+
+    def stats(self) -> dict:
+        """Число сегментов, их общий размер и страницы, ещё не отпущенные воркерами."""
+        with self._lock:
+            return {
+                "slabs": len(self._slabs),
+                "bytes": sum(slab.memory.size for slab in self._slabs.values()),
+                "pages": sum(slab.refs for slab in self._slabs.values()),
+            }
+
+    def close(self):
+        with self._lock:
+            for slab in self._slabs.values():
+                slab.memory.close()
+                slab.memory.unlink()
+            self._slabs.clear()
+
+
+# Сегменты, открытые в этом процессе (воркере): открываются один раз и переиспользуются
+_attached = {}
+
+
+def attach(descriptor: PageDescriptor) -> np.ndarray:
+    """Массив NumPy поверх страницы в общей памяти, без копирования."""
+    memory = _attached.get(descriptor.slab)
+    if memory is None:
+        memory = _attached[descriptor.slab] = shared_memory.SharedMemory(name=descriptor.slab)
+    return np.ndarray(descriptor.shape, np.dtype(descriptor.dtype), buffer=memory.buf, offset=descriptor.offset)
+
+
+def as_tensor(descriptor: PageDescriptor) -> torch.Tensor:
+    """Тензор torch поверх страницы в общей памяти, без копирования."""
+    return torch.from_numpy(attach(descriptor))
+
+
+def as_image(descriptor: PageDescriptor) -> Image.Image:
+    """
+    PIL.Image страницы в общей памяти.
+
+    Режимы L, RGBA, RGBX и подобные PIL открывает поверх буфера без копирования,
+    RGB хранится внутри PIL по 4 байта на пиксель и копируется один раз.
+    """
+    height, width = descriptor.shape[:2]
+    return Image.frombuffer(descriptor.mode, (width, height), attach(descriptor), "raw", descriptor.mode, 0, 1)
+
+
+_transport = None
+
+
+def page_transport() -> PageTransport:
+    """Общий на процесс бота PageTransport, создаётся при первом обращении."""
+    global _transport
+    if _transport is None:
+        _transport = PageTransport()
+    return _transport
+
+
+class PageProbe:
+    """Бэкенд воркера для benchmark_page_transport: читает страницу целиком."""
+
+    def checksum_image(self, image: Image.Image) -> int:
+        return int(np.asarray(image, dtype=np.uint8).sum(dtype=np.uint64))
+
+    def checksum_page(self, descriptor: PageDescriptor) -> int:
+        return int(attach(descriptor).sum(dtype=np.uint64))
+
+
+def benchmark_page_transport(sizes: tuple[tuple[int, int], ...] = ((1654, 2339), (3307, 4677)),
+                             pages: int = 16) -> dict:
+    """
+    Время доставки страницы воркеру пула: PIL.Image через pickle и очередь
+    против PageDescriptor и общей памяти. Воркер в обоих случаях читает страницу целиком.
+
+    Args:
+        sizes: размеры страниц (A4 при 200 и 400 dpi)
+        pages: страниц каждого размера
+    Returns:
+        dict: размер -> {'pickle_ms', 'shared_ms', 'pickle_bytes', 'descriptor_bytes'} на страницу
+    """
+    pool = InferencePool("page_transport:PageProbe", 1)
+    transport = PageTransport()
+    result = {}
+    try:
+        pool.wait_ready()
+        for width, height in sizes:
+            image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+            start = time.perf_counter()
+            expected = [pool.submit("checksum_image", image) for _ in range(pages)]
+            expected = [future.result() for future in expected]
+            pickle_ms = (time.perf_counter() - start) / pages * 1000
+
+            start = time.perf_counter()
+            descriptors = [transport.put_image(image) for _ in range(pages)]
+            futures = [pool.submit("checksum_page", descriptor) for descriptor in descriptors]
+            received = [future.result() for future in futures]
+            for descriptor in descriptors:
+                transport.release(descriptor)
+            shared_ms = (time.perf_counter() - start) / pages * 1000
+
+            if received != expected:
+                raise RuntimeError("Страница в общей памяти отличается от исходной")
+            result[(width, height)] = {
+                "pickle_ms": pickle_ms,
+                "shared_ms": shared_ms,
+                "pickle_bytes": len(pickle.dumps(image)),
+                "descriptor_bytes": len(pickle.dumps(descriptors[0])),
+            }
+            print(
+                f"{width}x{height}: pickle {pickle_ms:.1f} мс/стр. ({result[(width, height)]['pickle_bytes'] / 2 ** 20:.1f} МБ), "
+                f"общая память {shared_ms:.1f} мс/стр. ({result[(width, height)]['descriptor_bytes']} Б дескриптор), "
+                f"сегментов {transport.stats()['slabs']}"
+            )
+    finally:
+        pool.close()
+        transport.close()
+    return result
+
+
+if __name__ == "__main__":
+    benchmark_page_transport()
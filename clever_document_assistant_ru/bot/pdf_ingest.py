@@ -0,0 +1,266 @@
+import logging
+import time
+
+import fitz
+from PIL import Image
+
+from image_ingest import decode_to_target
+from image_tokens import estimate_image_tokens, smart_resize
+
+logger = logging.getLogger(__name__)
+
+RENDER_DPI = 200
+# Минимум символов текстового слоя, чтобы считать страницу цифровой
+MIN_TEXT_CHARS = 50
+# Доля площади страницы под изображениями, начиная с которой нужен визуальный анализ
+IMAGE_COVERAGE_THRESHOLD = 0.3
+# Доля площади страницы под векторной графикой (графики, диаграммы, схемы), начиная с которой нужен визуальный анализ
+DRAWING_COVERAGE_THRESHOLD = 0.1
+# Пути уже этого размера в пунктах - линейки, подчёркивания и линии таблиц, а не графика
+MIN_DRAWING_SIDE = 2.0
+# Координаты блоков нормируются так же, как <loc_N> у Florence-2
+COORD_BINS = 1000
+# Доля страницы, которую должно покрывать единственное изображение скана
+SCAN_COVERAGE = 0.9
+# Форматы встроенных изображений, которые PIL декодирует без перекодирования
+DECODABLE_EXTENSIONS = {"jpeg", "jpg", "png", "tiff", "tif", "bmp", "jpx", "jp2"}
+
+
+def drawing_coverage(page: fitz.Page) -> float:
+    """
+    Доля страницы под векторной графикой.
+
+    Не считается разметка, которую текстовый слой не теряет: тонкие линии
+    (подчёркивания) и незалитые контуры только из горизонтальных и вертикальных
+    отрезков (рамки страницы, сетки таблиц).
+    """
+    page_area = abs(page.rect) or 1.0
+    area = 0.0
+    for drawing in page.get_drawings():
+        rect = drawing["rect"] & page.rect
+        if rect.is_empty or min(rect.width, rect.height) < MIN_DRAWING_SIDE:
+            continue
+        if drawing.get("fill") is None and all(_is_ruling(item) for item in drawing["items"]):
+            continue
+        area += abs(rect)
+    return min(area / page_area, 1.0)
+
+
+def _is_ruling(item: tuple) -> bool:
+    # Прямоугольник или горизонтальный/вертикальный отрезок пути
+    if item[0] == "re":
+        return True
+    if item[0] == "l":
+        start, end = item[1], item[2]
+        return abs(start.x - end.x) < 0.5 or abs(start.y - end.y) < 0.5
+    return False
+
+
+def classify_page(page: fitz.Page) -> str:
+    """
+    Определяет, нужен ли странице визуальный анализ.
+
+    Args:
+        page: страница fitz
+    Returns:
+        str: "text" - цифровая страница с текстовым слоем,
+             "scanned" - только изображение без текста,
+             "mixed" - текст вместе с существенными изображениями или векторной графикой
+    """
+    num_chars = len(page.get_text("text").strip())
+
+    page_area = abs(page.rect) or 1.0
+    image_area = 0.0
+    for image in page.get_images(full=True):
+        for rect in page.get_image_rects(image[0]):
+            image_area += abs(rect & page.rect)
+    coverage = min(image_area / page_area, 1.0)
+
+    if num_chars >= MIN_TEXT_CHARS and coverage < IMAGE_COVERAGE_THRESHOLD:
+        # Цифровая страница с графиком или схемой: текстовый слой не передаёт рисунок
+        return "mixed" if drawing_coverage(page) >= DRAWING_COVERAGE_THRESHOLD else "text"
+    if num_chars < MIN_TEXT_CHARS and (coverage > 0 or num_chars == 0):
+        return "scanned"
+    return "mixed"
+
+
+def extract_page_text(page: fitz.Page) -> str:
+    """
+    Извлекает текстовый слой страницы в порядке чтения вместе с координатами блоков.
+
+    Args:
+        page: страница fitz
+    Returns:
+        str: строки вида "[x0,y0,x1,y1] текст блока", координаты в диапазоне 0-1000
+    """
+    width, height = page.rect.width or 1.0, page.rect.height or 1.0
+    lines = []
+    for x0, y0, x1, y1, text, _, block_type in page.get_text("blocks", sort=True):
+        text = " ".join(text.split())
+        if block_type != 0 or not text:
+            continue
+        box = [
+            int(x0 / width * COORD_BINS), int(y0 / height * COORD_BINS),
+            int(x1 / width * COORD_BINS), int(y1 / height * COORD_BINS),
+        ]
+        lines.append(f"[{','.join(str(min(max(v, 0), COORD_BINS - 1)) for v in box)}] {text}")
+    return "\n".join(lines)
+
+
+def render_page(page: fitz.Page, dpi: int = RENDER_DPI) -> Image.Image:
+    """Растеризует страницу fitz в PIL.Image."""
+    pix = page.get_pixmap(dpi=dpi)
+    mode = "RGBA" if pix.alpha else "RGB"
+    return Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+
+
+def extract_scan_image(document: fitz.Document, page: fitz.Page,
+                       target_size: tuple[int, int]) -> Image.Image | None:
+    """
+    Достаёт встроенное изображение скана напрямую из потока PDF, без растеризации.
+
+    Срабатывает, если на странице ровно одно изображение без маски прозрачности,
+    оно покрывает почти всю страницу и размещено без поворота. JPEG берётся
+    как есть и декодируется через draft сразу в целевое разрешение.
+
+    Args:
+        document: открытый PDF
+        page: страница документа
+        target_size: (ширина, высота) результата - размер, который дал бы рендеринг
+    Returns:
+        PIL.Image | None: изображение страницы или None, если нужна растеризация
+    """
+    images = page.get_images(full=True)
+    if len(images) != 1 or page.rotation:
+        return None
+    xref, smask = images[0][0], images[0][1]
+    if smask:
+        return None
+
+    placements = page.get_image_rects(xref, transform=True)
+    if len(placements) != 1:
+        return None
+    rect, matrix = placements[0]
+    if abs(matrix.b) > 1e-3 or abs(matrix.c) > 1e-3 or matrix.a <= 0 or matrix.d <= 0:
+        return None
+    if abs(rect & page.rect) < SCAN_COVERAGE * abs(page.rect):
+        return None
+
+    extracted = document.extract_image(xref)
+    if not extracted or extracted["ext"] not in DECODABLE_EXTENSIONS:
+        return None
+    try:
+        return decode_to_target(extracted["image"], target_size)
+    except OSError as ex:
+        logger.debug(f"⚠️ Встроенное изображение не декодировано, растеризуем: {ex}")
+        return None
+
+
+def ingest_pdf(data: bytes, use_text_layer: bool = True, extract_scans: bool = True) -> list[dict]:
+    """
+    Разбирает PDF постранично: цифровые страницы отдаются текстом,
+    растеризуются только страницы, которым нужен визуальный анализ.
+
+    Args:
+        data: содержимое PDF
+        use_text_layer: использовать текстовый слой (False - все страницы как изображения)
+        extract_scans: доставать встроенные изображения сканов вместо растеризации
+    Returns:
+        list: для каждой страницы {'index', 'kind', 'text', 'image', 'image_tokens'},
+              где text задан для kind == "text", image - для остальных
+    """
+    document = fitz.open(stream=data, filetype="pdf")
+    if not len(document):
+        raise ValueError("Не удалось конвертировать PDF в изображение")
+
+    pages = []
+    extracted = 0
+    for index, page in enumerate(document):
+        kind = classify_page(page) if use_text_layer else "scanned"
+        # Сколько визуальных токенов заняла бы страница при рендеринге
+        scale = RENDER_DPI / 72
+        render_size = (int(page.rect.width * scale), int(page.rect.height * scale))
+        image_tokens = estimate_image_tokens(*render_size)
+        entry = {"index": index, "kind": kind, "text": None, "image": None, "image_tokens": image_tokens}
+        if kind == "text":
+            entry["text"] = extract_page_text(page)
+        else:
+            if kind == "scanned" and extract_scans:
+                entry["image"] = extract_scan_image(document, page, smart_resize(*render_size))
+                extracted += entry["image"] is not None
+            if entry["image"] is None:
+                entry["image"] = render_page(page)
+            # Токены - по фактически полученному изображению
+            entry["image_tokens"] = estimate_image_tokens(*entry["image"].size)
+        pages.append(entry)
+
+    kinds = [page["kind"] for page in pages]
+    logger.debug(
+        f"✅ PDF разобран: {kinds.count('text')} текстовых, {kinds.count('scanned')} сканов "
+        f"(из них {extracted} извлечены без растеризации), {kinds.count('mixed')} смешанных страниц"
+    )
+    return pages
+
+
+def format_text_pages(pages: list[dict]) -> str:
+    """Собирает текст цифровых страниц для промпта с номерами страниц."""
+    return "\n\n".join(
+        f"Страница {page['index'] + 1}:\n{page['text']}" for page in pages if page["text"] is not None
+    )
+
+
+def make_office_pdf(num_pages: int = 10) -> bytes:
+    """Генерирует локально цифровой PDF, похожий на офисный документ, для бенчмарка."""
+    document = fitz.open()
+    # Встроенные шрифты PDF не содержат кириллицы, поэтому текст латиницей
+    paragraph = (
+        "The Contractor undertakes to provide the services and the Customer undertakes to accept "
+        "and pay for them in the manner and within the terms established by this agreement."
+    )
+    for index in range(num_pages):
+        page = document.new_page(width=595, height=842)
+        page.insert_text((72, 72), f"Section {index + 1}", fontsize=16, fontname="helv")
+        for line in range(30):
+            page.insert_text((72, 110 + line * 22), f"{line + 1}. {paragraph[:80]}", fontsize=10, fontname="helv")
+    return document.tobytes()
+
+
+def benchmark_ingest(num_pages: int = 10, tokenizer=None) -> dict:
+    """
+    Сравнивает растеризацию всех страниц с использованием текстового слоя
+    на локально сгенерированном цифровом PDF.
+
+    Args:
+        num_pages: число страниц тестового PDF
+        tokenizer: токенизатор Qwen для подсчёта текстовых токенов (если None - символы / 4)
+    Returns:
+        dict: время и количество токенов промпта для обоих вариантов
+    """
+    data = make_office_pdf(num_pages)
+
+    start = time.perf_counter()
+    rendered = ingest_pdf(data, use_text_layer=False, extract_scans=False)
+    render_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ingested = ingest_pdf(data)
+    text_time = time.perf_counter() - start
+
+    text = format_text_pages(ingested)
+    text_tokens = len(tokenizer(text)["input_ids"]) if tokenizer is not None else len(text) // 4
+    result = {
+        "pages": num_pages,
+        "render_time": render_time,
+        "render_tokens": sum(page["image_tokens"] for page in rendered),
+        "text_layer_time": text_time,
+        "text_layer_tokens": text_tokens + sum(page["image_tokens"] for page in ingested if page["image"] is not None),
+    }
+    print(
+        f"Растеризация: {result['render_time']:.3f} с, {result['render_tokens']} токенов; "
+        f"текстовый слой: {result['text_layer_time']:.3f} с, {result['text_layer_tokens']} токенов"
+    )
+    return result
+
+
+if __name__ == "__main__":
+    benchmark_ingest()
@@ -0,0 +1,53 @@
+import logging
+
+from image_ingest import PHOTO_MAX_PIXELS
+from image_tokens import IMAGE_FACTOR, MAX_PIXELS, smart_resize
+
+logger = logging.getLogger(__name__)
+
+# Слова, по которым вопрос требует мелких деталей фотографии (текст, цифры, реквизиты)
+DETAIL_KEYWORDS = (
+    "текст", "прочит", "мелк", "номер", "цифр", "сумм", "дата", "реквизит",
+    "инн", "распозна", "перепиш", "выпиш",
+)
+
+
+def needs_detail(question: str) -> bool:
+    """Проверяет, нужен ли для ответа на вопрос самый крупный вариант фотографии."""
+    question = question.lower()
+    return any(keyword in question for keyword in DETAIL_KEYWORDS)
+
+
+def photo_max_pixels(detail: bool) -> int:
+    """Ограничение площади фотографии: для детальных вопросов - предел Qwen2.5-VL."""
+    return MAX_PIXELS if detail else PHOTO_MAX_PIXELS
+
+
+def select_photo_size(sizes: list, detail: bool = False):
+    """
+    Выбирает наименьший вариант фотографии Telegram, которого достаточно модели.
+
+    Telegram присылает несколько PhotoSize одного снимка. Препроцессор всё равно
+    приводит изображение к smart_resize(..., photo_max_pixels), поэтому
+    скачивать вариант крупнее этого размера бессмысленно.
+
+    Args:
+        sizes: список PhotoSize (объекты с width, height), например message.photo
+        detail: вопрос требует мелких деталей - берётся самый крупный вариант
+    Returns:
+        PhotoSize: выбранный вариант
+    """
+    largest = max(sizes, key=lambda size: size.width * size.height)
+    if detail:
+        return largest
+
+    target_width, target_height = smart_resize(largest.width, largest.height, max_pixels=photo_max_pixels(False))
+    for size in sorted(sizes, key=lambda size: size.width * size.height):
+        # smart_resize округляет стороны до IMAGE_FACTOR, поэтому допускаем разницу в один патч
+        if size.width >= target_width - IMAGE_FACTOR and size.height >= target_height - IMAGE_FACTOR:
+            logger.debug(
+                f"📐 Выбран вариант фото {size.width}x{size.height} "
+                f"(крупнейший {largest.width}x{largest.height}, цель {target_width}x{target_height})"
+            )
+            return size
+    return largest
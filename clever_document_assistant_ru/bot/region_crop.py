@@ -0,0 +1,134 @@
+import logging
+import time
+
+from PIL import Image
+
+from florence_ocr import run_ocr_regions
+from image_tokens import IMAGE_FACTOR, estimate_image_tokens, smart_resize
+from page_retrieval import PageIndex
+
+logger = logging.getLogger(__name__)
+
+# Сколько строк OCR, похожих на вопрос, брать со страницы
+REGION_TOP_K = 3
+# Минимальная близость строки к вопросу (косинус TF-IDF по символьным n-граммам)
+MIN_REGION_SCORE = 0.15
+# Значение поля обычно справа в той же строке или в строках ниже
+CONTEXT_LINES = 2
+PADDING = 0.01
+# Если вырезки занимают больше этой доли страницы, выгоднее отдать страницу целиком
+MAX_CROP_AREA = 0.5
+# Миниатюра страницы для общего контекста (~256 визуальных токенов)
+THUMB_MAX_PIXELS = 256 * IMAGE_FACTOR * IMAGE_FACTOR
+# Не режем документы, где под вопрос отобрано больше страниц
+REGION_CROP_MAX_PAGES = 2
+
+
+def match_regions(regions: list[dict], question: str, top_k: int = REGION_TOP_K) -> list[int]:
+    """
+    Находит строки OCR, относящиеся к вопросу.
+
+    Args:
+        regions: строки страницы {'text', 'box'} из run_ocr_regions
+        question: текст вопроса
+        top_k: максимум строк
+    Returns:
+        list: индексы подходящих строк
+    """
+    if not regions:
+        return []
+    hits = PageIndex([region["text"] for region in regions]).search(question, top_k)
+    return [index for index, score in hits if score >= MIN_REGION_SCORE]
+
+
+def crop_boxes(regions: list[dict], matched: list[int], image_size: tuple[int, int]) -> list[tuple[int, int, int, int]]:
+    """
+    Полосы страницы вокруг найденных строк: на всю ширину, с CONTEXT_LINES строками ниже.
+    Пересекающиеся полосы объединяются.
+
+    Args:
+        regions: строки страницы {'text', 'box'}
+        matched: индексы найденных строк
+        image_size: (ширина, высота) страницы
+    Returns:
+        list: прямоугольники (x0, y0, x1, y1) для Image.crop
+    """
+    width, height = image_size
+    pad = int(PADDING * height)
+    strips = []
+    for index in matched:
+        _, y0, _, y1 = regions[index]["box"]
+        line_height = max(y1 - y0, 1)
+        strips.append([max(y0 - pad, 0), min(y1 + CONTEXT_LINES * line_height + pad, height)])
+
+    merged = []
+    for y0, y1 in sorted(strips):
+        if merged and y0 <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], y1)
+        else:
+            merged.append([y0, y1])
+    return [(0, y0, width, y1) for y0, y1 in merged]
+
+
+def question_crops(image: Image.Image, regions: list[dict], question: str) -> list[Image.Image] | None:
+    """
+    Готовит для VLM миниатюру страницы и вырезки в полном разрешении вокруг строк,
+    относящихся к вопросу.
+
+    Args:
+        image: страница в исходном разрешении
+        regions: строки страницы {'text', 'box'} из run_ocr_regions
+        question: текст вопроса
+    Returns:
+        list | None: [миниатюра, вырезки...] или None, если нужна вся страница
+    """
+    matched = match_regions(regions, question)
+    if not matched:
+        return None
+    boxes = crop_boxes(regions, matched, image.size)
+    if sum(y1 - y0 for _, y0, _, y1 in boxes) > MAX_CROP_AREA * image.height:
+        return None
+
+    thumbnail = image.resize(smart_resize(*image.size, max_pixels=THUMB_MAX_PIXELS), Image.BICUBIC)
+    return [thumbnail] + [image.crop(box) for box in boxes]
+
+
+def benchmark_region_crop(samples: list[tuple[Image.Image, str]], generate_fn=None) -> list[dict]:
+    """
+    Сравнивает целую страницу и вырезки по вопросу: визуальные токены и задержку.
+
+    Args:
+        samples: пары (страница, вопрос)
+        generate_fn: функция (изображения, вопрос) -> ответ, например inference_model.generate_answer;
+                     если None, сравниваются только токены
+    Returns:
+        list: для каждого примера токены, время OCR и генерации для обоих вариантов
+    """
+    results = []
+    for image, question in samples:
+        start = time.perf_counter()
+        regions = run_ocr_regions(image)
+        crops = question_crops(image, regions, question)
+        result = {
+            "question": question,
+            "region_time": time.perf_counter() - start,
+            "full_tokens": estimate_image_tokens(*image.size),
+            "crop_tokens": sum(estimate_image_tokens(*crop.size) for crop in crops) if crops else None,
+        }
+        if generate_fn is not None:
+            start = time.perf_counter()
+            result["full_answer"] = generate_fn([image], question)
+            result["full_time"] = time.perf_counter() - start
+            if crops:
+                start = time.perf_counter()
+                result["crop_answer"] = generate_fn(crops, question)
+                result["crop_time"] = time.perf_counter() - start
+        print(
+            f"{question}: {result['full_tokens']} токенов страницы, "
+            f"{result['crop_tokens'] if crops else 'нет вырезок'} токенов вырезок, "
+            f"OCR строк {result['region_time']:.2f} с"
+            + (f", генерация {result['full_time']:.2f} / {result.get('crop_time', float('nan')):.2f} с"
+               if generate_fn is not None else "")
+        )
+        results.append(result)
+    return results
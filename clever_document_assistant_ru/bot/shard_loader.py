@@ -0,0 +1,281 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+logger = logging.getLogger(__name__)
+
+# Потоков чтения шардов (чтение с диска и копирование из mmap отпускают GIL)
+SHARD_LOADER_WORKERS = int(os.getenv("SHARD_LOADER_WORKERS", "8"))
+# Прогревать страничный кэш шардами в параллельных потоках перед from_pretrained
+# (пропускается, если шарды не помещаются в доступную память - см. prefetch_checkpoint)
+PREFETCH_WEIGHTS = os.getenv("PREFETCH_WEIGHTS", "1") == "1"
+INDEX_NAME = "model.safetensors.index.json"
+SINGLE_NAME = "model.safetensors"
+READ_BLOCK = 16 * 1024 * 1024
+
+
+def shard_files(checkpoint_dir: str) -> dict[str, list[str]]:
+    """
+    Шарды чекпоинта и тензоры в каждом из них.
+
+    Args:
+        checkpoint_dir: каталог с model.safetensors.index.json или model.safetensors
+    Returns:
+        dict: путь к шарду -> имена тензоров (пустой словарь, если safetensors нет)
+    """
+    index_path = os.path.join(checkpoint_dir, INDEX_NAME)
+    if os.path.exists(index_path):
+        with open(index_path, encoding="utf-8") as f:
+            weight_map = json.load(f)["weight_map"]
+        shards = {}
+        for name, shard in weight_map.items():
+            shards.setdefault(os.path.join(checkpoint_dir, shard), []).append(name)
+        return shards
+    single = os.path.join(checkpoint_dir, SINGLE_NAME)
+    if os.path.exists(single):
+        with safe_open(single, framework="pt") as f:
+            return {single: list(f.keys())}
+    return {}
+
+
+def _read_through(path: str) -> int:
+    # Последовательное чтение файла целиком: страницы оседают в страничном кэше ОС
+    size = 0
+    buffer = bytearray(READ_BLOCK)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                return size
+            size += read
+
+
+def available_memory() -> int | None:
+    """Память, доступная без вытеснения (MemAvailable: свободная плюс освобождаемый кэш), в байтах."""
+    try:
+        with open("/proc/meminfo", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError):
+        return None
+
+
+def prefetch_checkpoint(checkpoint_dir: str, workers: int = SHARD_LOADER_WORKERS) -> dict[str, float]:
+    """
+    Читает шарды чекпоинта параллельно, чтобы последующий последовательный
+    from_pretrained брал веса из страничного кэша, а не с диска.
+
+    Если шарды больше доступной памяти, прогрев пропускается: первые шарды
+    вытеснились бы из кэша до from_pretrained, и чекпоинт читался бы с диска дважды.
+    Каталог адаптера без полной модели (веса базы в кэше Hugging Face) тоже пропускается.
+
+    Returns:
+        dict: путь к шарду -> секунды чтения (пустой, если прогрев пропущен)
+    """
+    shards = list(shard_files(checkpoint_dir))
+    if not shards:
+        return {}
+    total = sum(os.path.getsize(path) for path in shards)
+    available = available_memory()
+    if available is not None and total > available:
+        logger.info(
+            f"ℹ️ Прогрев {checkpoint_dir} пропущен: шарды {total / 2 ** 30:.1f} ГБ "
+            f"больше доступной памяти {available / 2 ** 30:.1f} ГБ"
+        )
+        return {}
+    start = time.perf_counter()
+
+    def read(path):
+        shard_start = time.perf_counter()
+        _read_through(path)
+        return path, time.perf_counter() - shard_start
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        timings = dict(pool.map(read, shards))
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"📦 Прогрев {len(shards)} шардов {checkpoint_dir}: {total / 2 ** 30:.2f} ГБ за {elapsed:.1f} с "
+        f"({total / 2 ** 20 / max(elapsed, 1e-9):.0f} МБ/с)"
+    )
+    return timings
+
+
+class ShardedCheckpoint(Mapping):
+    """
+    Чекпоинт safetensors из нескольких шардов с ленивой загрузкой тензоров.
+
+    Шарды открываются через mmap параллельно в пуле потоков (safe_open читает
+    только заголовок), тензор копируется из отображения при первом обращении
+    и запоминается. Объект - Mapping имён на тензоры, его можно передать в
+    model.load_state_dict(..., assign=True) для модели, созданной на meta.
+
+    Args:
+        checkpoint_dir: каталог чекпоинта
+        workers: потоков пула
+        device: куда класть тензоры ("cpu" или "cuda")
+    """
+
+    def __init__(self, checkpoint_dir: str, workers: int = SHARD_LOADER_WORKERS, device: str = "cpu"):
+        self.checkpoint_dir = checkpoint_dir
+        self.workers = workers
+        self.device = device
+        self.timings = {}  # путь к шарду -> {'open', 'materialize'} в секундах
+        self._tensors = {}
+        self._lock = threading.Lock()
+
+        shards = shard_files(checkpoint_dir)
+        if not shards:
+            raise FileNotFoundError(f"В {checkpoint_dir} нет чекпоинта safetensors")
+
+        def open_shard(path):
+            start = time.perf_counter()
+            handle = safe_open(path, framework="pt", device=device)
+            return path, handle, time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            opened = list(pool.map(open_shard, shards))
+        self._handles = {path: handle for path, handle, _ in opened}
+        self._shard_of = {name: path for path, names in shards.items() for name in names}
+        for path, _, elapsed in opened:
+            self.timings[path] = {"open": elapsed, "materialize": 0.0}
+
+    def __getitem__(self, name: str) -> torch.Tensor:
+        tensor = self._tensors.get(name)
+        if tensor is None:
+            path = self._shard_of[name]
+            start = time.perf_counter()
+            tensor = self._handles[path].get_tensor(name)
+            with self._lock:
+                self._tensors[name] = tensor
+                self.timings[path]["materialize"] += time.perf_counter() - start
+        return tensor
+
+    def __iter__(self):
+        return iter(self._shard_of)
+
+    def __len__(self) -> int:
+        return len(self._shard_of)
+
+    @property
+    def loaded(self) -> int:
+        """Число уже загруженных тензоров."""
+        return len(self._tensors)
+
+    def materialize(self, names: list[str] | None = None):
+        """
+        Загружает тензоры заранее: шарды параллельно, внутри шарда - подряд.
+
+        Args:
+            names: имена тензоров (по умолчанию все)
+        """
+        by_shard = {}
+        for name in names if names is not None else self._shard_of:
+            by_shard.setdefault(self._shard_of[name], []).append(name)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(lambda shard_names: [self[name] for name in shard_names], by_shard.values()))
+
+    def report(self) -> list[dict]:
+        """Время открытия и загрузки тензоров по шардам."""
+        return [
+            {"shard": os.path.basename(path), "bytes": os.path.getsize(path), **timing}
+            for path, timing in self.timings.items()
+        ]
+
+
+def make_sharded_checkpoint(checkpoint_dir: str, num_shards: int = 4, tensors_per_shard: int = 8,
+                            tensor_shape: tuple[int, int] = (1024, 1024)) -> int:
+    """
+    Маленький шардированный чекпоинт в формате from_pretrained для проверки загрузчика.
+
+    Returns:
+        int: суммарный размер шардов в байтах
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    generator = torch.Generator().manual_seed(0)
+    weight_map, total = {}, 0
+    for shard in range(num_shards):
+        shard_name = f"model-{shard + 1:05d}-of-{num_shards:05d}.safetensors"
+        tensors = {
+            f"model.layers.{shard * tensors_per_shard + i}.weight": torch.randn(tensor_shape, generator=generator)
+            for i in range(tensors_per_shard)
+        }
+        save_file(tensors, os.path.join(checkpoint_dir, shard_name), metadata={"format": "pt"})
+        for name, tensor in tensors.items():
+            weight_map[name] = shard_name
+            total += tensor.numel() * tensor.element_size()
+    with open(os.path.join(checkpoint_dir, INDEX_NAME), "w", encoding="utf-8") as f:
+        json.dump({"metadata": {"total_size": total}, "weight_map": weight_map}, f, indent=2)
+    return total
+
+
+def drop_page_cache(checkpoint_dir: str):
+    """Убирает шарды из страничного кэша (холодный старт без перезагрузки машины)."""
+    for path in shard_files(checkpoint_dir):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def benchmark_startup(checkpoint_dir: str | None = None, workers: int = SHARD_LOADER_WORKERS) -> dict:
+    """
+    Время загрузки всех весов: последовательный load_file по шардам против
+    ShardedCheckpoint, на холодном (после drop_page_cache) и тёплом страничном кэше.
+
+    Args:
+        checkpoint_dir: чекпоинт (по умолчанию создаётся make_sharded_checkpoint во временном каталоге)
+        workers: потоков пула
+    Returns:
+        dict: {(способ, 'cold'/'warm'): секунды}, 'shards' - отчёт по шардам последнего запуска
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        if checkpoint_dir is None:
+            checkpoint_dir = tmp
+            make_sharded_checkpoint(checkpoint_dir)
+
+        def serial():
+            return {name: t for path in shard_files(checkpoint_dir) for name, t in load_file(path).items()}
+
+        def parallel():
+            checkpoint = ShardedCheckpoint(checkpoint_dir, workers)
+            checkpoint.materialize()
+            return checkpoint
+
+        result = {}
+        for method, load in (("serial", serial), ("parallel", parallel)):
+            for cache in ("cold", "warm"):
+                if cache == "cold":
+                    drop_page_cache(checkpoint_dir)
+                start = time.perf_counter()
+                loaded = load()
+                result[(method, cache)] = time.perf_counter() - start
+                print(f"{method} {cache}: {result[(method, cache)]:.2f} с")
+        result["shards"] = loaded.report()
+        for shard in result["shards"]:
+            print(
+                f"  {shard['shard']}: {shard['bytes'] / 2 ** 20:.0f} МБ, открытие {shard['open'] * 1000:.1f} мс, "
+                f"тензоры {shard['materialize']:.2f} с"
+            )
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+
+    benchmark_startup(sys.argv[1] if len(sys.argv) > 1 else None)
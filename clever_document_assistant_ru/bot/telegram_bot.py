@@ -1,5 +1,4 @@
 import asyncio
-import io
 import aiohttp
 import base64
 from aiogram import Bot, Dispatcher, F
@@ -9,20 +8,42 @@ from aiogram.enums import ContentType, ParseMode
 from aiogram.filters import Command
 import logging
 import traceback
+import os
+import time
 from PIL import Image
-from inference_model import generate_answer
-import fitz
+import inference_model
+from inference_model import generate_answer, load_model, use_adapter
+from florence_ocr import ocr_pool
+from upload_pipeline import build_prompt, load_cached_upload, load_file_pages, lookup_upload, preprocess_upload
+from pdf_ingest import format_text_pages
+from page_cache import PageCache
+from image_ingest import sniff_format
+from image_tokens import MAX_PIXELS
+from photo_policy import needs_detail, photo_max_pixels, select_photo_size
+from page_filter import describe_skipped, filter_pages
+from answer_pipeline import OCR_SERVICE_MODE, answer_prepared
 
 # Настройки
 BOT_TOKEN = "YOUR_BOT_TOKEN_HERE"
+# Фоновая подготовка файлов при загрузке ("0" - всё во время вопроса, для сравнения задержки)
+PREPROCESS_ON_UPLOAD = os.getenv("PREPROCESS_ON_UPLOAD", "1") == "1"
+# Кэш подготовленных документов (страницы, признаки, OCR) по SHA-256 содержимого
+PAGE_CACHE_DIR = os.getenv("PAGE_CACHE_DIR", "data/page_cache")
+PAGE_CACHE_MAX_MB = int(os.getenv("PAGE_CACHE_MAX_MB", "2048"))
+# Время жизни сессии с документами без активности пользователя
+SESSION_TTL_MINUTES = int(os.getenv("SESSION_TTL_MINUTES", "30"))
 
 # Инициализация
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
+page_cache = PageCache(PAGE_CACHE_DIR, PAGE_CACHE_MAX_MB * 1024 * 1024)
 
 # Хранилище пользовательских данных в памяти
 user_data = {}
 user_size_data = {}
+user_last_activity = {}
+# Выбранный пользователем LoRA-адаптер (/adapter), переживает /restart
+user_adapter = {}
 
 # Логирование
 logging.basicConfig(
@@ -76,9 +97,10 @@ async def cmd_help(message: Message):
 • Изображения: JPG, PNG, JPEG, BMP, TIFF
 • Документы: PDF
 
-<b>После обработки файла вы не сможете добавить новые, пока не используете /restart</b>
+<b>Документы сохраняются для следующих вопросов, пока вы не используете /restart
+или не пройдёт {ttl} минут без активности</b>
         """
-        await message.answer(help_text)
+        await message.answer(help_text.format(ttl=SESSION_TTL_MINUTES))
         logger.info(f"✅ /help успешно обработан для {message.from_user.id}")
     except Exception as e:
         logger.error(f"❌ Ошибка в /help: {e}\n{traceback.format_exc()}")
@@ -92,7 +114,7 @@ async def clear_handler(message: Message):
     logger.info(f"🔄 /restart от пользователя {user_id}")
     try:
         if user_id in user_data:
-            del user_data[user_id]
+            clear_session(user_id)
             logger.info(f"✅ Данные очищены для {user_id}")
             await message.answer("✅ Данные успешно очищены. Теперь вы можете отправить новый файл.")
         else:
@@ -103,6 +125,33 @@ async def clear_handler(message: Message):
         await message.answer("❌ Произошла ошибка при очистке данных")
 
 
+# Выбор LoRA-адаптера: /adapter - список, /adapter <имя> - переключение
+@dp.message(Command("adapter"))
+async def adapter_handler(message: Message):
+    user_id = message.from_user.id
+    try:
+        adapter_manager = inference_model.adapter_manager
+        if adapter_manager is None:
+            await message.answer("ℹ️ Загружена одна модель, выбор адаптера недоступен")
+            return
+        current = user_adapter.get(user_id, inference_model.DEFAULT_ADAPTER)
+        parts = message.text.split(maxsplit=1)
+        if len(parts) == 1:
+            names = "\n".join(f"{'• ' if name == current else '  '}{name}" for name in adapter_manager.adapters)
+            await message.answer(f"<b>Доступные адаптеры:</b>\n{names}")
+            return
+        name = parts[1].strip()
+        if name not in adapter_manager.adapters:
+            await message.answer(f"❌ Адаптер {name} не загружен")
+            return
+        user_adapter[user_id] = name
+        logger.info(f"🔀 Пользователь {user_id} переключился на адаптер {name}")
+        await message.answer(f"✅ Ответы теперь даёт адаптер {name}")
+    except Exception as e:
+        logger.error(f"❌ Ошибка в /adapter: {e}\n{traceback.format_exc()}")
+        await message.answer("Произошла ошибка при выборе адаптера")
+
+
 # Скачивание файла из Telegram
 async def download_file(file_id: str, user_id: str) -> tuple[bytes, str] | tuple[None, None]:
     try:
@@ -119,12 +168,13 @@ async def download_file(file_id: str, user_id: str) -> tuple[bytes, str] | tuple
                 file_data = await response.read()
                 logger.debug(f"✅ Файл скачан, размер: {len(file_data)} байт")
 
-                # Определяем тип файла
+                # Определяем тип файла: по сигнатуре, затем по расширению
+                file_format = sniff_format(file_data)
                 file_extension = file.file_path.split('.')[-1].lower() if '.' in file.file_path else ''
-                if file_extension in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff', 'tif']:
-                    file_type = "image"
-                elif file_extension == 'pdf':
+                if file_format == "pdf" or (file_format is None and file_extension == 'pdf'):
                     file_type = "pdf"
+                elif file_format is not None or file_extension in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'tiff', 'tif']:
+                    file_type = "image"
                 else:
                     file_type = "document"
 
@@ -157,11 +207,34 @@ async def handle_files(message: Message):
         file_data, file_type = None, None
 
         if message.photo:
-            file_id = message.photo[-1].file_id
-            file_data, file_type = await download_file(file_id, user_id)
-        elif message.document:
-            file_id = message.document.file_id
-            file_data, file_type = await download_file(file_id, user_id)
+            # Наименьший вариант фото, которого достаточно модели
+            file_info = select_photo_size(message.photo)
+        else:
+            file_info = message.document
+
+        # Повторно присланный файл берём из кэша, не скачивая
+        cache_key = lookup_upload(
+            page_cache, file_info.file_unique_id, OCR_SERVICE_MODE != "off", OCR_SERVICE_MODE == "crop",
+            photo_max_pixels(not message.photo),
+        ) if PREPROCESS_ON_UPLOAD else None
+        if cache_key:
+            file_type = "pdf" if message.document and message.document.mime_type == "application/pdf" else "image"
+            file = {
+                "type": file_type,
+                "cache_key": cache_key,
+                "prepare_task": asyncio.create_task(asyncio.to_thread(load_cached_upload, page_cache, cache_key)),
+            }
+            if message.photo:
+                file["photo_sizes"], file["photo_size"] = message.photo, file_info
+            user_size_data[user_id] = user_size_data.get(user_id, 0) + (file_info.file_size or 0)
+            user_data.setdefault(user_id, []).append(file)
+            user_last_activity[user_id] = time.monotonic()
+            logger.info(f"📦 Файл {file_info.file_unique_id} найден в кэше: {page_cache.stats()}")
+            await message.answer(
+                f"✅ Файл ({file_type}) сохранен. Теперь отправьте текст с вашим вопросом к документу или другие документы.")
+            return
+
+        file_data, file_type = await download_file(file_info.file_id, user_id)
 
         if file_data and file_type:
             # Проверяем поддерживаемые форматы файлов
@@ -169,18 +242,26 @@ async def handle_files(message: Message):
                 await message.answer(f"❌ Формат файла не поддерживается. Отправьте изображение или PDF.")
                 logger.warning(f"⚠️ Неподдерживаемый формат файла от {user_id}: {file_type}")
                 return
+            file = {
+                "type": file_type,
+                "data": base64.b64encode(file_data).decode('utf-8')
+            }
+            if message.photo:
+                file["photo_sizes"], file["photo_size"] = message.photo, file_info
+            if PREPROCESS_ON_UPLOAD:
+                # Рендеринг, OCR и препроцессинг запускаются в фоне сразу после загрузки
+                # Фото Telegram уменьшаются до photo_max_pixels, изображения-документы - нет
+                file["prepare_task"] = asyncio.create_task(asyncio.to_thread(
+                    preprocess_upload, file_data, file_type, OCR_SERVICE_MODE != "off",
+                    page_cache, file_info.file_unique_id, photo_max_pixels(not message.photo),
+                    OCR_SERVICE_MODE == "crop",
+                ))
             if user_id in user_data:
-                file = {
-                    "type": file_type,
-                    "data": base64.b64encode(file_data).decode('utf-8')
-                }
                 user_data[user_id].append(file)
             else:
                 # Сохраняем информацию о файле (только один файл)
-                user_data[user_id] = [{
-                    "type": file_type,
-                    "data": base64.b64encode(file_data).decode('utf-8')
-                }]
+                user_data[user_id] = [file]
+            user_last_activity[user_id] = time.monotonic()
             await message.answer(
                 f"✅ Файл ({file_type}) сохранен. Теперь отправьте текст с вашим вопросом к документу или другие документы.")
             logger.debug(f"💾 Файл сохранен для {user_id}")
@@ -218,6 +299,7 @@ async def handle_text(message: Message):
             await message.answer("❌ Пожалуйста, укажите вопрос")
             return
 
+        user_last_activity[user_id] = time.monotonic()
         logger.info(f"🚀 Начинаем обработку запроса для {user_id}")
         await process_query(message, user_id, question)
 
@@ -270,67 +352,150 @@ async def process_query(message: Message, user_id: int, question: str):
 
         logger.debug(f"🔧 process_query начат для {user_id}")
         await message.answer("⏳ Обрабатываю запрос...")
-        # Получаем сохраненный файлы
-        prepare_data = []
-        for file in user_data[user_id]:
-            prepare_data.append((base64.b64decode(file['data']), file['type']))
+        question_start = time.perf_counter()
+        files = user_data[user_id]
+        adapter = user_adapter.get(user_id, inference_model.DEFAULT_ADAPTER)
+        if needs_detail(question):
+            await upgrade_photos(files, user_id)
+        prepared = await wait_prepared(files)
+        stats = {}
+
+        # Сообщаем о пропущенных пустых страницах и повторах один раз на файл
+        for file, p in zip(files, prepared or []):
+            if p.get("skipped_pages") and not file.get("skipped_reported"):
+                file["skipped_reported"] = True
+                await message.answer(f"ℹ️ Пропущены страницы: {describe_skipped(p['skipped_pages'])}")
+
+        if prepared:
+            # Ответ по подготовленным при загрузке документам - общий путь с HTTP-сервером
+            with use_adapter(adapter):
+                answer = answer_prepared(prepared, question, page_cache, stats=stats)
+        elif any("data" not in file for file in files):
+            # Файл был взят из кэша без скачивания, а запись успела вытесниться
+            await message.answer("❌ Не удалось получить документ из кэша. Отправьте файл заново.")
+            del user_data[user_id]
+            return
+        else:
+            # Получаем сохраненный файлы
+            prepare_data = []
+            for file in files:
+                prepare_data.append((base64.b64decode(file['data']), file['type']))
+
+            # Подготавливаем данные для модели
+            images, prompt = prepare_data_for_model(prepare_data, question, photo_max_pixels(needs_detail(question)))
 
-        # Подготавливаем данные для модели
-        images, prompt = prepare_data_for_model(prepare_data, question)
+            # Получаем ответ от модели
+            with use_adapter(adapter):
+                answer = generate_answer(images, prompt, stats=stats)
 
-        # Получаем ответ от модели
-        answer = generate_answer(images, prompt)
+        logger.info(
+            f"📊 Время от вопроса до ответа для {user_id}: {time.perf_counter() - question_start:.2f} с "
+            f"({'с предобработкой' if prepared else 'без предобработки'}), "
+            f"генерация {stats['generation_time']:.2f} с, токенов промпта {stats['prompt_tokens']}, "
+            f"префикс из кэша: {stats.get('prefix_hit', False)}"
+        )
 
         # Отправляем ответ пользователю
         await send_response(message, answer)
 
+        # Документы остаются в сессии для следующих вопросов до /restart или истечения TTL
         logger.info(f"✅ Запрос успешно обработан для {user_id}")
 
-        # Очистка данных после обработки запроса
-        if user_id in user_data:
-            del user_data[user_id]
-
     except Exception as e:
         logger.error(f"❌ Ошибка в process_query: {e}\n{traceback.format_exc()}")
         await message.answer("❌ Произошла ошибка при обработке запроса к модели")
 
 
+# Очистка сессии пользователя
+def clear_session(user_id: int):
+    user_data.pop(user_id, None)
+    user_size_data.pop(user_id, None)
+    user_last_activity.pop(user_id, None)
+
+
+# Периодическое удаление сессий без активности дольше SESSION_TTL_MINUTES
+async def expire_sessions():
+    while True:
+        await asyncio.sleep(60)
+        deadline = time.monotonic() - SESSION_TTL_MINUTES * 60
+        for user_id in [uid for uid, ts in user_last_activity.items() if ts < deadline]:
+            clear_session(user_id)
+            logger.info(f"⌛ Сессия {user_id} истекла, данные очищены")
+
+
+# Ожидание фоновой подготовки файлов, запущенной при загрузке
+async def wait_prepared(files: list[dict]) -> list[dict] | None:
+    if not all("prepare_task" in file for file in files):
+        return None
+    try:
+        return list(await asyncio.gather(*(file["prepare_task"] for file in files)))
+    except Exception as e:
+        logger.warning(f"⚠️ Фоновая подготовка не удалась, готовим данные заново: {e}")
+        return None
+
+
+# Замена уменьшенных вариантов фото самыми крупными для вопросов о мелких деталях
+async def upgrade_photos(files: list[dict], user_id: int):
+    for file in files:
+        sizes = file.get("photo_sizes")
+        if not sizes:
+            continue
+        largest = select_photo_size(sizes, detail=True)
+        # Тот же вариант фото подходит, только если он уже подготовлен без ограничения PHOTO_MAX_PIXELS
+        # или меньше этого ограничения
+        if file["photo_size"].file_unique_id == largest.file_unique_id and (
+                file.get("detail") or largest.width * largest.height <= photo_max_pixels(False)):
+            continue
+
+        file_data, _ = await download_file(largest.file_id, user_id)
+        if not file_data:
+            logger.warning(f"⚠️ Не удалось скачать крупный вариант фото для {user_id}, используем уменьшенный")
+            continue
+        if "prepare_task" in file:
+            file["prepare_task"].cancel()
+        file["data"] = base64.b64encode(file_data).decode('utf-8')
+        file["photo_size"] = largest
+        file["detail"] = True
+        file.pop("cache_key", None)
+        if PREPROCESS_ON_UPLOAD:
+            file["prepare_task"] = asyncio.create_task(asyncio.to_thread(
+                preprocess_upload, file_data, "image", OCR_SERVICE_MODE != "off",
+                page_cache, largest.file_unique_id, photo_max_pixels(True), OCR_SERVICE_MODE == "crop",
+            ))
+        else:
+            file.pop("prepare_task", None)
+        logger.info(f"🔍 Для детального вопроса {user_id} фото заменено на {largest.width}x{largest.height}")
+
+
 # Функция для подготовки данных к запросу модели
-def prepare_data_for_model(files: list[tuple[bytes, str]], question: str) -> tuple[list[Image.Image], str]:
+def prepare_data_for_model(files: list[tuple[bytes, str]], question: str,
+                           max_pixels: int = MAX_PIXELS) -> tuple[list[Image.Image], str]:
     """
     Подготавливает данные для запроса к модели.
 
     Args:
         files: набор данных в виде изображений и pdf файлов
         question: Текст вопроса пользователя
+        max_pixels: ограничение площади фотографий
     Returns:
-        tuple: (PIL.Image объект, текст запроса)
+        tuple: (PIL.Image объекты страниц, требующих визуального анализа, текст запроса
+                с текстовым слоем цифровых страниц)
     """
     try:
         logger.debug("🛠️ Подготовка данных для модели")
         images = []
+        texts = []
         for file in files:
-            if file[1] == "pdf":
-                # # Конвертируем PDF в изображение
-                logger.debug("📄 Конвертируем PDF в изображение")
-                pages = fitz.open(stream=file[0], filetype=file[1])
-                if pages:
-                    for page in range(len(pages)):
-                        pix = pages.load_page(page).get_pixmap(dpi=200)
-                        mode = "RGBA" if pix.alpha else "RGB"
-                        image = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
-                        images.append(image)
-                    logger.debug(f"✅ PDF сконвертирован в изображение")
-                else:
-                    raise ValueError("Не удалось конвертировать PDF в изображение")
-            else:
-                # Открываем изображение
-                image = Image.open(io.BytesIO(bytes(file[0])))
-                images.append(image)
-                logger.debug(f"✅ Изображение загружено, размер: {image.size}")
+            pages, skipped = filter_pages(load_file_pages(file[0], file[1], max_pixels))
+            if skipped:
+                logger.info(f"🧹 Пропущены страницы: {describe_skipped(skipped)}")
+            images.extend(page["image"] for page in pages if page["image"] is not None)
+            text = format_text_pages(pages)
+            if text:
+                texts.append(text)
 
         # Формируем полный запрос
-        prompt = f"Вопрос: {question}\n\nПроанализируй содержимое документа и дай развернутый ответ."
+        prompt = build_prompt(question, "\n\n".join(texts))
 
         return images, prompt
 
@@ -373,11 +538,19 @@ async def test_bot():
 # Главная функция запуска бота
 async def main():
     logger.info("🚀 Бот запускается...")
+    # Модель загружается здесь, а не при импорте: воркеры OCR (spawn) импортируют этот модуль заново
+    load_model()
     # Проверяем работу бота
     if not await test_bot():
         logger.error("❌ Не удалось инициализировать бота")
         return
     logger.info("✅ Бот успешно инициализирован, начинаем пуллинг...")
+    asyncio.create_task(expire_sessions())
+    # Реплики Florence-2 (FLORENCE_WORKERS) загружаются до первых файлов
+    pool = ocr_pool()
+    if pool is not None:
+        await asyncio.to_thread(pool.wait_ready)
+        logger.info(f"✅ Воркеры OCR готовы: {len(pool.metrics())}")
     try:
         await dp.start_polling(bot)
     except Exception as e:
@@ -0,0 +1,173 @@
+import logging
+import os
+import time
+
+from florence_ocr import extract_pages_regions, extract_pages_text
+from image_ingest import load_photo
+from image_tokens import MAX_PIXELS, estimate_image_tokens
+from inference_model import preprocess_images
+from page_cache import PageCache, content_key
+from page_filter import filter_pages
+from pdf_ingest import format_text_pages, ingest_pdf
+
+logger = logging.getLogger(__name__)
+
+# Использовать текстовый слой цифровых PDF вместо растеризации
+PDF_TEXT_LAYER = os.getenv("PDF_TEXT_LAYER", "1") == "1"
+
+
+# Разбор файла на страницы: текстовый слой или изображение
+def load_file_pages(data: bytes, file_type: str, max_pixels: int = MAX_PIXELS) -> list[dict]:
+    """
+    Преобразует файл в список страниц. Цифровые страницы PDF отдаются текстом,
+    растеризуются только страницы, которым нужен визуальный анализ.
+
+    Args:
+        data: содержимое файла
+        file_type: "pdf" или "image"
+        max_pixels: ограничение площади изображения (по умолчанию предел Qwen2.5-VL)
+    Returns:
+        list: страницы {'index', 'kind', 'text', 'image', 'image_tokens'} (см. ingest_pdf)
+    """
+    if file_type == "pdf":
+        logger.debug("📄 Разбираем PDF")
+        return ingest_pdf(data, use_text_layer=PDF_TEXT_LAYER)
+
+    # Открываем изображение: уменьшенное декодирование, поворот по EXIF, RGB
+    image = load_photo(data, max_pixels)
+    logger.debug(f"✅ Изображение загружено, размер: {image.size}")
+    return [{
+        "index": 0,
+        "kind": "scanned",
+        "text": None,
+        "image": image,
+        "image_tokens": estimate_image_tokens(*image.size),
+    }]
+
+
+# Формирование текста запроса к модели
+def build_prompt(question: str, document_text: str = "") -> str:
+    prompt = f"Вопрос: {question}\n\nПроанализируй содержимое документа и дай развернутый ответ."
+    if document_text:
+        prompt = f"Текст страниц документа:\n{document_text}\n\n{prompt}"
+    return prompt
+
+
+def upload_variant(ocr: bool, regions: bool, max_pixels: int) -> str:
+    """
+    Настройки подготовки, от которых зависит запись кэша: тот же файл с OCR и без,
+    с координатами строк и без, с другим ограничением площади - разные записи.
+    """
+    return f"ocr{int(ocr)}{int(regions)}-{max_pixels}"
+
+
+def lookup_upload(cache: PageCache, file_unique_id: str, ocr: bool = True, regions: bool = False,
+                  max_pixels: int = MAX_PIXELS) -> str | None:
+    """Ключ записи кэша для Telegram file_unique_id, подготовленной с этими же настройками."""
+    return cache.lookup(f"{file_unique_id}-{upload_variant(ocr, regions, max_pixels)}")
+
+
+def preprocess_upload(data: bytes, file_type: str, ocr: bool = True,
+                      cache: PageCache | None = None, file_unique_id: str | None = None,
+                      max_pixels: int = MAX_PIXELS, regions: bool = False) -> dict:
+    """
+    Выполняет всю подготовку файла при загрузке: разбор страниц, OCR
+    и препроцессинг изображений под Qwen. Вызывается в фоне из handle_files,
+    чтобы к моменту вопроса оставалась только генерация.
+
+    Args:
+        data: содержимое файла
+        file_type: "pdf" или "image"
+        ocr: выполнять ли OCR через Florence-2
+        cache: кэш подготовленных документов; повторный файл берётся из него
+        file_unique_id: Telegram file_unique_id для привязки к записи кэша
+        max_pixels: ограничение площади изображения (фото Telegram - см. photo_policy)
+        regions: OCR с координатами строк для вырезок по вопросу (см. region_crop)
+    Returns:
+        dict: content_key, cache_key (ключ записи кэша, см. upload_variant),
+              features (None, если все страницы текстовые), text_pages,
+              page_numbers, image_pages (позиции страниц-изображений), page_texts
+              (текстовый слой по страницам), skipped_pages, image_tokens,
+              text_layer_saved_tokens, timings, ocr_text и ocr_regions (при regions=True)
+    """
+    digest = content_key(data)
+    variant = upload_variant(ocr, regions, max_pixels)
+    key = f"{digest}-{variant}"
+    alias = f"{file_unique_id}-{variant}" if file_unique_id else None
+    if cache is not None:
+        cached = cache.get_prepared(key)
+        if cached is not None:
+            if alias:
+                cache.add_alias(key, alias)
+            return cached
+
+    result = {"content_key": digest, "cache_key": key, "timings": {}}
+
+    start = time.perf_counter()
+    pages = load_file_pages(data, file_type, max_pixels)
+    result["timings"]["render"] = time.perf_counter() - start
+
+    # Пустые страницы и повторы не доходят ни до OCR, ни до модели
+    start = time.perf_counter()
+    pages, result["skipped_pages"] = filter_pages(pages)
+    result["timings"]["filter"] = time.perf_counter() - start
+
+    images = [page["image"] for page in pages if page["image"] is not None]
+    # Списки ниже - по оставшимся страницам; page_numbers - их номера в исходном файле
+    result["page_numbers"] = [page["index"] for page in pages]
+    result["image_pages"] = [i for i, page in enumerate(pages) if page["image"] is not None]
+    result["page_texts"] = [page["text"] for page in pages]
+    result["text_pages"] = format_text_pages(pages)
+    result["image_tokens"] = sum(page["image_tokens"] for page in pages if page["image"] is not None)
+    result["text_layer_saved_tokens"] = sum(page["image_tokens"] for page in pages if page["text"] is not None)
+
+    # Текст всех страниц: текстовый слой или OCR растеризованных страниц
+    ocr_failed = False
+    if ocr and images:
+        try:
+            if regions:
+                result["ocr_regions"], result["timings"]["ocr"] = extract_pages_regions(images)
+                ocr_texts = ["\n".join(region["text"] for region in page) for page in result["ocr_regions"]]
+            else:
+                ocr_texts, result["timings"]["ocr"] = extract_pages_text(images)
+            ocr_iter = iter(ocr_texts)
+            result["ocr_text"] = [page["text"] if page["text"] is not None else next(ocr_iter) for page in pages]
+        except Exception as ex:
+            ocr_failed = True
+            result.pop("ocr_regions", None)
+            logger.warning(f"⚠️ OCR при загрузке не выполнен: {ex}")
+    elif not images:
+        result["ocr_text"] = [page["text"] for page in pages]
+        result["timings"]["ocr"] = 0.0
+
+    start = time.perf_counter()
+    result["features"] = preprocess_images(images) if images else None
+    result["timings"]["preprocess"] = time.perf_counter() - start
+
+    logger.debug(
+        "✅ Файл подготовлен при загрузке: "
+        + ", ".join(f"{name} {value:.2f} с" for name, value in result["timings"].items())
+    )
+    # Без OCR запись неполная: следующая загрузка того же файла должна попробовать снова
+    if cache is not None and not ocr_failed:
+        try:
+            cache.put(key, images, result, alias)
+        except OSError as ex:
+            logger.warning(f"⚠️ Не удалось сохранить файл в кэш: {ex}")
+    return result
+
+
+def load_cached_upload(cache: PageCache, key: str) -> dict:
+    """
+    Возвращает подготовленные данные документа из кэша.
+
+    Args:
+        cache: кэш подготовленных документов
+        key: ключ записи
+    Returns:
+        dict: то же, что preprocess_upload
+    """
+    cached = cache.get_prepared(key)
+    if cached is None:
+        raise KeyError(f"Запись {key} отсутствует в кэше")
+    return cached
@@ -0,0 +1,321 @@
+import importlib
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# Период проверки воркеров и время, за которое свободный воркер должен ответить на ping
+HEALTH_INTERVAL = float(os.getenv("WORKER_HEALTH_INTERVAL", "5"))
+HEALTH_TIMEOUT = float(os.getenv("WORKER_HEALTH_TIMEOUT", "30"))
+# Сколько раз запрос упавшего воркера отправляется другому
+MAX_RETRIES = 1
+PING = "__ping__"
+
+
+class WorkerError(RuntimeError):
+    """Ошибка в воркере или падение воркера во время запроса."""
+
+
+def _worker_main(backend: str, worker_id: int, requests, responses):
+    # backend - "модуль" (функции модуля) или "модуль:фабрика" (методы созданного объекта).
+    # responses - канал только этого воркера: send синхронный, а фоновый поток общей очереди,
+    # убитый вместе с процессом посреди записи, оставлял бы её блокировку захваченной для всех
+    module_name, _, factory = backend.partition(":")
+    target = importlib.import_module(module_name)
+    if factory:
+        target = getattr(target, factory)()
+    responses.send((None, worker_id, "ready", pickle.dumps(os.getpid()), 0.0))
+    while True:
+        message = requests.get()
+        if message is None:
+            return
+        request_id, method, args, kwargs = message
+        start = time.perf_counter()
+        try:
+            result = os.getpid() if method == PING else getattr(target, method)(*args, **kwargs)
+            # Сериализуем здесь: ошибка pickle в фоновом потоке очереди потеряла бы ответ
+            status, payload = "ok", pickle.dumps(result)
+        except Exception as ex:
+            status, payload = "error", pickle.dumps(f"{type(ex).__name__}: {ex}\n{traceback.format_exc()}")
+        responses.send((request_id, worker_id, status, payload, time.perf_counter() - start))
+
+
+class _Worker:
+    def __init__(self, worker_id: int):
+        self.worker_id = worker_id
+        self.process = None
+        self.requests = None
+        self.ready = threading.Event()
+        self.pid = None
+        self.outstanding = 0.0
+        self.in_flight = set()
+        self.completed = 0
+        self.failed = 0
+        self.restarts = 0
+        self.busy_time = 0.0
+        self.ping_sent = None
+
+
+class InferencePool:
+    """
+    Пул процессов-воркеров, у каждого своя реплика модели.
+
+    Запрос уходит воркеру с наименьшей суммарной стоимостью незавершённых запросов
+    (least outstanding work; стоимость - например, число пикселей страницы или токенов).
+    Упавший воркер перезапускается, его запросы отправляются другим воркерам;
+    свободный воркер, не ответивший на ping за HEALTH_TIMEOUT, считается зависшим.
+
+    Args:
+        backend: "модуль" или "модуль:фабрика", импортируется в каждом воркере
+                 (например, "florence_ocr" - функции run_ocr, run_ocr_regions)
+        num_workers: число воркеров
+        health_interval: период проверки воркеров в секундах
+    """
+
+    def __init__(self, backend: str, num_workers: int, health_interval: float = HEALTH_INTERVAL):
+        self.backend = backend
+        self.health_interval = health_interval
+        self._context = multiprocessing.get_context("spawn")
+        self._opened = queue.SimpleQueue()  # каналы ответов запущенных воркеров для _collect
+        self._pending = {}  # request_id -> {'future', 'worker', 'method', 'args', 'kwargs', 'cost', 'retries'}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._workers = [_Worker(i) for i in range(num_workers)]
+        for worker in self._workers:
+            self._start(worker)
+        threading.Thread(target=self._collect, daemon=True).start()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def _start(self, worker: _Worker):
+        worker.ready.clear()
+        worker.requests = self._context.Queue()
+        receiver, sender = self._context.Pipe(duplex=False)
+        worker.process = self._context.Process(
+            target=_worker_main, args=(self.backend, worker.worker_id, worker.requests, sender), daemon=True,
+        )
+        worker.process.start()
+        # Пишущий конец остаётся только у воркера: после его завершения канал отдаёт EOF
+        sender.close()
+        self._opened.put(receiver)
+        worker.ping_sent = None
+
+    def wait_ready(self, timeout: float | None = None) -> bool:
+        """Ждёт, пока все воркеры загрузят модель."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in self._workers:
+            left = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not worker.ready.wait(left):
+                return False
+        return True
+
+    def _send(self, request_id: int):
+        # Вызывается под self._lock
+        request = self._pending[request_id]
+        alive = [w for w in self._workers if w.process.is_alive()] or self._workers
+        worker = min(alive, key=lambda w: (w.outstanding, len(w.in_flight)))
+        request["worker"] = worker.worker_id
+        worker.outstanding += request["cost"]
+        worker.in_flight.add(request_id)
+        worker.requests.put((request_id, request["method"], request["args"], request["kwargs"]))
+
+    def submit(self, method: str, *args, cost: float = 1.0, **kwargs) -> Future:
+        """
+        Отправляет вызов backend.method(*args, **kwargs) наименее загруженному воркеру.
+
+        Args:
+            method: имя функции модуля или метода объекта backend
+            cost: оценка стоимости запроса для выбора воркера
+        Returns:
+            Future: результат или WorkerError
+        """
+        if self._closed.is_set():
+            raise RuntimeError("Пул воркеров остановлен")
+        future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._pending[request_id] = {
+                "future": future, "method": method, "args": args, "kwargs": kwargs, "cost": cost, "retries": 0,
+            }
+            self._send(request_id)
+        return future
+
+    def map(self, method: str, items: list, costs: list[float] | None = None) -> list:
+        """Вызывает method для каждого элемента параллельно на воркерах, результаты в исходном порядке."""
+        costs = costs or [1.0] * len(items)
+        futures = [self.submit(method, item, cost=cost) for item, cost in zip(items, costs)]
+        return [future.result() for future in futures]
+
+    def _collect(self):
+        connections = []
+        while not self._closed.is_set():
+            while not self._opened.empty():
+                connections.append(self._opened.get())
+            for connection in multiprocessing.connection.wait(connections, timeout=0.5):
+                try:
+                    response = connection.recv()
+                except (EOFError, OSError):
+                    # Воркер завершился, перезапущенный получит новый канал
+                    connections.remove(connection)
+                    connection.close()
+                    continue
+                self._handle_response(response)
+        for connection in connections:
+            connection.close()
+
+    def _handle_response(self, response: tuple):
+        request_id, worker_id, status, payload, elapsed = response
+        worker = self._workers[worker_id]
+        if status == "ready":
+            pid = pickle.loads(payload)
+            if pid != worker.process.pid:
+                # Уже заменённый процесс: готовность относится не к текущему воркеру
+                return
+            worker.pid = pid
+            worker.ready.set()
+            logger.info(f"✅ Воркер {worker_id} ({self.backend}) готов, pid {worker.pid}")
+            return
+        with self._lock:
+            request = self._pending.get(request_id)
+            if request is None or request["worker"] != worker_id:
+                # Ответ перезапущенного воркера на запрос, уже отправленный другому:
+                # запрос остаётся ждать ответа нового владельца
+                return
+            del self._pending[request_id]
+            worker.in_flight.discard(request_id)
+            worker.outstanding -= request["cost"]
+            worker.busy_time += elapsed
+            if request["method"] == PING:
+                worker.ping_sent = None
+            if status == "ok":
+                worker.completed += 1
+            else:
+                worker.failed += 1
+        if status == "ok":
+            request["future"].set_result(pickle.loads(payload))
+        else:
+            request["future"].set_exception(WorkerError(pickle.loads(payload)))
+
+    def _restart(self, worker: _Worker, reason: str):
+        # Вызывается под self._lock
+        logger.warning(f"⚠️ Воркер {worker.worker_id} ({self.backend}) {reason}, перезапуск")
+        if worker.process.is_alive():
+            worker.process.kill()
+        worker.process.join(timeout=5)
+        lost = list(worker.in_flight)
+        worker.in_flight.clear()
+        worker.outstanding = 0.0
+        worker.restarts += 1
+        self._start(worker)
+        for request_id in lost:
+            request = self._pending[request_id]
+            if request["method"] != PING and request["retries"] < MAX_RETRIES:
+                request["retries"] += 1
+                self._send(request_id)
+            else:
+                del self._pending[request_id]
+                worker.failed += request["method"] != PING
+                request["future"].set_exception(WorkerError(f"Воркер {worker.worker_id} упал во время запроса"))
+
+    def _watch(self):
+        while not self._closed.wait(self.health_interval):
+            with self._lock:
+                now = time.monotonic()
+                for worker in self._workers:
+                    if not worker.process.is_alive():
+                        self._restart(worker, f"завершился с кодом {worker.process.exitcode}")
+                    elif worker.ping_sent is not None and now - worker.ping_sent > HEALTH_TIMEOUT:
+                        self._restart(worker, f"не отвечает {now - worker.ping_sent:.0f} с")
+                    elif worker.ready.is_set() and not worker.in_flight:
+                        # Свободный воркер должен ответить на ping сразу
+                        request_id = next(self._ids)
+                        self._pending[request_id] = {
+                            "future": Future(), "method": PING, "args": (), "kwargs": {}, "cost": 0.0, "retries": 0,
+                            "worker": worker.worker_id,
+                        }
+                        worker.in_flight.add(request_id)
+                        worker.ping_sent = now
+                        worker.requests.put((request_id, PING, (), {}))
+
+    def metrics(self) -> list[dict]:
+        """Состояние и счётчики каждого воркера."""
+        with self._lock:
+            return [{
+                "worker": w.worker_id,
+                "pid": w.pid,
+                "alive": w.process.is_alive(),
+                "ready": w.ready.is_set(),
+                "outstanding": w.outstanding,
+                "in_flight": len(w.in_flight),
+                "completed": w.completed,
+                "failed": w.failed,
+                "restarts": w.restarts,
+                "busy_time": w.busy_time,
+                "mean_latency": w.busy_time / w.completed if w.completed else None,
+            } for w in self._workers]
+
+    def close(self):
+        """Останавливает воркеры; незавершённые запросы получают WorkerError."""
+        self._closed.set()
+        with self._lock:
+            for worker in self._workers:
+                worker.requests.put(None)
+            for request in self._pending.values():
+                request["future"].set_exception(WorkerError("Пул воркеров остановлен"))
+            self._pending.clear()
+        for worker in self._workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.kill()
+
+
+class StubModel:
+    """Заглушка модели для проверки пула без GPU: генерация - CPU-работа на каждый токен."""
+
+    work_per_token = 20000
+
+    def generate(self, prompt: str, max_new_tokens: int = 64) -> str:
+        for _ in range(max_new_tokens):
+            sum(i * i for i in range(self.work_per_token))
+        return f"ответ на «{prompt}»"
+
+    def crash(self):
+        os._exit(1)
+
+
+def benchmark_pool(worker_counts: tuple[int, ...] = (1, 2, 4), num_requests: int = 32,
+                   max_new_tokens: int = 64) -> dict:
+    """
+    Пропускная способность пула на заглушке в зависимости от числа воркеров.
+
+    Returns:
+        dict: число воркеров -> запросов в секунду
+    """
+    result = {}
+    for num_workers in worker_counts:
+        pool = InferencePool("worker_pool:StubModel", num_workers)
+        try:
+            pool.wait_ready()
+            start = time.perf_counter()
+            futures = [pool.submit("generate", f"вопрос {i}", max_new_tokens) for i in range(num_requests)]
+            for future in futures:
+                future.result()
+            result[num_workers] = num_requests / (time.perf_counter() - start)
+            completed = [m["completed"] for m in pool.metrics()]
+        finally:
+            pool.close()
+        print(f"{num_workers} воркер(ов): {result[num_workers]:.1f} запросов/с, по воркерам {completed}")
+    return result
+
+
+if __name__ == "__main__":
+    benchmark_pool()
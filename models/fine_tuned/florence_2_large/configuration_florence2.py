@@ -289,6 +289,18 @@ class Florence2Config(PretrainedConfig):
             `inputs_ids` passed when calling [`~Florence2ForConditionalGeneration`]
         projection_dim (`int`, *optional*, defaults to 1024):
             Dimension of the multimodal projection space.
+        image_token_keep_ratio (`float`, *optional*, defaults to 1.0):
+            Fraction of spatial image tokens kept after `image_proj_norm`. Values below 1.0 drop the
+            least informative (background) tokens before the language encoder; pooled tokens are always kept.
+        image_token_prune_criterion (`str`, *optional*, defaults to `"pixel_std"`):
+            How image tokens are scored for pruning: `"pixel_std"` (pixel variance under the token's patch,
+            blank paper scores lowest) or `"feature_norm"` (distance of the token feature from the mean token).
+        beam_shared_cross_attention (`bool`, *optional*, defaults to `False`):
+            During beam search, project and cache the decoder cross-attention keys/values once per source
+            sequence and broadcast them over the beams instead of keeping a copy per beam.
+        incremental_no_repeat_ngram (`bool`, *optional*, defaults to `False`):
+            Enforce `no_repeat_ngram_size` of the language model with an incremental tensor n-gram table that is
+            updated by one n-gram per step instead of rebuilding it from the whole prefix.
 
     Example:
 
@@ -321,11 +333,19 @@ class Florence2Config(PretrainedConfig):
         ignore_index=-100,
         vocab_size=51289,
         projection_dim=1024,
+        image_token_keep_ratio=1.0,
+        image_token_prune_criterion="pixel_std",
+        beam_shared_cross_attention=False,
+        incremental_no_repeat_ngram=False,
         **kwargs,
     ):
         self.ignore_index = ignore_index
         self.vocab_size = vocab_size
         self.projection_dim = projection_dim
+        self.image_token_keep_ratio = image_token_keep_ratio
+        self.image_token_prune_criterion = image_token_prune_criterion
+        self.beam_shared_cross_attention = beam_shared_cross_attention
+        self.incremental_no_repeat_ngram = incremental_no_repeat_ngram
         if vision_config is not None:
             vision_config = PretrainedConfig(**vision_config)
         self.vision_config = vision_config
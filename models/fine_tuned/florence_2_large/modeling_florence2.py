@@ -30,6 +30,7 @@ from timm.layers import DropPath, trunc_normal_
 
 from transformers.modeling_utils import PreTrainedModel
 from transformers.generation.utils import GenerationMixin
+from transformers.generation.logits_process import LogitsProcessor, LogitsProcessorList
 from transformers.utils import (
     ModelOutput,
     add_start_docstrings,
@@ -764,10 +765,77 @@ class Florence2Attention(nn.Module):
         self.v_proj = nn.Linear(embed_dim, embed_dim, bias=bias)
         self.q_proj = nn.Linear(embed_dim, embed_dim, bias=bias)
         self.out_proj = nn.Linear(embed_dim, embed_dim, bias=bias)
+        # number of beams sharing one source sequence (see `_beam_shared_cross_attention`)
+        self.shared_beams = 1
 
     def _shape(self, tensor: torch.Tensor, seq_len: int, bsz: int):
         return tensor.view(bsz, seq_len, self.num_heads, self.head_dim).transpose(1, 2).contiguous()
 
+    def _use_beam_shared_cross_attention(self, hidden_states, key_value_states, layer_head_mask, output_attentions):
+        return (
+            key_value_states is not None
+            and self.shared_beams > 1
+            and hidden_states.size(0) % self.shared_beams == 0
+            and layer_head_mask is None
+            and not output_attentions
+        )
+
+    def _beam_shared_cross_attention(
+        self,
+        hidden_states: torch.Tensor,
+        key_value_states: torch.Tensor,
+        past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, None, Tuple[torch.Tensor]]:
+        """
+        Cross-attention for beam search where the `shared_beams` consecutive rows of the batch are beams of
+        one source sequence (generation expands encoder outputs with `repeat_interleave`). Encoder K/V are
+        projected and cached once per source sequence, and the queries of all beams of a source attend to
+        them as extra query positions. The result is identical to the per-beam computation.
+        """
+        beams = self.shared_beams
+        bsz, tgt_len, _ = hidden_states.size()
+        num_sources = bsz // beams
+
+        if past_key_value is not None and past_key_value[0].shape[2] == key_value_states.shape[1]:
+            key_states, value_states = past_key_value[0], past_key_value[1]
+        else:
+            sources = key_value_states[::beams]
+            key_states = self._shape(self.k_proj(sources), -1, num_sources)
+            value_states = self._shape(self.v_proj(sources), -1, num_sources)
+
+        # [bsz, heads, tgt_len, head_dim] -> [num_sources, heads, beams * tgt_len, head_dim]
+        query_states = self._shape(self.q_proj(hidden_states), tgt_len, bsz)
+        query_states = (
+            query_states.view(num_sources, beams, self.num_heads, tgt_len, self.head_dim)
+            .transpose(1, 2)
+            .reshape(num_sources, self.num_heads, beams * tgt_len, self.head_dim)
+        )
+        if attention_mask is not None:
+            attention_mask = (
+                attention_mask.view(num_sources, beams, 1, tgt_len, -1)
+                .transpose(1, 2)
+                .reshape(num_sources, 1, beams * tgt_len, -1)
+            )
+
+        attn_output = torch.nn.functional.scaled_dot_product_attention(
+            query_states,
+            key_states,
+            value_states,
+            attn_mask=attention_mask,
+            dropout_p=self.dropout if self.training else 0.0,
+            scale=self.scaling,
+        )
+        attn_output = (
+            attn_output.view(num_sources, self.num_heads, beams, tgt_len, self.head_dim)
+            .transpose(1, 2)
+            .reshape(bsz, self.num_heads, tgt_len, self.head_dim)
+        )
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, tgt_len, self.embed_dim)
+        attn_output = self.out_proj(attn_output)
+
+        return attn_output, None, (key_states, value_states)
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -779,6 +847,9 @@ class Florence2Attention(nn.Module):
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         """Input shape: Batch x Time x Channel"""
 
+        if self._use_beam_shared_cross_attention(hidden_states, key_value_states, layer_head_mask, output_attentions):
+            return self._beam_shared_cross_attention(hidden_states, key_value_states, past_key_value, attention_mask)
+
         # if key_value_states are provided this layer is used as a cross-attention layer
         # for the decoder
         is_cross_attention = key_value_states is not None
@@ -1134,6 +1205,9 @@ class Florence2SdpaAttention(Florence2Attention):
                 output_attentions=output_attentions,
             )
 
+        if self._use_beam_shared_cross_attention(hidden_states, key_value_states, layer_head_mask, output_attentions):
+            return self._beam_shared_cross_attention(hidden_states, key_value_states, past_key_value, attention_mask)
+
         # if key_value_states are provided this layer is used as a cross-attention layer
         # for the decoder
         is_cross_attention = key_value_states is not None
@@ -2052,6 +2126,96 @@ class Florence2LanguageModel(Florence2LanguagePreTrainedModel):
         )
 
 
+class Florence2NoRepeatNGramLogitsProcessor(LogitsProcessor):
+    r"""
+    Incremental drop-in replacement for [`NoRepeatNGramLogitsProcessor`]. The stock processor rebuilds the n-gram
+    table of every hypothesis from the whole generated prefix in Python at each step. This one keeps, per hypothesis,
+    a tensor of n-gram keys (hash of the first `ngram_size - 1` tokens) and values (the last token), appends the
+    single n-gram produced by the previous step, and bans the matching values with one scatter.
+
+    Beam search reorders the hypotheses after every step, the model calls [`~reorder`] with the same `beam_idx` it
+    uses for the cache (see `Florence2LanguageForConditionalGeneration._reorder_cache`). If the rows no longer
+    continue the tracked sequences (no cache reordering, a new generation), the table is rebuilt from `input_ids`.
+
+    Args:
+        ngram_size (`int`):
+            All ngrams of size `ngram_size` can only occur once.
+    """
+
+    def __init__(self, ngram_size: int):
+        if not isinstance(ngram_size, int) or ngram_size <= 0:
+            raise ValueError(f"`ngram_size` has to be a strictly positive integer, but is {ngram_size}")
+        self.ngram_size = ngram_size
+        self.base = None
+        self.keys = None
+        self.values = None
+        self.count = 0
+        self.length = 0
+        self.last_tokens = None
+
+    def _hash(self, windows: torch.LongTensor) -> torch.LongTensor:
+        # exact for ngram_size <= 5 with the Florence-2 vocabulary, int64 wraparound beyond that
+        hashes = torch.zeros(windows.shape[:-1], dtype=torch.long, device=windows.device)
+        for i in range(windows.shape[-1]):
+            hashes = hashes * self.base + windows[..., i]
+        return hashes
+
+    def _rebuild(self, input_ids: torch.LongTensor):
+        rows, length = input_ids.shape
+        capacity = max(64, 2 * length)
+        self.keys = input_ids.new_full((rows, capacity), -1)
+        self.values = input_ids.new_zeros((rows, capacity))
+        self.count = max(length - self.ngram_size + 1, 0)
+        if self.count:
+            ngrams = input_ids.unfold(1, self.ngram_size, 1)
+            self.keys[:, :self.count] = self._hash(ngrams[..., :-1])
+            self.values[:, :self.count] = ngrams[..., -1]
+
+    def _append(self, input_ids: torch.LongTensor):
+        if self.count == self.keys.shape[1]:
+            self.keys = torch.cat([self.keys, torch.full_like(self.keys, -1)], dim=1)
+            self.values = torch.cat([self.values, torch.zeros_like(self.values)], dim=1)
+        ngram = input_ids[:, -self.ngram_size:]
+        self.keys[:, self.count] = self._hash(ngram[:, :-1])
+        self.values[:, self.count] = ngram[:, -1]
+        self.count += 1
+
+    def reorder(self, beam_idx: torch.LongTensor):
+        """Follows the beam search hypotheses selected at this step."""
+        if self.keys is None:
+            return
+        beam_idx = beam_idx.to(self.keys.device)
+        self.keys = self.keys.index_select(0, beam_idx)
+        self.values = self.values.index_select(0, beam_idx)
+        self.last_tokens = self.last_tokens.index_select(0, beam_idx)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        rows, length = input_ids.shape
+        if self.base is None:
+            self.base = scores.shape[-1] + 1
+        continues = (
+            self.keys is not None
+            and self.keys.shape[0] == rows
+            and length == self.length + 1
+            and torch.equal(self.last_tokens, input_ids[:, -2])
+        )
+        if not continues:
+            self._rebuild(input_ids)
+        elif length >= self.ngram_size:
+            self._append(input_ids)
+        self.length = length
+        self.last_tokens = input_ids[:, -1].clone()
+
+        if length + 1 < self.ngram_size or not self.count:
+            return scores
+        query = self._hash(input_ids[:, length + 1 - self.ngram_size:])
+        matches = self.keys[:, :self.count] == query[:, None]
+        banned = torch.zeros(scores.shape, dtype=torch.int32, device=scores.device).scatter_add_(
+            1, self.values[:, :self.count], matches.int()
+        )
+        return scores.masked_fill(banned > 0, -float("inf"))
+
+
 class Florence2LanguageForConditionalGeneration(Florence2LanguagePreTrainedModel, GenerationMixin):
     base_model_prefix = "model"
     _tied_weights_keys = ["encoder.embed_tokens.weight", "decoder.embed_tokens.weight", "lm_head.weight"]
@@ -2062,6 +2226,11 @@ class Florence2LanguageForConditionalGeneration(Florence2LanguagePreTrainedModel
         self.model = Florence2LanguageModel(config)
         self.register_buffer("final_logits_bias", torch.zeros((1, self.model.shared.num_embeddings)))
         self.lm_head = nn.Linear(config.d_model, self.model.shared.num_embeddings, bias=False)
+        # logits processors with per-hypothesis state, reordered together with the cache
+        self.beam_state_processors = []
+        # Florence2VocabularyConstraint of the running greedy or sampling generation: logits only over the allowed
+        # rows of lm_head (beam search normalizes the full logits before the processors, see `generate`)
+        self.vocabulary_constraint = None
 
         # Initialize weights and apply final processing
         self.post_init()
@@ -2098,6 +2267,14 @@ class Florence2LanguageForConditionalGeneration(Florence2LanguagePreTrainedModel
     def set_output_embeddings(self, new_embeddings):
         self.lm_head = new_embeddings
 
+    def set_cross_attention_beams(self, num_beams: int):
+        """
+        Makes decoder cross-attention keep encoder K/V once per source sequence and broadcast it over
+        `num_beams` beams (1 restores the per-row computation). Flash-attention layers ignore this setting.
+        """
+        for layer in self.model.decoder.layers:
+            layer.encoder_attn.shared_beams = num_beams
+
     def forward(
         self,
         input_ids: torch.LongTensor = None,
@@ -2116,12 +2293,15 @@ class Florence2LanguageForConditionalGeneration(Florence2LanguagePreTrainedModel
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        allowed_token_ids: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, Seq2SeqLMOutput]:
         r"""
         labels (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
             Labels for computing the masked language modeling loss. Indices should either be in `[0, ...,
             config.vocab_size]` or -100 (see `input_ids` docstring). Tokens with indices set to `-100` are ignored
             (masked), the loss is only computed for the tokens with labels in `[0, ..., config.vocab_size]`.
+        allowed_token_ids (`torch.LongTensor` of shape `(num_allowed,)`, *optional*):
+            Compute the logits only for these rows of `lm_head`, the rest of the vocabulary gets `-inf`.
 
         Returns:
         """
@@ -2154,8 +2334,11 @@ class Florence2LanguageForConditionalGeneration(Florence2LanguagePreTrainedModel
             return_dict=return_dict,
         )
 
-        lm_logits = self.lm_head(outputs[0])
-        lm_logits = lm_logits + self.final_logits_bias.to(lm_logits.device)
+        if allowed_token_ids is None:
+            lm_logits = self.lm_head(outputs[0])
+            lm_logits = lm_logits + self.final_logits_bias.to(lm_logits.device)
+        else:
+            lm_logits = self._sliced_logits(outputs[0], allowed_token_ids)
 
         masked_lm_loss = None
         if labels is not None:
@@ -2179,6 +2362,13 @@ class Florence2LanguageForConditionalGeneration(Florence2LanguagePreTrainedModel
             encoder_attentions=outputs.encoder_attentions,
         )
 
+    def _sliced_logits(self, hidden_states: torch.Tensor, allowed_token_ids: torch.LongTensor) -> torch.Tensor:
+        weight = self.lm_head.weight.index_select(0, allowed_token_ids)
+        bias = self.final_logits_bias[:, allowed_token_ids].to(hidden_states.device)
+        logits = F.linear(hidden_states, weight) + bias
+        lm_logits = logits.new_full((*logits.shape[:-1], self.lm_head.out_features), -float("inf"))
+        return lm_logits.index_copy_(-1, allowed_token_ids, logits)
+
     def prepare_inputs_for_generation(
         self,
         decoder_input_ids,
@@ -2192,6 +2382,11 @@ class Florence2LanguageForConditionalGeneration(Florence2LanguagePreTrainedModel
         encoder_outputs=None,
         **kwargs,
     ):
+        # the constraint looks at the whole hypotheses, before they are cut to the uncached tokens
+        allowed_token_ids = None
+        if self.vocabulary_constraint is not None:
+            allowed_token_ids = self.vocabulary_constraint.step_token_ids(decoder_input_ids)
+
         # cut decoder_input_ids if past_key_values is used
         if past_key_values is not None:
             past_length = past_key_values[0][0].shape[2]
@@ -2216,13 +2411,15 @@ class Florence2LanguageForConditionalGeneration(Florence2LanguagePreTrainedModel
             "decoder_head_mask": decoder_head_mask,
             "cross_attn_head_mask": cross_attn_head_mask,
             "use_cache": use_cache,  # change this to avoid caching (presumably for debugging)
+            "allowed_token_ids": allowed_token_ids,
         }
 
     def prepare_decoder_input_ids_from_labels(self, labels: torch.Tensor):
         return shift_tokens_right(labels, self.config.pad_token_id, self.config.decoder_start_token_id)
 
-    @staticmethod
-    def _reorder_cache(past_key_values, beam_idx):
+    def _reorder_cache(self, past_key_values, beam_idx):
+        for processor in self.beam_state_processors:
+            processor.reorder(beam_idx)
         reordered_past = ()
         for layer_past in past_key_values:
             # cached cross_attention states don't have to be reordered -> they are always the same
@@ -2548,6 +2745,13 @@ class Florence2ForConditionalGeneration(Florence2PreTrainedModel):
         self.language_model = language_model
 
         self.pad_token_id = self.config.pad_token_id if self.config.pad_token_id is not None else -1
+        # optional background-token pruning, can be changed at runtime
+        self.image_token_keep_ratio = getattr(config, 'image_token_keep_ratio', 1.0)
+        self.image_token_prune_criterion = getattr(config, 'image_token_prune_criterion', 'pixel_std')
+        # beam search keeps cross-attention K/V once per source sequence, can be changed at runtime
+        self.beam_shared_cross_attention = getattr(config, 'beam_shared_cross_attention', False)
+        # no_repeat_ngram_size is enforced by Florence2NoRepeatNGramLogitsProcessor instead of the stock processor
+        self.incremental_no_repeat_ngram = getattr(config, 'incremental_no_repeat_ngram', False)
         self.post_init()
     
     def _build_image_projection_layers(self, config):
@@ -2639,10 +2843,50 @@ class Florence2ForConditionalGeneration(Florence2PreTrainedModel):
         x = x @ self.image_projection
         x = self.image_proj_norm(x)
 
+        if self.image_token_keep_ratio < 1.0:
+            x = self._prune_image_tokens(x, pixel_values, x_feat_dict['last_frame'])
+
         return x 
 
+    def _prune_image_tokens(self, x, pixel_values, grid_features):
+        """
+        Drops low-information image tokens, keeping `image_token_keep_ratio` of the spatial tokens of every
+        image. Pooled tokens are always kept and kept tokens stay in their original order (positional
+        embeddings are already added), so every image in the batch ends up with the same number of tokens
+        and the attention masks built from `image_features` stay consistent.
+        """
+        batch_size, num_grid = grid_features.shape[:2]
+        h, w = int(num_grid ** 0.5), int(num_grid ** 0.5)
+        if self.image_token_prune_criterion == 'pixel_std':
+            gray = pixel_values.float().mean(dim=1, keepdim=True)
+            mean = F.adaptive_avg_pool2d(gray, (h, w))
+            sq_mean = F.adaptive_avg_pool2d(gray * gray, (h, w))
+            grid_scores = (sq_mean - mean * mean).clamp(min=0).sqrt().flatten(1)
+        elif self.image_token_prune_criterion == 'feature_norm':
+            grid_features = grid_features.float()
+            grid_scores = (grid_features - grid_features.mean(dim=1, keepdim=True)).norm(dim=-1)
+        else:
+            raise ValueError('invalid image token prune criterion: {}'.format(self.image_token_prune_criterion))
+
+        # scores follow the token layout of image_feature_source
+        scores, num_keep = [], 0
+        num_keep_grid = max(1, int(round(num_grid * self.image_token_keep_ratio)))
+        for _image_feature_source in self.image_feature_source:
+            if _image_feature_source == 'spatial_avg_pool':
+                scores.append(torch.full((batch_size, 1), float('inf'), device=x.device))
+                num_keep += 1
+            else:
+                scores.append(grid_scores)
+                num_keep += num_keep_grid
+        scores = torch.cat(scores, dim=1)
+        if num_keep >= scores.shape[1]:
+            return x
+
+        keep = scores.topk(num_keep, dim=1).indices.sort(dim=1).values
+        return x.gather(1, keep.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
+
     def _merge_input_ids_with_image_features(
-        self, image_features, inputs_embeds 
+        self, image_features, inputs_embeds, attention_mask=None
     ):
         batch_size, image_token_length = image_features.size()[:-1]
         device = image_features.device
@@ -2654,7 +2898,11 @@ class Florence2ForConditionalGeneration(Florence2PreTrainedModel):
             return image_features, image_attention_mask
 
         task_prefix_embeds = inputs_embeds
-        task_prefix_attention_mask = torch.ones(batch_size, task_prefix_embeds.size(1), device=device)
+        if attention_mask is not None:
+            # padding mask of the tokenized prompts, so that padded batches match per-item outputs
+            task_prefix_attention_mask = attention_mask.to(device=device, dtype=image_attention_mask.dtype)
+        else:
+            task_prefix_attention_mask = torch.ones(batch_size, task_prefix_embeds.size(1), device=device)
 
         if len(task_prefix_attention_mask.shape) == 3:
             task_prefix_attention_mask = task_prefix_attention_mask[:, 0]
@@ -2733,7 +2981,9 @@ class Florence2ForConditionalGeneration(Florence2PreTrainedModel):
             if pixel_values is not None:
                 # (batch_size, num_image_tokens, hidden_size)
                 image_features = self._encode_image(pixel_values)
-                inputs_embeds, attention_mask = self._merge_input_ids_with_image_features(image_features, inputs_embeds)
+                inputs_embeds, attention_mask = self._merge_input_ids_with_image_features(
+                    image_features, inputs_embeds, attention_mask
+                )
 
         if inputs_embeds is not None:
             attention_mask = attention_mask.to(inputs_embeds.dtype)
@@ -2780,8 +3030,17 @@ class Florence2ForConditionalGeneration(Florence2PreTrainedModel):
         input_ids, 
         inputs_embeds=None,
         pixel_values=None,
+        attention_mask=None,
+        vocabulary_constraint=None,
         **kwargs
         ):
+        """
+        vocabulary_constraint (`Florence2VocabularyConstraint`, *optional*):
+            Restricts the answer to the tokens of the task (see `Florence2Processor.task_constraint`). With
+            `num_beams=1` the logits are computed only over the allowed rows of `lm_head`. Beam search takes the
+            log-softmax of the logits before the logits processors, so it gets the full logits: the sliced ones
+            would renormalize the scores over the allowed tokens and change the beam scores and the result.
+        """
 
         if inputs_embeds is None:
             # 1. Extra the input embeddings
@@ -2790,13 +3049,43 @@ class Florence2ForConditionalGeneration(Florence2PreTrainedModel):
             # 2. Merge text and images
             if pixel_values is not None:
                 image_features = self._encode_image(pixel_values)
-                inputs_embeds, attention_mask = self._merge_input_ids_with_image_features(image_features, inputs_embeds)
-        
-        return self.language_model.generate(
-            input_ids=None,
-            inputs_embeds=inputs_embeds,
-            **kwargs
-        )
+                inputs_embeds, attention_mask = self._merge_input_ids_with_image_features(
+                    image_features, inputs_embeds, attention_mask
+                )
+
+        # the merged mask masks prompt padding in the encoder and in every decoder cross-attention
+        if attention_mask is not None:
+            kwargs['attention_mask'] = attention_mask
+
+        generation_config = kwargs.get('generation_config') or self.language_model.generation_config
+        num_beams = kwargs.get('num_beams') or generation_config.num_beams or 1
+        share_beams = self.beam_shared_cross_attention and num_beams > 1
+        if share_beams:
+            self.language_model.set_cross_attention_beams(num_beams)
+
+        ngram_processor = None
+        ngram_size = kwargs.get('no_repeat_ngram_size', generation_config.no_repeat_ngram_size)
+        if self.incremental_no_repeat_ngram and ngram_size:
+            ngram_processor = Florence2NoRepeatNGramLogitsProcessor(ngram_size)
+            kwargs['no_repeat_ngram_size'] = 0
+            kwargs['logits_processor'] = LogitsProcessorList([*(kwargs.get('logits_processor') or []), ngram_processor])
+            self.language_model.beam_state_processors.append(ngram_processor)
+        if vocabulary_constraint is not None:
+            kwargs['logits_processor'] = LogitsProcessorList([*(kwargs.get('logits_processor') or []), vocabulary_constraint])
+            if num_beams == 1:
+                self.language_model.vocabulary_constraint = vocabulary_constraint
+        try:
+            return self.language_model.generate(
+                input_ids=None,
+                inputs_embeds=inputs_embeds,
+                **kwargs
+            )
+        finally:
+            if share_beams:
+                self.language_model.set_cross_attention_beams(1)
+            if ngram_processor is not None:
+                self.language_model.beam_state_processors.remove(ngram_processor)
+            self.language_model.vocabulary_constraint = None
 
     def prepare_inputs_for_generation(
         self,
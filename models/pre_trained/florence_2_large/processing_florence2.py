@@ -24,6 +24,7 @@ import numpy as np
 import torch
 
 from transformers.feature_extraction_utils import BatchFeature
+from transformers.generation.logits_process import LogitsProcessor
 from transformers.image_utils import ImageInput, is_valid_image
 from transformers.processing_utils import ProcessorMixin
 from transformers.tokenization_utils_base import (
@@ -130,6 +131,19 @@ class Florence2Processor(ProcessorMixin):
             '<REGION_TO_OCR>': 'What text is in the region {input}?',
         }
 
+        # answer grammar of each post-processing type, see `task_constraint`:
+        # (phrases allowed, location tokens per box - 0 means whitelist only, consecutive boxes allowed, extra tokens)
+        self.tasks_answer_grammar = {
+            'pure_text': (True, 0, False, []),
+            'ocr': (True, 8, False, []),
+            'description_with_bboxes': (True, 4, True, []),
+            'bboxes': (False, 4, True, []),
+            'phrase_grounding': (True, 4, True, []),
+            'polygons': (True, 0, True, ['<poly>', '</poly>', '<sep>']),
+            'description_with_polygons': (True, 0, True, ['<poly>', '</poly>', '<sep>']),
+            'description_with_bboxes_or_polygons': (True, 0, True, ['<poly>', '</poly>', '<sep>']),
+        }
+
         self.post_processor = Florence2PostProcesser(tokenizer=tokenizer)
 
 
@@ -304,6 +318,40 @@ class Florence2Processor(ProcessorMixin):
         image_processor_input_names = self.image_processor.model_input_names
         return list(dict.fromkeys(tokenizer_input_names + image_processor_input_names))
 
+    def task_constraint(self, task, max_sliced_ratio=0.5):
+        """
+        Builds the vocabulary constraint of a task for `Florence2ForConditionalGeneration.generate(vocabulary_constraint=...)`.
+        The answer may only contain tokens the post-processor of the task parses, in the order it parses them.
+
+        Args:
+            task (`str`): The task token, e.g. `<OCR_WITH_REGION>`.
+            max_sliced_ratio (`float`): Logits are computed over the allowed rows of `lm_head` only when they are at
+                most this share of the vocabulary.
+        """
+        task_answer_post_processing_type = self.tasks_answer_post_processing_type.get(task, 'pure_text')
+        phrases, loc_group, repeat_boxes, extra_tokens = self.tasks_answer_grammar[task_answer_post_processing_type]
+
+        if not hasattr(self, '_phrase_token_ids'):
+            special_ids = set(self.tokenizer.all_special_ids)
+            self._phrase_token_ids = [i for i in range(len(self.tokenizer)) if i not in special_ids]
+        text_ids = (self._phrase_token_ids if phrases else []) + self.tokenizer.convert_tokens_to_ids(extra_tokens)
+        loc_ids = []
+        if task_answer_post_processing_type != 'pure_text':
+            num_bins = max(*self.post_processor.box_quantizer.bins, *self.post_processor.coordinates_quantizer.bins)
+            loc_ids = self.tokenizer.convert_tokens_to_ids([f'<loc_{i}>' for i in range(num_bins)])
+
+        return Florence2VocabularyConstraint(
+            text_ids=torch.tensor(text_ids, dtype=torch.long),
+            loc_ids=torch.tensor(loc_ids, dtype=torch.long),
+            loc_group=loc_group,
+            repeat_boxes=repeat_boxes,
+            vocab_size=len(self.tokenizer),
+            bos_token_id=self.tokenizer.bos_token_id,
+            eos_token_id=self.tokenizer.eos_token_id,
+            pad_token_id=self.tokenizer.pad_token_id,
+            max_sliced_ratio=max_sliced_ratio,
+        )
+
     def post_process_generation(self, text, task, image_size):
         """
         Post-process the output of the model to each of the task outputs.
@@ -374,6 +422,100 @@ class Florence2Processor(ProcessorMixin):
             task: final_answer}
         return final_answer 
 
+class Florence2VocabularyConstraint(LogitsProcessor):
+    """
+    Restricts the answer of a Florence-2 task to the tokens its post-processor parses, in the order it parses them:
+    `<loc_N>` tokens come in boxes of `loc_group` tokens (8 for a quad box of `<OCR_WITH_REGION>`, 4 for `<OD>` and
+    `<REGION_PROPOSAL>`), the answer ends only after a complete box. With `loc_group=0` only the whitelist applies.
+    Built by `Florence2Processor.task_constraint`.
+
+    With greedy search and sampling the language model asks `step_token_ids` for the union of tokens allowed at the
+    current step and computes the logits only for these rows of `lm_head`, the processor itself masks every
+    hypothesis to its own set. Beam search computes the full logits and relies on the processor alone.
+
+    Args:
+        text_ids (`torch.LongTensor`): Tokens allowed in phrases, empty if the answer has no text.
+        loc_ids (`torch.LongTensor`): Location tokens, empty if the answer has no boxes.
+        loc_group (`int`): Location tokens in one box, 0 - no grammar.
+        repeat_boxes (`bool`): Whether a box may directly follow another box.
+        vocab_size (`int`): Size of the tokenizer vocabulary.
+        max_sliced_ratio (`float`): Share of the vocabulary above which the logits are computed in full.
+    """
+
+    START, TEXT, LOC, BOX, DONE = range(5)
+
+    def __init__(self, text_ids, loc_ids, loc_group, repeat_boxes, vocab_size,
+                 bos_token_id, eos_token_id, pad_token_id, max_sliced_ratio=0.5):
+        self.text_ids = text_ids
+        self.loc_ids = loc_ids
+        self.loc_group = loc_group
+        self.vocab_size = vocab_size
+        self.bos_token_id = bos_token_id
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self.max_sliced_ratio = max_sliced_ratio
+
+        def tokens(*ids):
+            return torch.cat([torch.as_tensor(i, dtype=torch.long).view(-1) for i in ids])
+
+        anything = tokens(text_ids, loc_ids, eos_token_id)
+        if loc_group:
+            first = text_ids if len(text_ids) else loc_ids
+            after_box = tokens(text_ids, loc_ids if repeat_boxes else [], eos_token_id)
+            allowed = [tokens(first, eos_token_id, bos_token_id), tokens(text_ids, loc_ids), loc_ids, after_box]
+        else:
+            allowed = [tokens(anything, bos_token_id)] * 4
+        allowed.append(tokens(eos_token_id, pad_token_id))
+
+        self.table = torch.zeros(len(allowed), vocab_size, dtype=torch.bool)
+        for state, ids in enumerate(allowed):
+            self.table[state, ids] = True
+        self._unions = {}
+
+    def _states(self, input_ids):
+        length = input_ids.shape[1]
+        last = input_ids[:, -1]
+        states = torch.full_like(last, self.TEXT)
+        if self.loc_group:
+            # number of trailing location tokens
+            is_loc = torch.isin(input_ids, self.loc_ids.to(input_ids.device))
+            positions = torch.arange(length, device=input_ids.device).expand_as(input_ids)
+            run = length - 1 - torch.where(is_loc, -1, positions).max(dim=1).values
+            states[(run > 0) & (run % self.loc_group != 0)] = self.LOC
+            states[(run > 0) & (run % self.loc_group == 0)] = self.BOX
+        # the decoder starts with eos (decoder_start_token_id), then bos
+        if length == 1:
+            states[:] = self.START
+        else:
+            states[last == self.bos_token_id] = self.START
+            states[(last == self.eos_token_id) | (last == self.pad_token_id)] = self.DONE
+        return states
+
+    def step_token_ids(self, decoder_input_ids):
+        """
+        Tokens that any hypothesis may emit after `decoder_input_ids`, or None if the logits should be computed over
+        the whole vocabulary.
+        """
+        present = tuple(sorted(set(self._states(decoder_input_ids).tolist())))
+        key = (present, decoder_input_ids.device)
+        if key not in self._unions:
+            allowed = self.table[list(present)].any(dim=0).nonzero().squeeze(1)
+            sliced = len(allowed) <= self.max_sliced_ratio * self.vocab_size
+            self._unions[key] = allowed.to(decoder_input_ids.device) if sliced else None
+        return self._unions[key]
+
+    def __call__(self, input_ids, scores):
+        if self.table.device != scores.device:
+            self.table = self.table.to(scores.device)
+        mask = self.table[self._states(input_ids)]
+        if mask.shape[-1] < scores.shape[-1]:
+            mask = torch.nn.functional.pad(mask, (0, scores.shape[-1] - mask.shape[-1]))
+        constrained = scores.masked_fill(~mask[:, :scores.shape[-1]], -float("inf"))
+        # forced tokens (eos at max_length) win over the grammar instead of leaving a row without candidates
+        stuck = torch.isinf(constrained).all(dim=-1, keepdim=True)
+        return torch.where(stuck, scores, constrained)
+
+
 class BoxQuantizer(object):
     def __init__(self, mode, bins):
         self.mode = mode
@@ -0,0 +1,98 @@
+import pytest
+import torch
+from torch import nn
+
+from adapter_manager import AdapterManager, _random_adapter
+
+HIDDEN = 16
+
+
+@pytest.fixture
+def manager():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(HIDDEN, 32), nn.GELU(), nn.Linear(32, HIDDEN)).eval()
+    manager = AdapterManager(model, torch.float32)
+    for seed, name in enumerate(("a0", "a1")):
+        # Крупные веса, чтобы адаптеры заметно меняли выход
+        config, pairs = _random_adapter(model, 4, seed)
+        manager.add_adapter(name, config, {module: (a * 50, b * 50) for module, (a, b) in pairs.items()})
+    return manager
+
+
+def _run(manager, x, adapters=None, rows_per_request=1):
+    with torch.inference_mode(), manager.use(adapters, rows_per_request):
+        return manager.model(x)
+
+
+def test_use_switches_and_restores(manager):
+    x = torch.randn(3, 5, HIDDEN)
+    base = _run(manager, x)
+    assert manager.active is None
+    with manager.use("a0"):
+        assert manager.active == "a0"
+        with manager.use("a1"):
+            assert manager.active == "a1"
+        assert manager.active == "a0"
+        with manager.use(["a0", "a1"]):
+            assert manager.active == "mixed"
+    assert manager.active is None
+    assert not torch.allclose(_run(manager, x, "a0"), base)
+    assert not torch.allclose(_run(manager, x, "a0"), _run(manager, x, "a1"))
+    torch.testing.assert_close(_run(manager, x), base)
+
+
+@pytest.mark.parametrize("rows_per_request", [1, 3])
+def test_mixed_batch_matches_separate_passes(manager, rows_per_request):
+    adapters = ["a0", None, "a1", "a0"]
+    x = torch.randn(len(adapters) * rows_per_request, 5, HIDDEN)
+    mixed = _run(manager, x, adapters, rows_per_request)
+    for request, name in enumerate(adapters):
+        rows = slice(request * rows_per_request, (request + 1) * rows_per_request)
+        torch.testing.assert_close(mixed[rows], _run(manager, x[rows], name))
+
+
+def test_remove_adapter(manager):
+    x = torch.randn(2, 5, HIDDEN)
+    expected = _run(manager, x, "a1")
+    base = _run(manager, x)
+    manager.remove_adapter("a0")
+    assert manager.adapters == ["a1"]
+    with pytest.raises(KeyError):
+        _run(manager, x, "a0")
+    torch.testing.assert_close(_run(manager, x, "a1"), expected)
+    torch.testing.assert_close(_run(manager, x), base)
+
+
+@pytest.mark.parametrize("num_rows, rows_per_request", [(6, 1), (5, 1), (4, 3)])
+def test_mixed_batch_rejects_concatenated_inputs(manager, num_rows, rows_per_request):
+    # Склеенные патчи двух изображений (например, 4 + 2) по первой размерности не отличить от строк запросов
+    patches = torch.randn(num_rows, HIDDEN)
+    with pytest.raises(ValueError):
+        _run(manager, patches, ["a0", "a1"], rows_per_request)
+    # С одним адаптером на батч склеенный вход допустим
+    _run(manager, patches, ["a0", "a0"])
+
+
+def test_loaded_peft_adapter_matches_peft(tmp_path):
+    pytest.importorskip("peft")
+    from peft import LoraConfig, PeftModel, get_peft_model
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    config = LlamaConfig(vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2)
+    torch.manual_seed(0)
+    base = LlamaForCausalLM(config).eval()
+    adapter_path = str(tmp_path / "adapter")
+    lora = LoraConfig(r=4, lora_alpha=8, target_modules=["q_proj", "v_proj"], init_lora_weights=False)
+    get_peft_model(LlamaForCausalLM(config), lora).save_pretrained(adapter_path)
+
+    input_ids = torch.randint(0, 64, (2, 8), generator=torch.Generator().manual_seed(1))
+    with torch.inference_mode():
+        model = LlamaForCausalLM(config)
+        model.load_state_dict(base.state_dict())
+        expected = PeftModel.from_pretrained(model, adapter_path).eval()(input_ids).logits
+        manager = AdapterManager(base, torch.float32)
+        manager.load_adapter("adapter", adapter_path)
+        with manager.use("adapter"):
+            actual = base(input_ids).logits
+    torch.testing.assert_close(actual, expected)
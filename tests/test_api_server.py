@@ -0,0 +1,132 @@
+import base64
+import io
+import json
+
+import fitz
+import pytest
+
+pytest.importorskip("pytest_aiohttp")
+import pytest_asyncio
+from aiohttp import FormData
+from PIL import Image
+
+from api_server import ChatServer, StubChatBackend
+from map_reduce import CostModel
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest_asyncio.fixture
+async def client(aiohttp_client):
+    # Скорости заглушки высокие, чтобы тесты не ждали модельное время
+    backend = StubChatBackend(batch_size=4, cost_model=CostModel(prefill_tokens_per_s=1e9, decode_steps_per_s=1e4))
+    return await aiohttp_client(ChatServer(backend).app())
+
+
+def _png() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), "white").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def _pdf() -> bytes:
+    document = fitz.open()
+    document.new_page().insert_text((72, 72), "Договор поставки")
+    return document.tobytes()
+
+
+def _data_url(data: bytes, mime: str) -> str:
+    return f"data:{mime};base64,{base64.b64encode(data).decode()}"
+
+
+async def test_json_completion(client):
+    response = await client.post("/v1/chat/completions", json={
+        "model": "stub",
+        "messages": [
+            {"role": "system", "content": "Ты ассистент"},
+            {"role": "user", "content": [
+                {"type": "text", "text": "Что на картинке?"},
+                {"type": "image_url", "image_url": {"url": _data_url(_png(), "image/png")}},
+            ]},
+        ],
+    })
+    assert response.status == 200
+    body = await response.json()
+    assert body["object"] == "chat.completion"
+    answer = body["choices"][0]["message"]["content"]
+    assert "«Что на картинке?»" in answer and "1 файл(ам)" in answer
+    assert body["usage"]["total_tokens"] == body["usage"]["prompt_tokens"] + body["usage"]["completion_tokens"]
+
+
+async def test_multipart_completion(client):
+    form = FormData()
+    form.add_field("messages", json.dumps([{"role": "user", "content": [
+        {"type": "text", "text": "О чём договор?"},
+        {"type": "file", "file": {"file_data": _data_url(_pdf(), "application/pdf")}},
+    ]}]))
+    form.add_field("upload", _png(), filename="scan.png", content_type="image/png")
+    response = await client.post("/v1/chat/completions", data=form)
+    assert response.status == 200
+    answer = (await response.json())["choices"][0]["message"]["content"]
+    # PDF из сообщения и изображение отдельной частью
+    assert "«О чём договор?» по 2 файл(ам)" in answer
+
+
+async def test_stream_completion(client):
+    response = await client.post("/v1/chat/completions", json={
+        "messages": [{"role": "user", "content": "Кратко"}], "stream": True, "max_tokens": 5,
+    })
+    assert response.status == 200
+    assert response.headers["Content-Type"].startswith("text/event-stream")
+    events = [line.removeprefix("data: ") for line in (await response.text()).split("\n\n") if line]
+    assert events[-1] == "[DONE]"
+    chunks = [json.loads(event) for event in events[:-1]]
+    assert chunks[0]["choices"][0]["delta"] == {"role": "assistant"}
+    text = "".join(chunk["choices"][0]["delta"].get("content", "") for chunk in chunks)
+    assert text == "Ответ заглушки на вопрос «Кратко»"
+    assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+    assert chunks[-1]["usage"]["completion_tokens"] == 5
+
+
+@pytest.mark.parametrize("messages", [
+    ["Что в документе?"],
+    [{"role": "user", "content": ["Что в документе?"]}],
+    [{"role": "user", "content": [{"type": "image_url", "image_url": {"url": "https://example.com/a.png"}}]}],
+    [{"role": "user", "content": [{"type": "file", "file": "документ"}]}],
+    [{"role": "user", "content": 42}],
+    {"role": "user", "content": "Что в документе?"},
+])
+async def test_malformed_messages(client, messages):
+    response = await client.post("/v1/chat/completions", json={"messages": messages})
+    assert response.status == 400
+
+
+async def test_malformed_multipart_messages(client):
+    form = FormData()
+    form.add_field("messages", "[{не json")
+    response = await client.post("/v1/chat/completions", data=form)
+    assert response.status == 400
+
+
+async def test_bad_request_body(client):
+    assert (await client.post("/v1/chat/completions", data="не json")).status == 400
+    assert (await client.post("/v1/chat/completions", json=["Что в документе?"])).status == 400
+    response = await client.post("/v1/chat/completions", json={
+        "messages": [{"role": "user", "content": "Вопрос"}], "max_tokens": "много",
+    })
+    assert response.status == 400
+
+
+@pytest.mark.parametrize("field", ["max_tokens", "max_completion_tokens"])
+@pytest.mark.parametrize("value", [0, -5])
+async def test_non_positive_max_tokens(client, field, value):
+    response = await client.post("/v1/chat/completions", json={
+        "messages": [{"role": "user", "content": "Вопрос"}], field: value,
+    })
+    assert response.status == 400
+
+
+async def test_models_and_health(client):
+    assert [m["id"] for m in (await (await client.get("/v1/models")).json())["data"]] == ["stub"]
+    health = await (await client.get("/health")).json()
+    assert health["backend"] == "StubChatBackend" and health["batch_size"] == 4
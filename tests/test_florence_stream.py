@@ -0,0 +1,109 @@
+import importlib
+import os
+import random
+import sys
+
+import pytest
+import torch
+
+from florence_ocr import OcrRegionStreamer, OcrRegionStreamParser
+
+MODELS_DIR = os.path.join(os.path.dirname(__file__), "..", "models", "fine_tuned")
+IMAGE_SIZE = (1654, 2339)
+
+
+def _box(*coords: int) -> str:
+    return "".join(f"<loc_{c}>" for c in coords)
+
+
+# Вывод <OCR_WITH_REGION> после decoder_start_token (его OcrRegionStreamer пропускает):
+# строка с угловой скобкой в тексте, серия координат, прерванная текстом,
+# строка без текста перед координатами и хвост без координат
+GENERATED = (
+    "<s>Договор поставки № 5" + _box(100, 40, 900, 40, 900, 80, 100, 80)
+    + "Итого: 1 200 <руб.> с НДС" + _box(100, 120, 700, 120, 700, 150, 100, 150)
+    + "Цена " + _box(5, 6) + "за единицу" + _box(100, 200, 600, 200, 600, 230, 100, 230)
+    + _box(1, 2, 3, 4, 5, 6, 7, 8, 9)
+    + "Подпись" + _box(700, 900, 950, 900, 950, 960, 700, 960)
+    + "хвост без координат" + _box(1, 2, 3) + "</s><pad><pad>"
+)
+
+
+@pytest.fixture(scope="module")
+def post_processor():
+    sys.path.insert(0, MODELS_DIR)
+    try:
+        processing = importlib.import_module("florence_2_large.processing_florence2")
+    finally:
+        sys.path.remove(MODELS_DIR)
+    return processing.Florence2PostProcesser()
+
+
+def _stream(post_processor, chunks: list[str]) -> list[dict]:
+    parser = OcrRegionStreamParser(post_processor, IMAGE_SIZE)
+    emitted = []
+    for chunk in chunks:
+        emitted.extend(parser.feed(chunk))
+    assert emitted == parser.instances
+    return parser.finish()
+
+
+def _split(text: str, cuts: list[int]) -> list[str]:
+    bounds = [0] + sorted(cuts) + [len(text)]
+    return [text[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def test_whole_text_matches_post_processor(post_processor):
+    expected = post_processor(text=GENERATED, image_size=IMAGE_SIZE, parse_tasks="ocr")["ocr"]
+    assert len(expected) == 5
+    assert _stream(post_processor, [GENERATED]) == expected
+
+
+def test_every_single_split_matches(post_processor):
+    expected = post_processor(text=GENERATED, image_size=IMAGE_SIZE, parse_tasks="ocr")["ocr"]
+    for cut in range(1, len(GENERATED)):
+        assert _stream(post_processor, _split(GENERATED, [cut])) == expected, cut
+
+
+def test_split_inside_loc_tag(post_processor):
+    expected = post_processor(text=GENERATED, image_size=IMAGE_SIZE, parse_tasks="ocr")["ocr"]
+    tag = GENERATED.index("<loc_900>")
+    chunks = _split(GENERATED, [tag + 1, tag + 4, tag + 7])
+    assert chunks[1] == "loc" and chunks[2] == "_90"
+    assert _stream(post_processor, chunks) == expected
+
+
+def test_random_chunks_match(post_processor):
+    expected = post_processor(text=GENERATED, image_size=IMAGE_SIZE, parse_tasks="ocr")["ocr"]
+    rng = random.Random(0)
+    for _ in range(200):
+        cuts = rng.sample(range(1, len(GENERATED)), rng.randint(2, 40))
+        assert _stream(post_processor, _split(GENERATED, cuts)) == expected
+
+
+def test_character_by_character(post_processor):
+    expected = post_processor(text=GENERATED, image_size=IMAGE_SIZE, parse_tasks="ocr")["ocr"]
+    assert _stream(post_processor, list(GENERATED)) == expected
+
+
+class _PieceTokenizer:
+    # Токен - кусок текста; куски режут теги <loc_…> посередине
+    def __init__(self, pieces: list[str]):
+        self.pieces = pieces
+
+    def decode(self, ids: list[int], skip_special_tokens: bool = False) -> str:
+        return "".join(self.pieces[i] for i in ids)
+
+
+def test_streamer_emits_lines_as_they_complete(post_processor):
+    rng = random.Random(1)
+    pieces = _split(GENERATED, rng.sample(range(1, len(GENERATED)), 60))
+    tokenizer = _PieceTokenizer(["</s>"] + pieces)
+    parser = OcrRegionStreamParser(post_processor, IMAGE_SIZE)
+    lines = []
+    streamer = OcrRegionStreamer(tokenizer, parser, on_line=lines.append)
+    streamer.put(torch.tensor([[0]]))  # decoder_input_ids
+    for token in range(1, len(pieces) + 1):
+        streamer.put(torch.tensor([token]))
+    streamer.end()
+    assert lines == post_processor(text=GENERATED, image_size=IMAGE_SIZE, parse_tasks="ocr")["ocr"]
@@ -0,0 +1,50 @@
+import pytest
+import torch
+
+pytest.importorskip("peft")
+from peft import LoraConfig, PeftModel, get_peft_model
+from transformers import AutoModelForCausalLM, LlamaConfig, LlamaForCausalLM
+
+from lora_merge import MERGE_INFO, merge_checkpoint, merged_path, preferred_model_path
+
+
+def _save_adapter(tmp_path, **lora_kwargs) -> tuple[str, str]:
+    torch.manual_seed(0)
+    base = LlamaForCausalLM(LlamaConfig(
+        vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2,
+    ))
+    base_path, adapter_path = str(tmp_path / "base"), str(tmp_path / "adapter")
+    base.save_pretrained(base_path)
+    # init_lora_weights=False: B не нулевая, иначе адаптер ничего не меняет
+    get_peft_model(base, LoraConfig(init_lora_weights=False, **lora_kwargs)).save_pretrained(adapter_path)
+    return base_path, adapter_path
+
+
+def test_merged_checkpoint_matches_peft(tmp_path):
+    base_path, adapter_path = _save_adapter(
+        tmp_path, r=4, lora_alpha=8, target_modules=["q_proj", "v_proj", "down_proj"],
+        rank_pattern={"down_proj": 2}, alpha_pattern={"down_proj": 6}, modules_to_save=["lm_head"],
+    )
+    output_path = merge_checkpoint(adapter_path, base_model=base_path, dtype=torch.float32)
+    assert output_path == merged_path(adapter_path)
+    assert preferred_model_path(adapter_path) == output_path
+    assert (tmp_path / "adapter-merged" / MERGE_INFO).exists()
+
+    peft_model = PeftModel.from_pretrained(AutoModelForCausalLM.from_pretrained(base_path), adapter_path).eval()
+    merged = AutoModelForCausalLM.from_pretrained(output_path).eval()
+    input_ids = torch.randint(0, 64, (2, 12), generator=torch.Generator().manual_seed(1))
+    with torch.inference_mode():
+        expected = peft_model(input_ids).logits
+        base_logits = AutoModelForCausalLM.from_pretrained(base_path)(input_ids).logits
+        actual = merged(input_ids).logits
+    assert not torch.allclose(expected, base_logits, atol=1e-3)
+    torch.testing.assert_close(actual, expected, atol=1e-5, rtol=1e-4)
+
+
+def test_embedding_lora_is_rejected(tmp_path):
+    # lora_embedding_A/B не совпадают с LORA_KEY_RE и не должны молча пропадать
+    base_path, adapter_path = _save_adapter(tmp_path, r=4, lora_alpha=8, target_modules=["q_proj", "embed_tokens"])
+    with pytest.raises(KeyError, match="lora_embedding_A"):
+        merge_checkpoint(adapter_path, base_model=base_path, dtype=torch.float32)
+    assert preferred_model_path(adapter_path) == adapter_path
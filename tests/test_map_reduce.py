@@ -0,0 +1,97 @@
+from map_reduce import (
+    MAP_NEW_TOKENS,
+    NO_INFO,
+    REDUCE_NEW_TOKENS,
+    StubBackend,
+    is_no_info,
+    map_reduce_answer,
+    plan_chunks,
+)
+
+MARKED = (7, 63, 111)
+
+
+def make_pages(num_pages: int, tokens_per_page: int = 1300) -> list[dict]:
+    return [{
+        "label": f"стр. {i + 1}",
+        "tokens": tokens_per_page,
+        "features": None,
+        "text": "ОТВЕТ" if i in MARKED else "Типовой текст договора.",
+    } for i in range(num_pages)]
+
+
+class ScriptedBackend:
+    """Map-шаг отвечает заданными строками по порядку фрагментов, reduce склеивает ответы."""
+
+    batch_size = 1
+
+    def __init__(self, map_answers: list[str]):
+        self.map_answers = list(map_answers)
+        self.reduce_inputs = []
+
+    def generate_batch(self, requests: list[dict]) -> list[str]:
+        answers = []
+        for r in requests:
+            if "partials" in r:
+                self.reduce_inputs.append(r["partials"])
+                answers.append(" | ".join(r["partials"]) or NO_INFO)
+            else:
+                answers.append(self.map_answers.pop(0))
+        return answers
+
+
+def test_plan_chunks_keeps_order_and_budget():
+    pages = make_pages(10, 300)
+    chunks = plan_chunks(pages, budget=1000)
+    assert [page for chunk in chunks for page in chunk] == pages
+    assert all(sum(page["tokens"] for page in chunk) <= 1000 for chunk in chunks)
+
+
+def test_stub_backend_large_document():
+    backend = StubBackend(batch_size=8)
+    answer, report = map_reduce_answer(make_pages(120), "Где в документе ответ?", backend)
+    for i in MARKED:
+        assert f"стр. {i + 1}" in answer
+    assert report["chunks"] == report["estimate"]["map_calls"] > 1
+    assert all(size <= 8 for size in backend.batches)
+    assert report["reduce_rounds"] == 1
+
+
+def test_reduce_terminates_when_budget_fits_one_partial():
+    budget = 2 * MAP_NEW_TOKENS - 1
+    pages = [{"label": f"стр. {i + 1}", "tokens": 100, "features": None, "text": "ОТВЕТ"} for i in range(40)]
+    answer, report = map_reduce_answer(pages, "Вопрос", StubBackend(batch_size=4), budget=budget)
+    assert report["reduce_rounds"] > 1
+    for i in range(40):
+        assert f"ответ на стр. {i + 1}" in answer
+
+
+def test_reduce_outputs_counted_as_reduce_tokens():
+    requests = []
+
+    class RecordingBackend(StubBackend):
+        def generate_batch(self, batch):
+            requests.extend(batch)
+            return super().generate_batch(batch)
+
+    budget = 4 * MAP_NEW_TOKENS
+    pages = [{"label": f"стр. {i + 1}", "tokens": budget, "features": None, "text": "ОТВЕТ"} for i in range(16)]
+    map_reduce_answer(pages, "Вопрос", RecordingBackend(batch_size=4), budget=budget)
+    reduce_requests = [r for r in requests if "partials" in r]
+    assert reduce_requests[0]["tokens"] == len(reduce_requests[0]["partials"]) * MAP_NEW_TOKENS
+    assert reduce_requests[-1]["tokens"] == len(reduce_requests[-1]["partials"]) * REDUCE_NEW_TOKENS
+
+
+def test_only_exact_no_info_partials_are_dropped():
+    useful = "Срок оплаты 10 дней (стр. 3); в остальных пунктах нет сведений о штрафах."
+    backend = ScriptedBackend(["Нет сведений.", useful, f"«{NO_INFO}»"])
+    pages = [{"label": f"стр. {i + 1}", "tokens": 100, "features": None, "text": "текст"} for i in range(3)]
+    answer, _ = map_reduce_answer(pages, "Какой срок оплаты?", backend, budget=100)
+    assert backend.reduce_inputs == [[useful]]
+    assert answer == useful
+
+
+def test_is_no_info():
+    assert is_no_info("нет сведений")
+    assert is_no_info(" Нет сведений. ")
+    assert not is_no_info("Нет сведений о штрафах, срок оплаты 10 дней")
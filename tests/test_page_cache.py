@@ -0,0 +1,57 @@
+import os
+
+import torch
+from PIL import Image
+
+import page_cache
+from page_cache import PageCache
+
+
+def _pages(count: int) -> list[Image.Image]:
+    return [Image.new("RGB", (32, 24), (i * 40, 0, 0)) for i in range(count)]
+
+
+def _prepared() -> dict:
+    return {"content_key": "abc", "features": {"pixel_values": torch.ones(2, 3)}, "ocr_text": ["строка"]}
+
+
+def test_get_prepared_does_not_decode_pages(tmp_path, monkeypatch):
+    cache = PageCache(str(tmp_path), 2 ** 30)
+    cache.put("abc-ocr10-100", _pages(3), _prepared(), "uid-ocr10-100")
+
+    opened = []
+    monkeypatch.setattr(page_cache.Image, "open", lambda *args, **kwargs: opened.append(args) or None)
+    prepared = cache.get_prepared("abc-ocr10-100")
+    assert opened == []
+    assert prepared["ocr_text"] == ["строка"]
+    assert torch.equal(prepared["features"]["pixel_values"], torch.ones(2, 3))
+    assert cache.stats()["hits"] == 1
+
+
+def test_pages_load_lazily(tmp_path):
+    cache = PageCache(str(tmp_path), 2 ** 30)
+    pages = _pages(3)
+    cache.put("abc-ocr10-100", pages, _prepared())
+    assert cache.load_page("abc-ocr10-100", 2).getpixel((0, 0)) == pages[2].getpixel((0, 0))
+    assert cache.load_page("abc-ocr10-100", 3) is None
+
+    loaded, prepared = cache.get("abc-ocr10-100")
+    assert [page.getpixel((0, 0)) for page in loaded] == [page.getpixel((0, 0)) for page in pages]
+    assert prepared["content_key"] == "abc"
+
+
+def test_variants_are_separate_entries(tmp_path):
+    cache = PageCache(str(tmp_path), 2 ** 30)
+    cache.put("abc-ocr00-100", _pages(1), {**_prepared(), "ocr_text": None}, "uid-ocr00-100")
+    assert cache.get_prepared("abc-ocr10-100") is None
+    assert cache.lookup("uid-ocr10-100") is None
+    assert cache.lookup("uid-ocr00-100") == "abc-ocr00-100"
+
+
+def test_corrupted_entry_is_dropped(tmp_path):
+    cache = PageCache(str(tmp_path), 2 ** 30)
+    cache.put("abc-ocr10-100", _pages(2), _prepared())
+    os.remove(tmp_path / "abc-ocr10-100" / "page_0001.png")
+    assert cache.get("abc-ocr10-100") is None
+    assert cache.get_prepared("abc-ocr10-100") is None
+    assert cache.stats()["entries"] == 0
@@ -0,0 +1,87 @@
+import threading
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from page_transport import PageTransport, as_image, attach
+
+
+@pytest.fixture
+def transport():
+    transport = PageTransport(slab_bytes=4096)
+    yield transport
+    transport.close()
+
+
+def _page(value: int, size: int = 1000) -> np.ndarray:
+    return np.full(size, value, dtype=np.uint8)
+
+
+def test_image_round_trip(transport):
+    image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (20, 30, 3), dtype=np.uint8))
+    descriptor = transport.put_image(image)
+    assert np.array_equal(np.asarray(as_image(descriptor)), np.asarray(image))
+    array = np.arange(12, dtype=np.float32).reshape(3, 4)
+    assert np.array_equal(attach(transport.put_array(array)), array)
+
+
+def test_released_slab_is_reused_from_start(transport):
+    first = [transport.put_array(_page(i)) for i in range(3)]
+    assert [descriptor.offset for descriptor in first] == [0, 1024, 2048]
+    for descriptor in first:
+        transport.release(descriptor)
+    assert transport.stats() == {"slabs": 1, "bytes": 4096, "pages": 0}
+    assert transport.put_array(_page(7)).offset == 0
+
+
+def test_live_pages_are_not_overwritten(transport):
+    kept = transport.put_array(_page(1))
+    released = transport.put_array(_page(2))
+    transport.release(released)
+    # Сегмент ещё занят страницей kept: новые страницы идут дальше, а не с начала
+    later = [transport.put_array(_page(value)) for value in (3, 4, 5)]
+    assert later[0].offset == 2048 and later[1].offset == 3072
+    assert later[2].slab != kept.slab and transport.stats()["slabs"] == 2
+    assert (attach(kept) == 1).all()
+    for descriptor, value in zip(later, (3, 4, 5)):
+        assert (attach(descriptor) == value).all()
+
+
+def test_page_larger_than_slab_gets_own_slab(transport):
+    small = transport.put_array(_page(1))
+    large = transport.put_array(_page(9, 10000))
+    assert large.slab != small.slab and large.offset == 0
+    assert transport.stats()["bytes"] == 4096 + 10000
+    assert (attach(large) == 9).all() and (attach(small) == 1).all()
+
+
+def test_map_pages_releases_after_all_requests(monkeypatch, transport):
+    florence_ocr = pytest.importorskip("florence_ocr")
+    in_use = []
+
+    class SlowPool:
+        # Первая страница падает сразу, вторая ещё читается воркером
+        def __init__(self):
+            self.calls = 0
+
+        def submit(self, method, function_name, descriptor, cost):
+            future = Future()
+            self.calls += 1
+            if self.calls == 1:
+                future.set_exception(RuntimeError("страница не распознана"))
+            else:
+                def finish():
+                    in_use.append(transport.stats()["pages"])
+                    future.set_result("текст")
+                threading.Timer(0.2, finish).start()
+            return future
+
+    monkeypatch.setattr(florence_ocr, "ocr_pool", SlowPool)
+    monkeypatch.setattr(florence_ocr, "page_transport", lambda: transport)
+    images = [Image.new("RGB", (16, 16)), Image.new("RGB", (16, 16))]
+    with pytest.raises(RuntimeError):
+        florence_ocr._map_pages(florence_ocr.run_ocr, images)
+    assert in_use == [2]
+    assert transport.stats()["pages"] == 0
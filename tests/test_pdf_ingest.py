@@ -0,0 +1,68 @@
+import fitz
+import pytest
+
+from pdf_ingest import classify_page, drawing_coverage, ingest_pdf
+
+TEXT = (
+    "Отчёт о выручке за 2024 год. Выручка по кварталам приведена на диаграмме ниже, "
+    "рост относительно прошлого года составил 12 процентов."
+)
+
+
+def _page_with_text(document: fitz.Document) -> fitz.Page:
+    page = document.new_page()
+    page.insert_textbox(fitz.Rect(72, 72, 520, 160), TEXT)
+    return page
+
+
+def _draw_chart(page: fitz.Page):
+    # Столбчатая диаграмма: оси, залитые столбцы и линия тренда
+    shape = page.new_shape()
+    shape.draw_line((100, 500), (100, 250))
+    shape.draw_line((100, 500), (480, 500))
+    shape.finish(color=(0, 0, 0), width=1)
+    for i, height in enumerate((120, 180, 150, 220)):
+        shape.draw_rect(fitz.Rect(130 + i * 85, 500 - height, 190 + i * 85, 500))
+        shape.finish(color=None, fill=(0.2, 0.4, 0.8))
+    shape.draw_polyline([(160, 370), (245, 310), (330, 340), (415, 270)])
+    shape.finish(color=(0.8, 0.1, 0.1), width=2)
+    shape.commit()
+
+
+def _draw_layout(page: fitz.Page):
+    # Рамка страницы, подчёркивание и сетка таблицы - не графика
+    shape = page.new_shape()
+    shape.draw_rect(fitz.Rect(20, 20, page.rect.width - 20, page.rect.height - 20))
+    shape.draw_line((72, 165), (520, 165))
+    for y in range(200, 400, 25):
+        shape.draw_line((72, y), (520, y))
+    for x in (72, 220, 370, 520):
+        shape.draw_line((x, 200), (x, 375))
+    shape.finish(color=(0, 0, 0), width=0.5)
+    shape.commit()
+
+
+def test_text_page_with_vector_chart_is_mixed():
+    document = fitz.open()
+    page = _page_with_text(document)
+    _draw_chart(page)
+    assert drawing_coverage(page) > 0.1
+    assert classify_page(page) == "mixed"
+
+
+@pytest.mark.parametrize("layout", [False, True])
+def test_text_page_without_graphics_is_text(layout):
+    document = fitz.open()
+    page = _page_with_text(document)
+    if layout:
+        _draw_layout(page)
+    assert classify_page(page) == "text"
+
+
+def test_chart_page_is_rendered():
+    document = fitz.open()
+    _page_with_text(document)
+    _draw_chart(_page_with_text(document))
+    pages = ingest_pdf(document.tobytes())
+    assert [page["kind"] for page in pages] == ["text", "mixed"]
+    assert pages[0]["image"] is None and pages[1]["image"] is not None
@@ -0,0 +1,78 @@
+from collections import namedtuple
+
+import pytest
+
+from image_ingest import PHOTO_MAX_PIXELS
+from image_tokens import IMAGE_FACTOR, MAX_PIXELS, smart_resize
+from photo_policy import needs_detail, photo_max_pixels, select_photo_size
+
+PhotoSize = namedtuple("PhotoSize", ["file_unique_id", "width", "height"])
+
+# Варианты одного снимка 4000x3000, как их присылает Telegram
+TELEGRAM_SIZES = [
+    PhotoSize("s", 90, 68),
+    PhotoSize("m", 320, 240),
+    PhotoSize("x", 1700, 1275),
+    PhotoSize("y", 2560, 1920),
+    PhotoSize("w", 4000, 3000),
+]
+
+
+def test_needs_detail():
+    assert needs_detail("Прочитай номер договора")
+    assert needs_detail("Какая СУММА в чеке?")
+    assert not needs_detail("Что изображено на фото?")
+
+
+def test_photo_max_pixels():
+    assert photo_max_pixels(True) == MAX_PIXELS
+    assert photo_max_pixels(False) == PHOTO_MAX_PIXELS
+
+
+def test_detail_question_takes_largest():
+    assert select_photo_size(TELEGRAM_SIZES, detail=True).file_unique_id == "w"
+
+
+def test_plain_question_takes_smallest_sufficient():
+    selected = select_photo_size(TELEGRAM_SIZES)
+    target_width, target_height = smart_resize(4000, 3000, max_pixels=PHOTO_MAX_PIXELS)
+    assert selected.file_unique_id == "x"
+    assert selected.width >= target_width - IMAGE_FACTOR and selected.height >= target_height - IMAGE_FACTOR
+
+
+def test_order_of_sizes_does_not_matter():
+    assert select_photo_size(list(reversed(TELEGRAM_SIZES))).file_unique_id == "x"
+
+
+def test_portrait_photo():
+    sizes = [PhotoSize(s.file_unique_id, s.height, s.width) for s in TELEGRAM_SIZES]
+    assert select_photo_size(sizes).file_unique_id == "x"
+
+
+def test_one_patch_below_target_is_enough():
+    target_width, target_height = smart_resize(4000, 3000, max_pixels=PHOTO_MAX_PIXELS)
+    almost = PhotoSize("almost", target_width - IMAGE_FACTOR, target_height - IMAGE_FACTOR)
+    too_small = PhotoSize("small", target_width - 2 * IMAGE_FACTOR, target_height)
+    assert select_photo_size([too_small, almost, PhotoSize("w", 4000, 3000)]).file_unique_id == "almost"
+
+
+def test_missing_middle_sizes_fall_back_to_largest():
+    sizes = [PhotoSize("s", 90, 68), PhotoSize("m", 320, 240), PhotoSize("w", 4000, 3000)]
+    assert select_photo_size(sizes).file_unique_id == "w"
+
+
+def test_small_photo_returns_largest_available():
+    sizes = [PhotoSize("s", 90, 68), PhotoSize("m", 320, 240), PhotoSize("x", 800, 600)]
+    assert select_photo_size(sizes).file_unique_id == "x"
+    assert select_photo_size(sizes, detail=True).file_unique_id == "x"
+
+
+def test_single_size():
+    only = PhotoSize("only", 1280, 960)
+    assert select_photo_size([only]) is only
+    assert select_photo_size([only], detail=True) is only
+
+
+def test_no_sizes():
+    with pytest.raises(ValueError):
+        select_photo_size([])
@@ -0,0 +1,67 @@
+import pytest
+import torch
+from safetensors.torch import load_file
+
+import shard_loader
+from shard_loader import ShardedCheckpoint, make_sharded_checkpoint, prefetch_checkpoint, shard_files
+
+NUM_SHARDS, TENSORS_PER_SHARD = 3, 4
+
+
+@pytest.fixture
+def checkpoint_dir(tmp_path):
+    make_sharded_checkpoint(str(tmp_path), NUM_SHARDS, TENSORS_PER_SHARD, (64, 32))
+    return str(tmp_path)
+
+
+def _reference(checkpoint_dir: str) -> dict:
+    return {name: tensor for path in shard_files(checkpoint_dir) for name, tensor in load_file(path).items()}
+
+
+def test_tensors_load_lazily(checkpoint_dir):
+    checkpoint = ShardedCheckpoint(checkpoint_dir, workers=2)
+    assert len(checkpoint) == NUM_SHARDS * TENSORS_PER_SHARD
+    assert checkpoint.loaded == 0
+
+    name = next(iter(checkpoint))
+    first = checkpoint[name]
+    assert checkpoint.loaded == 1
+    assert checkpoint[name] is first
+
+    checkpoint.materialize([f"model.layers.{i}.weight" for i in range(TENSORS_PER_SHARD, 2 * TENSORS_PER_SHARD)])
+    assert checkpoint.loaded == 1 + TENSORS_PER_SHARD
+
+
+def test_tensors_match_load_file(checkpoint_dir):
+    reference = _reference(checkpoint_dir)
+    checkpoint = ShardedCheckpoint(checkpoint_dir, workers=2)
+    checkpoint.materialize()
+    assert checkpoint.loaded == len(reference)
+    assert set(checkpoint) == set(reference)
+    for name, tensor in reference.items():
+        assert torch.equal(checkpoint[name], tensor)
+    assert len(checkpoint.report()) == NUM_SHARDS
+
+
+def test_load_state_dict_from_checkpoint(checkpoint_dir):
+    reference = _reference(checkpoint_dir)
+    with torch.device("meta"):
+        model = torch.nn.Module()
+        model.model = torch.nn.Module()
+        model.model.layers = torch.nn.ModuleList(
+            torch.nn.Linear(32, 64, bias=False) for _ in range(NUM_SHARDS * TENSORS_PER_SHARD)
+        )
+    model.load_state_dict(ShardedCheckpoint(checkpoint_dir), assign=True)
+    assert torch.equal(model.model.layers[5].weight, reference["model.layers.5.weight"])
+
+
+def test_prefetch_skips_checkpoint_larger_than_memory(checkpoint_dir, monkeypatch):
+    assert set(prefetch_checkpoint(checkpoint_dir)) == set(shard_files(checkpoint_dir))
+    monkeypatch.setattr(shard_loader, "available_memory", lambda: 1024)
+    assert prefetch_checkpoint(checkpoint_dir) == {}
+
+
+def test_missing_checkpoint(tmp_path):
+    assert prefetch_checkpoint(str(tmp_path)) == {}
+    with pytest.raises(FileNotFoundError):
+        ShardedCheckpoint(str(tmp_path))
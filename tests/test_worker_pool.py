@@ -0,0 +1,43 @@
+import pickle
+
+import pytest
+
+from worker_pool import InferencePool, WorkerError
+
+
+@pytest.fixture
+def pool():
+    pool = InferencePool("worker_pool:StubModel", 2, health_interval=0.2)
+    assert pool.wait_ready(timeout=60)
+    yield pool
+    pool.close()
+
+
+def test_map_keeps_order(pool):
+    prompts = [f"вопрос {i}" for i in range(6)]
+    assert pool.map("generate", prompts) == [f"ответ на «{prompt}»" for prompt in prompts]
+    assert sum(m["completed"] for m in pool.metrics()) == len(prompts)
+
+
+def test_worker_error_is_returned(pool):
+    with pytest.raises(WorkerError, match="AttributeError"):
+        pool.submit("missing").result(timeout=30)
+
+
+def test_crashed_request_is_retried_then_failed(pool):
+    # crash роняет и первого воркера, и того, кому запрос отправлен повторно (MAX_RETRIES = 1)
+    with pytest.raises(WorkerError, match="упал"):
+        pool.submit("crash").result(timeout=60)
+    assert sum(m["restarts"] for m in pool.metrics()) == 2
+    assert pool.wait_ready(timeout=60)
+    assert pool.submit("generate", "после сбоя", 1).result(timeout=30) == "ответ на «после сбоя»"
+
+
+def test_late_response_of_previous_owner_is_ignored(pool):
+    future = pool.submit("generate", "долгий", 200)
+    with pool._lock:
+        (request_id, request), = pool._pending.items()
+        previous_owner = 1 - request["worker"]
+    # Ответ воркера, которому запрос был отправлен до перезапуска, приходит после повторной отправки
+    pool._handle_response((request_id, previous_owner, "ok", pickle.dumps("устаревший"), 0.0))
+    assert future.result(timeout=60) == "ответ на «долгий»"